@@ -33,6 +33,10 @@ comandos_sql = [
 
     # 8. Índice para filtro combinado por Status + Modalidade
     "CREATE INDEX idx_status_modalidade ON licitacoes (situacaoReal, modalidadeId)",
+
+    # 9. Índices para ordenação pelas datas da proposta (paginação por cursor da /api/licitacoes busca por intervalo neles)
+    "CREATE INDEX idx_data_abertura ON licitacoes (dataAberturaProposta)",
+    "CREATE INDEX idx_data_encerramento ON licitacoes (dataEncerramentoProposta)",
 ]
 
 def get_db_connection():
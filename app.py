@@ -37,7 +37,11 @@ import hmac # Para comparação segura de senha
 import json
 import traceback
 import hashlib
+import base64 # Cursor opaco da paginação por keyset
+import unicodedata # Remoção de acentos na assinatura dos filtros de busca
 from mysql.connector import pooling
+from geracao_cache import geracao_atual, adquirir_trava, liberar_trava # Geração dos dados (incrementada pelo sync) e travas do cache
+from concurrent.futures import ThreadPoolExecutor # Recálculo do cache da busca em segundo plano
 
 # =========================================================================
 # ========================= FIREBASE ======================================
@@ -667,37 +671,22 @@ def _build_licitacoes_query(filtros):
     
     return query_where, parametros_db
 
-@app.route('/api/licitacoes', methods=['GET'])
-@cache.cached(timeout=10800, query_string=True)   # Cacheia a resposta por 3 horas, considerando os parâmetros da query string. Mudar depois para "timeout=900" quando tiver muitos usuários
-def get_licitacoes():
-    # 1. Coleta e valida os parâmetros de paginação/ordenação
-    pagina = request.args.get('pagina', default=1, type=int)
-    por_pagina = request.args.get('porPagina', default=20, type=int)
-    orderBy_param = request.args.get('orderBy', default='dataAtualizacao', type=str)
-    orderDir_param = request.args.get('orderDir', default='DESC', type=str).upper()
 
-    if pagina < 1:
-        pagina = 1
-    if por_pagina not in [10, 20, 50, 100]:
-        por_pagina = 20
+# --- FILTROS CANÔNICOS E ASSINATURA DA BUSCA ---
+# A mesma busca escrita de jeitos diferentes (uf=SP,RJ / uf=RJ&uf=SP, espaços, termos repetidos, statusRadar=TODOS)
+# vira o mesmo dict de filtros e a mesma assinatura. A assinatura é a chave de cache da busca, da exportação e da
+# contagem. Os filtros canônicos também são os que vão para o SQL, então a mesma chave sempre tem o mesmo resultado.
+# Cada entrada guarda a geração dos dados (geracao_cache.py) em que foi calculada: o sync, o atualizar_status.py e o
+# limpeza_db.py incrementam a geração depois de gravar, e a entrada de uma geração anterior vira velha (ver
+# _obter_com_cache). Por isso o timeout é longo: ele só devolve a memória do Redis, quem garante dado novo é a geração.
+TIMEOUT_CACHE_BUSCA = 7 * 86400 # 7 dias
+TAMANHO_MAXIMO_CACHE_CSV = 5 * 1024 * 1024 # Exportações maiores que isso não vão para o Redis
 
-    campos_validos_ordenacao = [
-        'dataPublicacaoPncp', 'dataAtualizacao', 'valorTotalEstimado',
-        'dataAberturaProposta', 'dataEncerramentoProposta', 'modalidadeNome',
-        'orgaoEntidadeRazaoSocial', 'unidadeOrgaoMunicipioNome', 'situacaoReal'
-    ]
-    if orderBy_param not in campos_validos_ordenacao:
-        return jsonify({"erro": "Parâmetro de ordenação inválido."}), 400
-    if orderDir_param not in ['ASC', 'DESC']:
-        return jsonify({"erro": "Parâmetro de direção de ordenação inválido."}), 400
-
-    # 2. Coleta todos os filtros em um único dicionário
-    # Função auxiliar para limpar e dividir a string
+def _coletar_filtros_busca():
+    """Filtros da URL já canônicos. Listas aceitam vírgulas (uf=SP,RJ) e parâmetro repetido (uf=SP&uf=RJ)."""
     def parse_lista_param(param_name):
-        value = request.args.get(param_name, '')
-        # Primeiro, divide pela vírgula. Depois, remove espaços de cada item.
-        # E por fim, filtra quaisquer itens que ficaram vazios.
-        return [item.strip() for item in value.split(',') if item.strip()]
+        # Divide cada ocorrência pela vírgula, remove espaços de cada item e descarta os vazios
+        return [item.strip() for valor in request.args.getlist(param_name) for item in valor.split(',') if item.strip()]
 
     filtros = {
         'ufs': parse_lista_param('uf'),
@@ -716,28 +705,327 @@ def get_licitacoes():
         'cnpjOrgao': request.args.get('cnpjOrgao'),
         'statusId': request.args.get('statusId', type=int),
     }
-    # Limpa filtros vazios ou nulos
-    filtros = {k: v for k, v in filtros.items() if v is not None and v != '' and v != []}
+    return _canonicalizar_filtros(filtros)
+
+
+def _canonicalizar_filtros(filtros):
+    """Listas sem repetição e ordenadas, espaços colapsados, UF em maiúsculas, vazios e valores padrão removidos."""
+    canonicos = {}
+    for chave, valor in filtros.items():
+        if isinstance(valor, list):
+            if chave == 'ufs':
+                valor = sorted({item.upper() for item in valor})
+            elif chave == 'modalidadesId':
+                valor = sorted({int(item) for item in valor})
+            else:
+                valor = sorted({' '.join(str(item).split()) for item in valor} - {''})
+        elif isinstance(valor, str):
+            valor = ' '.join(valor.split())
+        if valor is None or valor == '' or valor == []:
+            continue
+        canonicos[chave] = valor
 
-    # 3. Monta a cláusula WHERE e os parâmetros usando a função centralizada
-    query_where, parametros_db = _build_licitacoes_query(filtros)
+    # Mesma precedência do _build_licitacoes_query: statusRadar (exceto TODOS) vence o statusId
+    status_radar = canonicos.get('statusRadar')
+    if status_radar and status_radar.upper() == 'TODOS':
+        del canonicos['statusRadar']
+    elif status_radar:
+        canonicos.pop('statusId', None)
+    return canonicos
 
-    # 4. Monta as queries de contagem e de dados
-    query_contagem = f"SELECT COUNT(*) as total FROM licitacoes {query_where}"
-    
-    query_select_dados = f"""
-        SELECT * FROM licitacoes
-        {query_where}
-        ORDER BY {orderBy_param} {orderDir_param}
-        LIMIT %s OFFSET %s
+
+def _dobrar_texto(texto):
+    """Minúsculas e sem acentos ('São Paulo' -> 'sao paulo')."""
+    decomposto = unicodedata.normalize('NFKD', texto.casefold())
+    return ''.join(c for c in decomposto if not unicodedata.combining(c))
+
+
+def _assinatura_filtros(filtros, **extras):
+    """
+    Hash estável da busca. Texto entra sem caixa e sem acentos: a collation da tabela (utf8mb4, *_ci/_ai) e o FULLTEXT
+    já os ignoram, então 'São Paulo' e 'sao paulo' dão o mesmo resultado. 'extras' = página, ordenação etc.
+    """
+    dobrados = {}
+    for chave, valor in filtros.items():
+        if isinstance(valor, list):
+            valor = sorted({_dobrar_texto(item) if isinstance(item, str) else item for item in valor}, key=str)
+        elif isinstance(valor, str):
+            valor = _dobrar_texto(valor)
+        dobrados[chave] = valor
+    bruto = json.dumps({'filtros': dobrados, **extras}, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(bruto.encode('utf-8')).hexdigest()
+
+
+def _chave_cache_busca(prefixo, filtros, **extras):
+    """Chave da entrada no cache (a geração dos dados vai dentro da entrada, não na chave)."""
+    return f"{prefixo}_{_assinatura_filtros(filtros, **extras)}"
+
+
+# --- CACHE DA BUSCA: STALE-WHILE-REVALIDATE + SINGLE-FLIGHT ---
+# Entrada = {'geracao', 'calculado_em', 'valor'}. Três casos:
+#  - fresca (da geração atual): servida direto, sem limite de idade. Quem grava o que a busca mostra incrementa a
+#    geração (sync, limpeza, reprocessamento e worker_enriquecimento.py, este no máximo a cada
+#    SYNC_ENRIQUECIMENTO_INTERVALO_PUBLICACAO segundos); sem isso, recalcular daria o mesmo resultado (a entrada vence
+#    pelo TIMEOUT_CACHE_BUSCA);
+#  - velha (de geração anterior, mas mais nova que IDADE_MAXIMA_VELHA): servida na hora e recalculada
+#    em segundo plano por um único processo (trava no Redis), sem requisições esperando o banco;
+#  - ausente ou velha demais: só quem pega a trava consulta o banco e as requisições iguais esperam o resultado dele
+#    (até ESPERA_MAXIMA_RECALCULO) em vez de repetir a mesma busca FULLTEXT no pool de 10 conexões.
+# Se o banco falhar, a entrada velha (de qualquer idade) é servida no lugar do erro.
+IDADE_MAXIMA_VELHA = int(os.getenv('CACHE_BUSCA_IDADE_MAXIMA_VELHA', 6 * 3600)) # Segundos
+TIMEOUT_TRAVA_RECALCULO = 60 # Segundos: a trava vence sozinha se o processo morrer no meio do recálculo
+ESPERA_MAXIMA_RECALCULO = 10 # Segundos
+INTERVALO_ESPERA_RECALCULO = 0.05 # Segundos entre as leituras do cache enquanto outro processo recalcula
+_executor_recalculo = ThreadPoolExecutor(max_workers=2, thread_name_prefix='recalculo_cache')
+
+class BancoIndisponivel(Exception):
+    """Sem conexão do pool para calcular a resposta."""
+
+
+def _gravar_no_cache(chave, valor, geracao, pode_gravar=None):
+    if pode_gravar and not pode_gravar(valor):
+        return
+    cache.set(chave, {'geracao': geracao, 'calculado_em': time.time(), 'valor': valor}, timeout=TIMEOUT_CACHE_BUSCA)
+
+
+def _recalcular_em_segundo_plano(chave, calcular, geracao, token, pode_gravar):
+    """Roda no executor: recalcula, grava e libera a trava. Se falhar, a entrada velha continua no cache."""
+    try:
+        _gravar_no_cache(chave, calcular(), geracao, pode_gravar)
+    except Exception as err:
+        app.logger.warning(f"CACHE_BUSCA: Recálculo em segundo plano de {chave} falhou, entrada velha mantida: {err}")
+    finally:
+        liberar_trava(f"trava_{chave}", token)
+
+
+def _obter_com_cache(chave, calcular, pode_gravar=None):
+    """
+    Valor da chave pelas regras acima. 'calcular' não pode usar o request (pode rodar em outra thread) e levanta
+    BancoIndisponivel ou mysql.connector.Error quando o banco falha. 'pode_gravar(valor)' = False não guarda o valor.
     """
+    geracao = geracao_atual()
+    if geracao is None: # Sem Redis: sem cache e sem trava
+        return calcular()
+
+    entrada = cache.get(chave)
+    if entrada is not None:
+        if entrada['geracao'] == geracao:
+            return entrada['valor']
+        if time.time() - entrada['calculado_em'] < IDADE_MAXIMA_VELHA:
+            token = adquirir_trava(f"trava_{chave}", TIMEOUT_TRAVA_RECALCULO)
+            if token: # Sem a trava, outro processo já está recalculando esta chave
+                _executor_recalculo.submit(_recalcular_em_segundo_plano, chave, calcular, geracao, token, pode_gravar)
+            return entrada['valor']
+
+    token = adquirir_trava(f"trava_{chave}", TIMEOUT_TRAVA_RECALCULO)
+    if token is None:
+        # Outro processo está consultando o banco para a mesma chave: espera o resultado dele
+        limite = time.monotonic() + ESPERA_MAXIMA_RECALCULO
+        while time.monotonic() < limite:
+            time.sleep(INTERVALO_ESPERA_RECALCULO)
+            nova = cache.get(chave)
+            if nova is not None and (entrada is None or nova['calculado_em'] > entrada['calculado_em']):
+                return nova['valor']
+        app.logger.warning(f"CACHE_BUSCA: Recálculo de {chave} passou de {ESPERA_MAXIMA_RECALCULO}s; consultando o banco também.")
+
+    try:
+        valor = calcular()
+        _gravar_no_cache(chave, valor, geracao, pode_gravar) # Antes de liberar a trava: quem espera já encontra o valor
+    except (BancoIndisponivel, mysql.connector.Error) as err:
+        if entrada is None:
+            raise
+        app.logger.warning(f"CACHE_BUSCA: Banco falhou ({err}); servindo a entrada velha de {chave}.")
+        return entrada['valor']
+    finally:
+        if token:
+            liberar_trava(f"trava_{chave}", token)
+    return valor
+
+
+# --- PAGINAÇÃO POR CURSOR (KEYSET) ---
+# Em vez de OFFSET (o banco lê e descarta todas as linhas anteriores), o cursor guarda o valor da coluna de ordenação
+# e o id da última linha entregue, e a próxima página começa dali com um predicado de intervalo sobre o índice
+# da coluna (ex.: idx_situacao_data_att, idx_data_pub). O id desempata linhas com o mesmo valor.
+# No MariaDB, NULL vem primeiro no ASC e por último no DESC; o predicado abaixo respeita essa ordem.
+def _codificar_cursor(ultima_linha, order_by, order_dir):
+    """Cursor opaco (base64url de um JSON curto) apontando para depois de 'ultima_linha'."""
+    valor = ultima_linha.get(order_by)
+    if isinstance(valor, (datetime, date, Decimal)):
+        valor = str(valor) # 'AAAA-MM-DD HH:MM:SS' / '123.45': o banco compara direto com a coluna
+    dados = {'o': order_by, 'd': order_dir, 'v': valor, 'id': ultima_linha['id']}
+    bruto = json.dumps(dados, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(bruto).decode('ascii').rstrip('=')
+
+
+def _decodificar_cursor(cursor_param, order_by, order_dir):
+    """Devolve (valor, id) do cursor ou None se ele for inválido ou de outra ordenação."""
+    try:
+        bruto = base64.urlsafe_b64decode(cursor_param + '=' * (-len(cursor_param) % 4))
+        dados = json.loads(bruto.decode('utf-8'))
+        ultimo_id = dados['id']
+        valor = dados['v']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(dados, dict) or dados.get('o') != order_by or dados.get('d') != order_dir:
+        return None
+    if isinstance(ultimo_id, bool) or not isinstance(ultimo_id, int):
+        return None
+    if valor is not None and not isinstance(valor, (str, int, float)):
+        return None
+    return valor, ultimo_id
+
+
+def _build_keyset_predicate(order_by, order_dir, valor, ultimo_id):
+    """Condição "vem depois de (valor, id)" na ordem ORDER BY order_by order_dir, id order_dir."""
+    if order_dir == 'DESC':
+        if valor is None: # Já estamos no bloco final de NULLs
+            return f"({order_by} IS NULL AND id < %s)", [ultimo_id]
+        return f"({order_by} < %s OR ({order_by} = %s AND id < %s) OR {order_by} IS NULL)", [valor, valor, ultimo_id]
+    if valor is None: # Resto dos NULLs (que vêm primeiro) e depois todos os não nulos
+        return f"(({order_by} IS NULL AND id > %s) OR {order_by} IS NOT NULL)", [ultimo_id]
+    return f"({order_by} > %s OR ({order_by} = %s AND id > %s))", [valor, valor, ultimo_id]
+
+
+# --- CONTAGEM DE RESULTADOS (withCount) ---
+# A contagem não depende da página nem da ordenação: fica em cache por filtro, versionada pela geração dos dados
+# (ver _chave_cache_busca), então percorrer um resultado custa uma query por página.
+# Filtros só de status/UF/modalidade (ou nenhum) somam a tabela licitacoes_agregados, recalculada a cada sync,
+# em vez de rodar COUNT(*) na tabela principal: o total vem marcado como estimado.
+FILTROS_CONTAGEM_AGREGADA = {'statusRadar', 'ufs', 'modalidadesId'}
+
+def _contar_por_agregados(cursor, filtros):
+    """Total pela licitacoes_agregados ou None se ela ainda não foi preenchida (nunca rodou um sync com ela)."""
+    condicoes, parametros = [], []
+    status_radar = filtros.get('statusRadar')
+    if status_radar and status_radar.upper() != 'TODOS':
+        condicoes.append("situacaoReal = %s")
+        parametros.append(status_radar)
+    if filtros.get('ufs'):
+        condicoes.append(f"unidadeOrgaoUfSigla IN ({', '.join(['%s'] * len(filtros['ufs']))})")
+        parametros.extend(uf.upper() for uf in filtros['ufs'])
+    if filtros.get('modalidadesId'):
+        condicoes.append(f"modalidadeId IN ({', '.join(['%s'] * len(filtros['modalidadesId']))})")
+        parametros.extend(filtros['modalidadesId'])
+    query_where = f" WHERE {' AND '.join(condicoes)}" if condicoes else ""
+    cursor.execute(
+        f"SELECT EXISTS(SELECT 1 FROM licitacoes_agregados) AS preenchida, COALESCE(SUM(total), 0) AS total FROM licitacoes_agregados{query_where}",
+        parametros
+    )
+    resultado = cursor.fetchone()
+    return int(resultado['total']) if resultado and resultado['preenchida'] else None
+
+
+def _contar_licitacoes(cursor, filtros, query_where, parametros_db):
+    """(total, estimado). 'filtros' = filtros canônicos (_coletar_filtros_busca)."""
+    # A contagem só é calculada dentro da busca (já protegida pelo _obter_com_cache), então fica num cache simples,
+    # com a geração dos dados na chave: contagem de geração anterior nunca é reaproveitada
+    geracao = geracao_atual()
+    chave_cache = None
+    if geracao is not None: # Sem Redis não há como saber se a contagem guardada ainda vale: conta direto
+        chave_cache = f"contagem_licitacoes_{geracao}_{_assinatura_filtros(filtros)}"
+        em_cache = cache.get(chave_cache)
+        if em_cache is not None:
+            return em_cache['total'], em_cache['estimado']
+
+    total = None
+    estimado = False
+    if set(filtros) <= FILTROS_CONTAGEM_AGREGADA:
+        try:
+            total = _contar_por_agregados(cursor, filtros)
+            estimado = total is not None
+        except errors.ProgrammingError as err: # Tabela ainda não criada (atualizar_db_sync.sql)
+            app.logger.warning(f"Contagem agregada indisponível, usando COUNT(*): {err}")
+    if total is None:
+        cursor.execute(f"SELECT COUNT(*) as total FROM licitacoes {query_where}", parametros_db)
+        resultado = cursor.fetchone()
+        total = resultado['total'] if resultado else 0
+
+    if chave_cache:
+        cache.set(chave_cache, {'total': total, 'estimado': estimado}, timeout=TIMEOUT_CACHE_BUSCA)
+    return total, estimado
+
+
+@app.route('/api/licitacoes', methods=['GET'])
+def get_licitacoes():
+    # 1. Coleta e valida os parâmetros de paginação/ordenação
+    pagina = request.args.get('pagina', default=1, type=int)
+    por_pagina = request.args.get('porPagina', default=20, type=int)
+    orderBy_param = request.args.get('orderBy', default='dataAtualizacao', type=str)
+    orderDir_param = request.args.get('orderDir', default='DESC', type=str).upper()
+
+    if pagina < 1:
+        pagina = 1
+    if por_pagina not in [10, 20, 50, 100]:
+        por_pagina = 20
+
+    campos_validos_ordenacao = [
+        'dataPublicacaoPncp', 'dataAtualizacao', 'valorTotalEstimado',
+        'dataAberturaProposta', 'dataEncerramentoProposta', 'modalidadeNome',
+        'orgaoEntidadeRazaoSocial', 'unidadeOrgaoMunicipioNome', 'situacaoReal'
+    ]
+    if orderBy_param not in campos_validos_ordenacao:
+        return jsonify({"erro": "Parâmetro de ordenação inválido."}), 400
+    if orderDir_param not in ['ASC', 'DESC']:
+        return jsonify({"erro": "Parâmetro de direção de ordenação inválido."}), 400
+
+    # Modo cursor: 'cursor' presente na URL (vazio = primeira página). Sem OFFSET: a página N custa o mesmo que a 1.
+    # O modo 'pagina' continua para a interface web (precisa do total de páginas).
+    modo_cursor = 'cursor' in request.args
+    # withCount: total de registros na resposta. Padrão: sim no modo página, não no modo cursor.
+    com_contagem = request.args.get('withCount', default='0' if modo_cursor else '1', type=str).strip().lower() in ('1', 'true', 'sim')
+    posicao_cursor = None
+    cursor_param = request.args.get('cursor', default='', type=str).strip()
+    if cursor_param:
+        posicao_cursor = _decodificar_cursor(cursor_param, orderBy_param, orderDir_param)
+        if posicao_cursor is None:
+            return jsonify({"erro": "Cursor inválido ou de outra ordenação."}), 400
+
+    # 2. Coleta todos os filtros em um único dicionário (canônico) e busca a resposta pelo cache da assinatura
+    filtros = _coletar_filtros_busca()
+    chave_cache = _chave_cache_busca(
+        "busca_licitacoes", filtros, pagina=None if modo_cursor else pagina, por_pagina=por_pagina, order_by=orderBy_param,
+        order_dir=orderDir_param, cursor=cursor_param if modo_cursor else None, com_contagem=com_contagem
+    )
+    try:
+        resposta = _obter_com_cache(chave_cache, lambda: _executar_busca_licitacoes(
+            filtros, pagina, por_pagina, orderBy_param, orderDir_param, modo_cursor, posicao_cursor, com_contagem
+        ))
+    except BancoIndisponivel:
+        return jsonify({"erro": "Falha na conexão com o banco de dados."}), 503
+    except mysql.connector.Error as err:
+        app.logger.error(f"Erro de SQL em get_licitacoes: {err}")
+        return jsonify({"erro": "Erro interno ao processar sua busca.", "detalhes": str(err)}), 500
+    return jsonify(resposta)
+
+
+def _executar_busca_licitacoes(filtros, pagina, por_pagina, orderBy_param, orderDir_param, modo_cursor, posicao_cursor, com_contagem):
+    """Consulta do get_licitacoes (sem o request: também roda no recálculo em segundo plano do cache)."""
+    # 3. Monta a cláusula WHERE e os parâmetros usando a função centralizada (ela altera o dict: vai uma cópia)
+    query_where, parametros_db = _build_licitacoes_query(dict(filtros))
+
+    # 4. Monta a query de dados (a contagem é feita à parte, por _contar_licitacoes)
+    # O id entra no ORDER BY como desempate: ordem estável entre páginas (e necessária para o cursor)
+    ordenacao = f"ORDER BY {orderBy_param} {orderDir_param}, id {orderDir_param}"
+    if modo_cursor:
+        where_cursor, parametros_cursor = query_where, []
+        if posicao_cursor:
+            predicado, parametros_cursor = _build_keyset_predicate(orderBy_param, orderDir_param, *posicao_cursor)
+            where_cursor = f"{query_where} AND {predicado}" if query_where else f" WHERE {predicado}"
+        query_select_dados = f"SELECT * FROM licitacoes {where_cursor} {ordenacao} LIMIT %s"
+        parametros_dados_sql = parametros_db + parametros_cursor + [por_pagina + 1]
+    else:
+        query_select_dados = f"SELECT * FROM licitacoes {query_where} {ordenacao} LIMIT %s OFFSET %s"
+        parametros_dados_sql = parametros_db + [por_pagina + 1, (pagina - 1) * por_pagina]
+    # Nos dois modos busca uma linha a mais só para saber se existe próxima página (sem depender da contagem)
     
     conn = get_db_connection()
     if not conn:
-        return jsonify({"erro": "Falha na conexão com o banco de dados."}), 503
+        raise BancoIndisponivel()
 
     licitacoes_lista = []
-    total_registros = 0
+    total_registros = None
+    total_estimado = False
+    proximo_cursor = None
     try:
         # Cria cursores que retornam dicionários
         cursor_dados = conn.cursor(dictionary=True)
@@ -747,24 +1035,20 @@ def get_licitacoes():
         # Isso reduz a chance de a leitura bloquear o script de escrita (sync_api.py).
         cursor_contagem.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
         
-        # Executa a query de contagem total
-        cursor_contagem.execute(query_contagem, parametros_db)
-        resultado_contagem = cursor_contagem.fetchone()
-        if resultado_contagem:
-            total_registros = resultado_contagem['total']
+        # Contagem total (opcional, em cache por filtro)
+        if com_contagem:
+            total_registros, total_estimado = _contar_licitacoes(cursor_contagem, filtros, query_where, parametros_db)
 
         # Executa a query de dados com paginação
-        parametros_dados_sql = parametros_db + [por_pagina, (pagina - 1) * por_pagina]
         cursor_dados.execute(query_select_dados, parametros_dados_sql)
         licitacoes_lista_bruta = cursor_dados.fetchall()
+
+        # O cursor é montado com os valores crus do banco (antes do formatar_para_json)
+        if len(licitacoes_lista_bruta) > por_pagina:
+            licitacoes_lista_bruta = licitacoes_lista_bruta[:por_pagina]
+            proximo_cursor = _codificar_cursor(licitacoes_lista_bruta[-1], orderBy_param, orderDir_param)
         
         licitacoes_lista = [formatar_para_json(row) for row in licitacoes_lista_bruta]
-
-
-
-    except mysql.connector.Error as err:
-        app.logger.error(f"Erro de SQL em get_licitacoes: {err}")
-        return jsonify({"erro": "Erro interno ao processar sua busca.", "detalhes": str(err)}), 500
     finally:
         if conn and conn.is_connected():    # Verifica se a conexão e o cursor estão abertos, se tiverem então fecha
             if 'cursor_dados' in locals():
@@ -773,16 +1057,32 @@ def get_licitacoes():
                 cursor_contagem.close()
             conn.close()
 
-    total_paginas = (total_registros + por_pagina - 1) // por_pagina if por_pagina > 0 else 0
+    if modo_cursor:
+        resposta = {
+            "por_pagina": por_pagina,
+            "next_cursor": proximo_cursor, # None = última página
+            "origem_dados": "banco_local_com_filtro_sql",
+            "licitacoes": licitacoes_lista
+        }
+        if com_contagem:
+            resposta.update({"total_registros": total_registros, "total_estimado": total_estimado})
+        return resposta
+
+    # Sem withCount, total_registros e total_paginas vêm nulos (use next_cursor para saber se há mais)
+    total_paginas = None
+    if total_registros is not None:
+        total_paginas = (total_registros + por_pagina - 1) // por_pagina if por_pagina > 0 else 0
 
-    return jsonify({
+    return {
         "pagina_atual": pagina,
         "por_pagina": por_pagina,
         "total_registros": total_registros,
+        "total_estimado": total_estimado, # True = soma das contagens agregadas do último sync
         "total_paginas": total_paginas,
+        "next_cursor": proximo_cursor, # Permite continuar no modo cursor a partir desta página
         "origem_dados": "banco_local_com_filtro_sql",
         "licitacoes": licitacoes_lista
-    })    
+    }
 
 @app.route('/api/licitacao/<path:numero_controle_pncp>', methods=['GET'])
 @with_db_cursor
@@ -859,26 +1159,8 @@ def api_get_municipios_ibge(uf_sigla):
 # EXPORTAR CSV - Mantendo separado de def get_licitacoes() sem refatorar posso enviar mais coisas ou menos. 
 @app.route('/api/exportar-csv')
 def exportar_csv():
-    # 1. Coleta todos os filtros da URL em um único dicionário
-    filtros = {
-        'ufs': request.args.getlist('uf'),
-        'modalidadesId': request.args.getlist('modalidadeId', type=int),
-        'statusRadar': request.args.get('statusRadar'),
-        'dataPubInicio': request.args.get('dataPubInicio'),
-        'dataPubFim': request.args.get('dataPubFim'),
-        'valorMin': request.args.get('valorMin', type=float),
-        'valorMax': request.args.get('valorMax', type=float),
-        'municipiosNome': request.args.getlist('municipioNome'),
-        'dataAtualizacaoInicio': request.args.get('dataAtualizacaoInicio'),
-        'dataAtualizacaoFim': request.args.get('dataAtualizacaoFim'),
-        'anoCompra': request.args.get('anoCompra', type=int),
-        'cnpjOrgao': request.args.get('cnpjOrgao'),
-        'statusId': request.args.get('statusId', type=int),
-        'palavrasChave': request.args.getlist('palavraChave'),
-        'excluirPalavras': request.args.getlist('excluirPalavra')
-    }
-    # Limpa filtros que não foram preenchidos
-    filtros = {k: v for k, v in filtros.items() if v is not None and v != '' and v != []}
+    # 1. Coleta todos os filtros da URL em um único dicionário (os mesmos filtros canônicos da busca)
+    filtros = _coletar_filtros_busca()
     
     # Coleta parâmetros de ordenação
     orderBy_param = request.args.get('orderBy', default='dataPublicacaoPncp')
@@ -900,22 +1182,44 @@ def exportar_csv():
         app.logger.warning(f"Export CSV: Tentativa de direção de ordenação inválida '{orderDir_param}'")
         return jsonify({"erro": "Parâmetro de direção de ordenação inválido."}), 400
 
+    # Mesma assinatura e mesmo cache da busca: o CSV de uma busca já exportada sai do Redis
+    chave_cache = _chave_cache_busca("exportar_csv", filtros, order_by=orderBy_param, order_dir=orderDir_param)
+    try:
+        conteudo_csv = _obter_com_cache(
+            chave_cache, lambda: _gerar_csv_licitacoes(filtros, orderBy_param, orderDir_param),
+            pode_gravar=lambda conteudo: len(conteudo) <= TAMANHO_MAXIMO_CACHE_CSV
+        )
+    except BancoIndisponivel:
+        return jsonify({"erro": "Falha na conexão com o banco de dados."}), 503
+    except mysql.connector.Error as e:
+        app.logger.error(f"Erro ao buscar dados para exportar CSV: {e}")
+        return jsonify({"erro": "Erro ao buscar dados para exportação"}), 500
+
+    # 5. Prepara a resposta HTTP para o download do arquivo
+    return Response(
+        conteudo_csv,
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment;filename=radar_pncp_licitacoes.csv"}
+    )
+
+
+def _gerar_csv_licitacoes(filtros, orderBy_param, orderDir_param):
+    """CSV (bytes) da exportação, sem o request: também roda no recálculo em segundo plano do cache."""
     # 2. Usa a função central para construir a cláusula WHERE e os parâmetros
-    query_where_sql, parametros_db_sql = _build_licitacoes_query(filtros)
+    query_where_sql, parametros_db_sql = _build_licitacoes_query(dict(filtros))
     
     # 3. Monta a query final de seleção (sem paginação para exportar tudo)
     query_select_dados = f"SELECT * FROM licitacoes {query_where_sql} ORDER BY {orderBy_param} {orderDir_param}"
     
     conn = get_db_connection()
+    if not conn:
+        raise BancoIndisponivel()
     licitacoes_filtradas = []
     try:
         cursor = conn.cursor(dictionary=True)
         cursor.execute(query_select_dados, parametros_db_sql)
         # O resultado do banco já está completamente filtrado
         licitacoes_filtradas = cursor.fetchall()
-    except mysql.connector.Error as e:
-        app.logger.error(f"Erro ao buscar dados para exportar CSV: {e}")
-        return jsonify({"erro": "Erro ao buscar dados para exportação"}), 500
     finally:
         if conn and conn.is_connected():
             if 'cursor' in locals():
@@ -949,13 +1253,7 @@ def exportar_csv():
             lic.get('link_portal_pncp', '')
         ])
 
-    # 5. Prepara a resposta HTTP para o download do arquivo
-    output.seek(0)
-    return Response(
-        output.getvalue().encode('utf-8-sig'), # utf-8-sig para compatibilidade com Excel
-        mimetype="text/csv",
-        headers={"Content-Disposition": "attachment;filename=radar_pncp_licitacoes.csv"}
-    )
+    return output.getvalue().encode('utf-8-sig') # utf-8-sig para compatibilidade com Excel
 
 # ===============================================================
 # =================== Rotas para posts do blog ==================
@@ -0,0 +1,154 @@
+-- atualizar_db_sync.sql
+-- Migrações do sync (sync_api.py) para bancos JÁ existentes. Pode ser executado mais de uma vez.
+-- (Bancos novos criados com create_mariadb.sql já nascem com essas colunas/índices.)
+
+-- =======================================================
+-- 1. Itens sincronizados por diferença (hash do conteúdo)
+-- =======================================================
+
+-- Remove itens duplicados (mesma licitação + mesmo numeroItem), mantendo o mais recente,
+-- para que a chave única abaixo possa ser criada.
+DELETE i1 FROM `itens_licitacao` i1
+JOIN `itens_licitacao` i2
+  ON i1.`licitacao_id` = i2.`licitacao_id`
+ AND i1.`numeroItem` = i2.`numeroItem`
+ AND i1.`id` < i2.`id`;
+
+ALTER TABLE `itens_licitacao`
+    ADD COLUMN IF NOT EXISTS `hashConteudo` CHAR(64) NULL; -- NULL = item antigo, será regravado uma vez no próximo sync
+
+ALTER TABLE `itens_licitacao`
+    ADD UNIQUE KEY IF NOT EXISTS `uk_item_licitacao` (`licitacao_id`, `numeroItem`);
+
+-- =======================================================
+-- 2. Arquivos sincronizados por diferença (sequencialDocumento)
+-- =======================================================
+
+ALTER TABLE `arquivos_licitacao`
+    ADD COLUMN IF NOT EXISTS `sequencialDocumento` INT NULL AFTER `licitacao_id`;
+
+-- Preenche a partir do link de download (.../arquivos/{sequencialDocumento})
+UPDATE `arquivos_licitacao`
+SET `sequencialDocumento` = CAST(SUBSTRING_INDEX(`link_download`, '/', -1) AS UNSIGNED)
+WHERE `sequencialDocumento` IS NULL AND `link_download` IS NOT NULL;
+
+ALTER TABLE `arquivos_licitacao`
+    ADD UNIQUE KEY IF NOT EXISTS `uk_arquivo_licitacao` (`licitacao_id`, `sequencialDocumento`);
+
+-- Assinatura documental do cabeçalho (NULL = arquivos são buscados de novo na próxima atualização da licitação)
+ALTER TABLE `licitacoes`
+    ADD COLUMN IF NOT EXISTS `assinaturaDocumental` CHAR(64) NULL;
+
+-- =======================================================
+-- 3. Estado da sincronização (marca d'água + checkpoint por modalidade)
+-- =======================================================
+
+CREATE TABLE IF NOT EXISTS `sync_estado` (
+    `modalidade_id` INT PRIMARY KEY,
+    `marca_dagua` DATETIME NULL,               -- Fim da janela da última execução COMPLETA da modalidade
+    `janela_inicio` DATETIME NULL,             -- Janela da execução em andamento (reaproveitada na retomada)
+    `janela_fim` DATETIME NULL,
+    `ultima_pagina_commitada` INT NOT NULL DEFAULT 0, -- Checkpoint: a retomada começa na página seguinte
+    `em_andamento` BOOLEAN NOT NULL DEFAULT FALSE,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- =======================================================
+-- 4. Fatias do backfill histórico (sync_api.py backfill)
+-- =======================================================
+
+CREATE TABLE IF NOT EXISTS `sync_backfill_shards` (
+    `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `modalidade_id` INT NOT NULL,
+    `data_inicio` DATE NOT NULL,
+    `data_fim` DATE NOT NULL,
+    `status` ENUM('pendente', 'em_andamento', 'concluido', 'falha') NOT NULL DEFAULT 'pendente',
+    `ultima_pagina` INT NOT NULL DEFAULT 0,   -- Checkpoint: a retomada começa na página seguinte
+    `licitacoes` INT NOT NULL DEFAULT 0,
+    `tentativas` INT NOT NULL DEFAULT 0,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY `uk_backfill_shard` (`modalidade_id`, `data_inicio`, `data_fim`),
+    INDEX `idx_backfill_status` (`status`, `data_inicio`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- =======================================================
+-- 5. Fila de reprocessamento (DLQ) no banco
+-- =======================================================
+-- Requer MariaDB 10.6+ (SELECT ... FOR UPDATE SKIP LOCKED no reprocessar_pag_fail.py).
+-- O conteúdo antigo de failed_pages.jsonl é importado automaticamente na próxima execução do reprocessador.
+
+CREATE TABLE IF NOT EXISTS `sync_falhas` (
+    `id` BIGINT AUTO_INCREMENT PRIMARY KEY,
+    `tipo` ENUM('pagina', 'licitacao') NOT NULL,
+    `chave` VARCHAR(255) NOT NULL,          -- 'modalidade:pagina:data_inicio:data_fim' ou numeroControlePNCP
+    `modalidade_id` INT NULL,
+    `pagina` INT NULL,
+    `data_inicio` CHAR(8) NULL,             -- AAAAMMDD, como enviado para a API
+    `data_fim` CHAR(8) NULL,
+    `dado` LONGTEXT NULL,                   -- JSON bruto da licitação (tipo 'licitacao')
+    `motivo` TEXT,
+    `tentativas` INT NOT NULL DEFAULT 0,
+    `proxima_tentativa` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    `status` ENUM('pendente', 'morta') NOT NULL DEFAULT 'pendente',
+    `criado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY `uk_falha` (`tipo`, `chave`),
+    INDEX `idx_falha_fila` (`status`, `proxima_tentativa`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- =======================================================
+-- 6. Leases de coordenação (substituem o sync_api.lock)
+-- =======================================================
+-- Cada script reserva só o recurso que usa, com validade renovada por heartbeat: jobs que não conflitam rodam
+-- juntos (inclusive em máquinas diferentes) e um dono que morreu perde o lease quando ele vence.
+
+CREATE TABLE IF NOT EXISTS `sync_leases` (
+    `recurso` VARCHAR(191) PRIMARY KEY,       -- 'sync:modalidade:6', 'backfill:fatia:42', 'dlq', 'status'
+    `dono` VARCHAR(255) NOT NULL,             -- host:pid:aleatório do processo que detém o lease
+    `token` BIGINT NOT NULL DEFAULT 1,        -- Aumenta a cada novo dono (identifica a "geração" do lease)
+    `expira_em` DATETIME(3) NOT NULL,         -- Renovado pelo heartbeat; vencido = qualquer nó pode assumir
+    `adquirido_em` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    `renovado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- =======================================================
+-- 7. Detecção de mudança por grupo de colunas
+-- =======================================================
+-- NULL = linha antiga: na próxima atualização da licitação ela é regravada inteira uma vez e passa a ter os hashes.
+
+ALTER TABLE `licitacoes`
+    ADD COLUMN IF NOT EXISTS `hashTexto` CHAR(64) NULL AFTER `assinaturaDocumental`,
+    ADD COLUMN IF NOT EXISTS `hashDados` CHAR(64) NULL AFTER `hashTexto`;
+
+-- =======================================================
+-- 8. Contagens agregadas para a busca
+-- =======================================================
+-- O sync recalcula a tabela no fim de cada execução; a /api/licitacoes soma as linhas dela para filtros só de
+-- status/UF/modalidade (ou sem filtro) em vez de rodar COUNT(*) na tabela principal.
+
+CREATE TABLE IF NOT EXISTS `licitacoes_agregados` (
+    `situacaoReal` VARCHAR(100),
+    `unidadeOrgaoUfSigla` VARCHAR(2),
+    `modalidadeId` INT,
+    `total` INT NOT NULL,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX `idx_agregados_filtros` (`situacaoReal`, `unidadeOrgaoUfSigla`, `modalidadeId`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- =======================================================
+-- 9. Enriquecimento pendente (fila de itens/arquivos)
+-- =======================================================
+-- Gravada no mesmo commit do cabeçalho quando itens/arquivos vão para a fila (SYNC_ENRIQUECIMENTO_FILA=1) e limpa por
+-- quem os grava. Enquanto houver marca, o sync volta a pedir os itens (bit 1) e/ou arquivos (bit 2) da licitação.
+
+ALTER TABLE `licitacoes`
+    ADD COLUMN IF NOT EXISTS `enriquecimentoPendente` TINYINT UNSIGNED NOT NULL DEFAULT 0 AFTER `hashDados`;
+
+-- =======================================================
+-- 10. Hash das listas de itens/arquivos gravadas
+-- =======================================================
+-- Gravados na mesma transação dos itens/arquivos. NULL = desconhecido: a próxima busca regrava (por diferença) uma vez.
+
+ALTER TABLE `licitacoes`
+    ADD COLUMN IF NOT EXISTS `hashItens` CHAR(64) NULL AFTER `hashDados`,
+    ADD COLUMN IF NOT EXISTS `hashArquivos` CHAR(64) NULL AFTER `hashItens`;
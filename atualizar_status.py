@@ -1,14 +1,13 @@
 # atualizar_status.py
 import os
 import sys
-import fcntl
 import mysql.connector
 
 # --- REUTILIZAÇÃO DA LÓGICA EXISTENTE ---
-from sync_api import get_db_connection, logger
+from sync_api import get_db_connection, get_coordenador_leases, publicar_alteracoes_dados, logger
 
 # --- CONFIGURAÇÕES ---
-LOCK_FILE = "sync_api.lock"  # OBRIGATÓRIO: usar o mesmo lock dos outros scripts
+RECURSO_LEASE = "status"  # Lease próprio (tabela sync_leases): o UPDATE é idempotente e pode rodar junto com o sync
 
 def atualizar_status_baseado_no_tempo():
     """
@@ -52,6 +51,8 @@ def atualizar_status_baseado_no_tempo():
 
         if updated_count > 0:
             logger.info(f"UPDATE_STATUS: SUCESSO. {updated_count} licitações tiveram seu status atualizado para 'Em Julgamento/Propostas Encerradas'.")
+            # situacaoReal mudou: recalcula as contagens por status e invalida o cache da API (nova geração dos dados)
+            publicar_alteracoes_dados(updated_count)
         else:
             logger.info("UPDATE_STATUS: Nenhuma licitação para atualizar. Os status estão consistentes com as datas.")
 
@@ -68,15 +69,12 @@ def atualizar_status_baseado_no_tempo():
             conn.close()
 
 if __name__ == '__main__':
-    # --- MECANISMO DE LOCK (IDÊNTICO AOS OUTROS SCRIPTS) ---
-    # Garante que este script não execute ao mesmo tempo que o sync ou o reprocessamento.
-    try:
-        lock_handle = open(LOCK_FILE, "w")
-        fcntl.lockf(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        logger.info("UPDATE_STATUS: Lock adquirido. Iniciando atualização de status.")
-    except IOError:
-        logger.warning("UPDATE_STATUS: Outro script de sincronização já está em execução. Saindo.")
+    # --- LEASE (só entre instâncias deste script, em qualquer máquina) ---
+    # O sync e o reprocessamento não conflitam com este UPDATE: cada script reserva só o próprio recurso.
+    if not get_coordenador_leases().adquirir(RECURSO_LEASE):
+        logger.warning(f"UPDATE_STATUS: Outra instância está com o lease '{RECURSO_LEASE}'. Saindo.")
         sys.exit(0)
+    logger.info("UPDATE_STATUS: Lease adquirido. Iniciando atualização de status.")
     
     atualizar_status_baseado_no_tempo()
     logger.info("UPDATE_STATUS: Script de atualização de status finalizado.")
\ No newline at end of file
@@ -0,0 +1,214 @@
+# arquivo benchmark_sync.py
+# Teste de carga de ponta a ponta do sync_api.py: sobe o mock_pncp_api.py, cria um banco MariaDB descartável
+# (create_mariadb.sql) e roda o sync contra os dois, medindo licitações/s, chamadas à API por licitação,
+# comandos SQL por licitação e pico de memória (RSS) do processo do sync.
+# Rodada 1 = carga completa no banco vazio; rodadas seguintes = incrementais depois de /__mutar no mock.
+# Usa MARIADB_HOST/USER/PASSWORD do .env; o banco de teste é apagado e recriado a cada execução.
+# Uso: python benchmark_sync.py --workers 4 --licitacoes-por-modalidade 300 --latencia-ms 80 --taxa-429 0.01
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+import mysql.connector
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BANCO_BENCHMARK_PADRAO = 'radar_pncp_benchmark'
+# DB separado do Redis: cada rodada incrementa a geração dos dados, e no Redis de produção isso invalidaria o cache da API
+REDIS_BENCHMARK_PADRAO = 'redis://localhost:6379/15'
+TIMEOUT_SUBIDA_MOCK = 30 # segundos esperando o mock responder
+# Contadores do MariaDB somados por rodada (diferença antes/depois). 'Questions' = comandos enviados pelos clientes.
+CONTADORES_SQL = ('Questions', 'Com_select', 'Com_insert', 'Com_update', 'Com_delete', 'Com_commit', 'Com_rollback')
+
+
+def _porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _get_json(url):
+    with urllib.request.urlopen(url, timeout=10) as resposta:
+        return json.loads(resposta.read().decode('utf-8'))
+
+
+def subir_mock(args, porta):
+    comando = [sys.executable, os.path.join(BASE_DIR, 'mock_pncp_api.py'), '--porta', str(porta),
+               '--licitacoes-por-modalidade', str(args.licitacoes_por_modalidade),
+               '--itens', str(args.itens), '--arquivos', str(args.arquivos),
+               '--latencia-ms', str(args.latencia_ms), '--jitter-ms', str(args.jitter_ms),
+               '--taxa-erro', str(args.taxa_erro), '--taxa-429', str(args.taxa_429), '--semente', str(args.semente)]
+    if args.gravado:
+        comando += ['--gravado', args.gravado]
+    processo = subprocess.Popen(comando)
+    limite = time.time() + TIMEOUT_SUBIDA_MOCK
+    while time.time() < limite:
+        try:
+            _get_json(f"http://127.0.0.1:{porta}/__estatisticas")
+            return processo
+        except OSError:
+            if processo.poll() is not None:
+                break
+            time.sleep(0.2)
+    processo.kill()
+    raise RuntimeError("O mock do PNCP não subiu a tempo.")
+
+
+def _conectar(banco=None):
+    return mysql.connector.connect(
+        host=os.getenv('MARIADB_HOST'), user=os.getenv('MARIADB_USER'),
+        password=os.getenv('MARIADB_PASSWORD'), database=banco, autocommit=True
+    )
+
+
+def recriar_banco(banco):
+    """Apaga e recria o banco descartável com o create_mariadb.sql."""
+    with open(os.path.join(BASE_DIR, 'create_mariadb.sql'), 'r', encoding='utf-8') as f:
+        script = re.sub(r'--[^\n]*', '', f.read())
+    conn = _conectar()
+    cursor = conn.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS `{banco}`")
+    cursor.execute(f"CREATE DATABASE `{banco}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+    cursor.execute(f"USE `{banco}`")
+    for comando in script.split(';'):
+        if comando.strip():
+            cursor.execute(comando)
+    cursor.close()
+    conn.close()
+
+
+def ler_contadores_sql(conn):
+    cursor = conn.cursor()
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN (" + ", ".join(["%s"] * len(CONTADORES_SQL)) + ")", CONTADORES_SQL)
+    contadores = {nome: int(valor) for nome, valor in cursor.fetchall()}
+    cursor.close()
+    return contadores
+
+
+def contar_licitacoes_no_banco(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT (SELECT COUNT(*) FROM licitacoes), (SELECT COUNT(*) FROM itens_licitacao), (SELECT COUNT(*) FROM arquivos_licitacao)")
+    licitacoes, itens, arquivos = cursor.fetchone()
+    cursor.close()
+    return {'licitacoes': licitacoes, 'itens': itens, 'arquivos': arquivos}
+
+
+def rodar_sync(args, ambiente, diretorio_trabalho):
+    """Roda o sync como subprocesso e devolve (código de saída, segundos, pico de RSS em MB)."""
+    comando = [sys.executable, os.path.join(BASE_DIR, 'sync_api.py'), '--workers', str(args.workers)]
+    saida = None if args.verboso else subprocess.DEVNULL
+    inicio = time.perf_counter()
+    processo = subprocess.Popen(comando, env=ambiente, cwd=diretorio_trabalho, stdout=saida, stderr=saida)
+    _, status, uso = os.wait4(processo.pid, 0) # rusage do filho: ru_maxrss em KB no Linux
+    processo.returncode = os.waitstatus_to_exitcode(status)
+    return processo.returncode, time.perf_counter() - inicio, uso.ru_maxrss / 1024
+
+
+def executar_benchmark(args):
+    if args.banco == os.getenv('MARIADB_DATABASE'):
+        raise SystemExit(f"BENCHMARK: O banco de teste '{args.banco}' é o mesmo do .env (MARIADB_DATABASE). Use outro nome com --banco.")
+    if args.redis_url == os.getenv('REDIS_URL'):
+        raise SystemExit(f"BENCHMARK: O Redis de teste '{args.redis_url}' é o mesmo do .env (REDIS_URL). Use outro DB com --redis-url.")
+
+    porta = _porta_livre()
+    url_mock = f"http://127.0.0.1:{porta}"
+    mock = subir_mock(args, porta)
+    resultados = []
+    try:
+        recriar_banco(args.banco)
+        conn = _conectar(args.banco)
+        with tempfile.TemporaryDirectory(prefix='benchmark_sync_') as diretorio_trabalho:
+            ambiente = dict(
+                os.environ,
+                MARIADB_DATABASE=args.banco,
+                PNCP_URL_CONSULTA=f"{url_mock}/api/consulta",
+                PNCP_URL_PNCP_API=f"{url_mock}/pncp-api",
+                PNCP_CACHE_CAMINHO=os.path.join(diretorio_trabalho, 'cache_pncp.sqlite3'),
+                PNCP_CACHE_SUBRECURSOS='1' if args.cache else '0',
+                PNCP_ARQUIVO_BRUTO='0',
+                SYNC_LOG_ARQUIVO=os.path.join(diretorio_trabalho, 'sync_api.log'),
+                # Métricas da execução ficam no diretório temporário: nada de sobrescrever o textfile/relatórios de produção
+                SYNC_RELATORIOS_DIR=os.path.join(diretorio_trabalho, 'relatorios_sync'),
+                SYNC_METRICAS_PROMETHEUS='',
+                # Geração dos dados (publicar_alteracoes_dados) longe do Redis da API; itens/arquivos buscados pelo próprio sync
+                REDIS_URL=args.redis_url,
+                SYNC_ENRIQUECIMENTO_FILA='0',
+            )
+            if args.taxa_maxima:
+                ambiente.update(PNCP_TAXA_INICIAL=str(args.taxa_maxima), PNCP_TAXA_MAXIMA=str(args.taxa_maxima))
+
+            for rodada in range(1, args.rodadas + 1):
+                mutadas = None
+                if rodada > 1:
+                    mutadas = _get_json(f"{url_mock}/__mutar?fracao={args.fracao_mudanca}")['mutadas']
+                _get_json(f"{url_mock}/__zerar")
+                antes = ler_contadores_sql(conn)
+                codigo, segundos, rss_mb = rodar_sync(args, ambiente, diretorio_trabalho)
+                depois = ler_contadores_sql(conn)
+                api = _get_json(f"{url_mock}/__estatisticas")
+                sql = {nome: depois[nome] - antes[nome] for nome in CONTADORES_SQL}
+                licitacoes = api['licitacoes_servidas'] or 1
+                resultados.append({
+                    'rodada': rodada, 'tipo': 'completa' if rodada == 1 else 'incremental', 'mutadas': mutadas,
+                    'codigo_saida': codigo, 'segundos': round(segundos, 2), 'licitacoes': api['licitacoes_servidas'],
+                    'licitacoes_por_segundo': round(api['licitacoes_servidas'] / segundos, 2),
+                    'chamadas_api': api['total'], 'chamadas_api_por_licitacao': round(api['total'] / licitacoes, 3),
+                    'comandos_sql': sql['Questions'], 'comandos_sql_por_licitacao': round(sql['Questions'] / licitacoes, 3),
+                    'pico_rss_mb': round(rss_mb, 1), 'api': api, 'sql': sql, 'banco': contar_licitacoes_no_banco(conn),
+                })
+                if codigo != 0:
+                    print(f"BENCHMARK: O sync terminou com código {codigo} na rodada {rodada} (log em {ambiente['SYNC_LOG_ARQUIVO']}).", file=sys.stderr)
+                    break
+        conn.close()
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+    return resultados
+
+
+def imprimir_relatorio(args, resultados):
+    print(f"\n=== Benchmark do sync: {args.workers} worker(s), {args.licitacoes_por_modalidade} licitações/modalidade, "
+          f"latência {args.latencia_ms:.0f}±{args.jitter_ms:.0f} ms, 5xx {args.taxa_erro:.1%}, 429 {args.taxa_429:.1%} ===")
+    print(f"{'rodada':<16}{'licitações':>11}{'segundos':>10}{'lic/s':>9}{'API/lic':>9}{'SQL/lic':>9}{'RSS (MB)':>10}{'304':>7}{'429':>6}")
+    for r in resultados:
+        print(f"{r['rodada']}-{r['tipo']:<14}{r['licitacoes']:>11}{r['segundos']:>10}{r['licitacoes_por_segundo']:>9}"
+              f"{r['chamadas_api_por_licitacao']:>9}{r['comandos_sql_por_licitacao']:>9}{r['pico_rss_mb']:>10}"
+              f"{r['api']['respostas_304']:>7}{r['api']['respostas_429']:>6}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark de ponta a ponta do sync_api.py contra o mock local do PNCP.")
+    parser.add_argument('--workers', type=int, default=1, help="Repassado ao sync_api.py (1 = pipeline sequencial).")
+    parser.add_argument('--rodadas', type=int, default=2, help="1 carga completa + N-1 incrementais.")
+    parser.add_argument('--fracao-mudanca', type=float, default=0.1, help="Fração das licitações alteradas antes de cada rodada incremental.")
+    parser.add_argument('--banco', default=BANCO_BENCHMARK_PADRAO, help="Banco descartável (apagado e recriado).")
+    parser.add_argument('--redis-url', default=REDIS_BENCHMARK_PADRAO, help="Redis do sync na benchmark (geração dos dados). Não pode ser o do .env.")
+    parser.add_argument('--taxa-maxima', type=float, help="Fixa o limitador do sync nesta taxa (req/s). Padrão: a do .env.")
+    parser.add_argument('--sem-cache', dest='cache', action='store_false', help="Desliga o cache de itens/arquivos do sync.")
+    parser.add_argument('--json', help="Grava os resultados completos neste arquivo.")
+    parser.add_argument('--verboso', action='store_true', help="Mostra a saída do sync.")
+    # Repassados ao mock
+    parser.add_argument('--licitacoes-por-modalidade', type=int, default=200)
+    parser.add_argument('--itens', type=int, default=8)
+    parser.add_argument('--arquivos', type=int, default=2)
+    parser.add_argument('--gravado', help="Serve o arquivo bruto gravado pelo sync em vez de dados gerados.")
+    parser.add_argument('--latencia-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--taxa-erro', type=float, default=0.0)
+    parser.add_argument('--taxa-429', type=float, default=0.0)
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args()
+
+    resultados = executar_benchmark(args)
+    imprimir_relatorio(args, resultados)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(resultados, f, ensure_ascii=False, indent=2)
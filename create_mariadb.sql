@@ -5,6 +5,11 @@
 DROP TABLE IF EXISTS `arquivos_licitacao`;
 DROP TABLE IF EXISTS `itens_licitacao`;
 DROP TABLE IF EXISTS `licitacoes`;
+DROP TABLE IF EXISTS `sync_estado`;
+DROP TABLE IF EXISTS `sync_backfill_shards`;
+DROP TABLE IF EXISTS `sync_falhas`;
+DROP TABLE IF EXISTS `sync_leases`;
+DROP TABLE IF EXISTS `licitacoes_agregados`;
 
 -- Tabela Principal: licitacoes
 CREATE TABLE `licitacoes` (
@@ -50,9 +55,15 @@ CREATE TABLE `licitacoes` (
     `link_portal_pncp` TEXT,
     `justificativaPresencial` TEXT,
     `situacaoReal` VARCHAR(100),
+    `assinaturaDocumental` CHAR(64), -- Hash dos campos do cabeçalho ligados aos documentos (o sync pula a busca de arquivos se não mudou)
+    `hashTexto` CHAR(64), -- Hash das colunas do idx_fts_busca: sem mudança, o sync não as regrava (nem reindexa o FULLTEXT)
+    `hashDados` CHAR(64), -- Hash das demais colunas do cabeçalho (exceto dataAtualizacao, assinaturaDocumental e situacaoReal)
+    `hashItens` CHAR(64), -- Hash da lista de itens da API gravada por último (igual = o sync não regrava os itens)
+    `hashArquivos` CHAR(64), -- Idem para a lista de arquivos
+    `enriquecimentoPendente` TINYINT UNSIGNED NOT NULL DEFAULT 0, -- Bits 1 = itens, 2 = arquivos ainda na fila de enriquecimento (o sync pede de novo enquanto houver)
     INDEX `idx_data_atualizacao` (`dataAtualizacao`),
     INDEX `idx_uf_sigla` (`unidadeOrgaoUfSigla`),
-    INDEX `idx_modalidade_id` (`modalidadeId`)
+    INDEX `idx_modalidade_id` (`modalidadeId`),
     FULLTEXT KEY `idx_fts_busca` (`objetoCompra`, `orgaoEntidadeRazaoSocial`, `unidadeOrgaoNome`, `numeroControlePNCP`, `unidadeOrgaoMunicipioNome`, `unidadeOrgaoUfNome`, `orgaoEntidadeCnpj`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
@@ -78,19 +89,89 @@ CREATE TABLE `itens_licitacao` (
     `dataAtualizacao` DATETIME,
     `temResultado` BOOLEAN,
     `informacaoComplementar` TEXT,
-    FOREIGN KEY (`licitacao_id`) REFERENCES `licitacoes`(`id`) ON DELETE CASCADE
+    `hashConteudo` CHAR(64), -- SHA-256 do conteúdo do item (o sync só regrava itens cujo hash mudou)
+    FOREIGN KEY (`licitacao_id`) REFERENCES `licitacoes`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `uk_item_licitacao` (`licitacao_id`, `numeroItem`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 -- Tabela de Arquivos
 CREATE TABLE `arquivos_licitacao` (
     `id` INT AUTO_INCREMENT PRIMARY KEY,
     `licitacao_id` INT NOT NULL,
+    `sequencialDocumento` INT, -- Identificador do documento na API (o sync aplica só a diferença por este campo)
     `titulo` VARCHAR(255),
     `link_download` VARCHAR(512) UNIQUE,
     `dataPublicacaoPncp` DATETIME,
     `anoCompra` INT,
     `statusAtivo` BOOLEAN,
-    FOREIGN KEY (`licitacao_id`) REFERENCES `licitacoes`(`id`) ON DELETE CASCADE
+    FOREIGN KEY (`licitacao_id`) REFERENCES `licitacoes`(`id`) ON DELETE CASCADE,
+    UNIQUE KEY `uk_arquivo_licitacao` (`licitacao_id`, `sequencialDocumento`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Estado da sincronização por modalidade (marca d'água + checkpoint de página, usado pelo sync_api.py)
+CREATE TABLE `sync_estado` (
+    `modalidade_id` INT PRIMARY KEY,
+    `marca_dagua` DATETIME NULL,               -- Fim da janela da última execução COMPLETA da modalidade
+    `janela_inicio` DATETIME NULL,             -- Janela da execução em andamento (reaproveitada na retomada)
+    `janela_fim` DATETIME NULL,
+    `ultima_pagina_commitada` INT NOT NULL DEFAULT 0, -- Checkpoint: a retomada começa na página seguinte
+    `em_andamento` BOOLEAN NOT NULL DEFAULT FALSE,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Fatias do backfill histórico (python sync_api.py backfill --from ... --to ...)
+CREATE TABLE `sync_backfill_shards` (
+    `id` INT AUTO_INCREMENT PRIMARY KEY,
+    `modalidade_id` INT NOT NULL,
+    `data_inicio` DATE NOT NULL,
+    `data_fim` DATE NOT NULL,
+    `status` ENUM('pendente', 'em_andamento', 'concluido', 'falha') NOT NULL DEFAULT 'pendente',
+    `ultima_pagina` INT NOT NULL DEFAULT 0,   -- Checkpoint: a retomada começa na página seguinte
+    `licitacoes` INT NOT NULL DEFAULT 0,
+    `tentativas` INT NOT NULL DEFAULT 0,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY `uk_backfill_shard` (`modalidade_id`, `data_inicio`, `data_fim`),
+    INDEX `idx_backfill_status` (`status`, `data_inicio`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Fila de reprocessamento (DLQ) do sync: páginas e licitações que falharam (consumida por reprocessar_pag_fail.py)
+CREATE TABLE `sync_falhas` (
+    `id` BIGINT AUTO_INCREMENT PRIMARY KEY,
+    `tipo` ENUM('pagina', 'licitacao') NOT NULL,
+    `chave` VARCHAR(255) NOT NULL,          -- 'modalidade:pagina:data_inicio:data_fim' ou numeroControlePNCP
+    `modalidade_id` INT NULL,
+    `pagina` INT NULL,
+    `data_inicio` CHAR(8) NULL,             -- AAAAMMDD, como enviado para a API
+    `data_fim` CHAR(8) NULL,
+    `dado` LONGTEXT NULL,                   -- JSON bruto da licitação (tipo 'licitacao')
+    `motivo` TEXT,
+    `tentativas` INT NOT NULL DEFAULT 0,
+    `proxima_tentativa` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    `status` ENUM('pendente', 'morta') NOT NULL DEFAULT 'pendente',
+    `criado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY `uk_falha` (`tipo`, `chave`),
+    INDEX `idx_falha_fila` (`status`, `proxima_tentativa`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Leases de coordenação entre processos/nós (sync por modalidade, fatias do backfill, DLQ, atualização de status)
+CREATE TABLE `sync_leases` (
+    `recurso` VARCHAR(191) PRIMARY KEY,       -- 'sync:modalidade:6', 'backfill:fatia:42', 'dlq', 'status'
+    `dono` VARCHAR(255) NOT NULL,             -- host:pid:aleatório do processo que detém o lease
+    `token` BIGINT NOT NULL DEFAULT 1,        -- Aumenta a cada novo dono (identifica a "geração" do lease)
+    `expira_em` DATETIME(3) NOT NULL,         -- Renovado pelo heartbeat; vencido = qualquer nó pode assumir
+    `adquirido_em` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    `renovado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+
+-- Contagens por situacaoReal/UF/modalidade, recalculadas no fim de cada sync (total estimado da /api/licitacoes sem COUNT(*))
+CREATE TABLE `licitacoes_agregados` (
+    `situacaoReal` VARCHAR(100),
+    `unidadeOrgaoUfSigla` VARCHAR(2),
+    `modalidadeId` INT,
+    `total` INT NOT NULL,
+    `atualizado_em` TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    INDEX `idx_agregados_filtros` (`situacaoReal`, `unidadeOrgaoUfSigla`, `modalidadeId`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
 
 -- =============================================
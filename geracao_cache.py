@@ -0,0 +1,71 @@
+# arquivo geracao_cache.py
+# Geração dos dados: um contador no Redis que quem grava no banco incrementa depois do commit (sync_api.py).
+# A API guarda o número dentro de cada entrada do cache da busca (a chave não muda): uma entrada de geração anterior é
+# tratada como velha e recalculada, e uma escrita invalida todas de uma vez sem apagar chave por chave.
+# A contagem de licitações ainda leva a geração na chave (as antigas só deixam de ser lidas e vencem pelo timeout).
+# Também ficam aqui as travas de recálculo do cache da API (single-flight: só um processo recalcula cada entrada).
+# Redis fora do ar nunca derruba quem chama: as funções devolvem None e o chamador segue sem cache.
+import os
+import uuid
+import threading
+from redis import Redis
+from redis.exceptions import RedisError
+
+REDIS_URL_PADRAO = 'redis://localhost:6379/0' # REDIS_URL é lido na primeira conexão (depois do load_dotenv de quem importa)
+CHAVE_GERACAO_DADOS = 'radar:geracao_dados'
+TIMEOUT_REDIS_GERACAO = 2 # Segundos: a API não pode travar esperando o Redis
+
+_cliente_redis = None
+_lock_cliente = threading.Lock()
+
+# Só apaga a trava se ela ainda for de quem a pegou (se venceu e outro pegou, não mexe)
+SCRIPT_LIBERAR_TRAVA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _get_cliente_redis():
+    global _cliente_redis
+    if _cliente_redis is None:
+        with _lock_cliente:
+            if _cliente_redis is None:
+                _cliente_redis = Redis.from_url(
+                    os.getenv('REDIS_URL', REDIS_URL_PADRAO), socket_timeout=TIMEOUT_REDIS_GERACAO, socket_connect_timeout=TIMEOUT_REDIS_GERACAO
+                )
+    return _cliente_redis
+
+
+def geracao_atual():
+    """Geração atual dos dados (0 se ninguém incrementou ainda) ou None se o Redis não respondeu."""
+    try:
+        valor = _get_cliente_redis().get(CHAVE_GERACAO_DADOS)
+    except RedisError:
+        return None
+    return int(valor) if valor is not None else 0
+
+
+def incrementar_geracao():
+    """Chamar depois do commit de alterações. Devolve a nova geração ou None se o Redis não respondeu."""
+    try:
+        return _get_cliente_redis().incr(CHAVE_GERACAO_DADOS)
+    except RedisError:
+        return None
+
+
+def adquirir_trava(chave, segundos):
+    """SET NX com validade: devolve o token da trava, ou None se outro já a tem (ou o Redis não respondeu)."""
+    token = uuid.uuid4().hex
+    try:
+        return token if _get_cliente_redis().set(chave, token, nx=True, ex=segundos) else None
+    except RedisError:
+        return None
+
+
+def liberar_trava(chave, token):
+    try:
+        _get_cliente_redis().eval(SCRIPT_LIBERAR_TRAVA, 1, chave, token)
+    except RedisError:
+        pass # Vence sozinha pela validade
@@ -4,6 +4,8 @@ import os
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import time
+from geracao_cache import incrementar_geracao # Invalida o cache da API (buscas e contagens) depois da remoção
+from sync_api import SQL_RECALCULAR_AGREGADOS # Mesma consulta do sync: as contagens da busca não podem contar licitações removidas
 
 # Carrega as variáveis de ambiente do arquivo .env
 load_dotenv()
@@ -67,6 +69,27 @@ def cleanup_licitacoes_antigas():
 
         print(f"LIMPEZA: {total_deleted} licitações antigas (e seus itens/arquivos) removidas com sucesso.")
 
+        if total_deleted > 0:
+            # Recalcula as contagens agregadas da busca antes de invalidar o cache da API (senão ele guardaria as antigas)
+            print("LIMPEZA: Recalculando as contagens agregadas (licitacoes_agregados)...")
+            try:
+                cursor.execute("DELETE FROM licitacoes_agregados") # DELETE (não TRUNCATE): a API nunca vê a tabela vazia
+                cursor.execute(SQL_RECALCULAR_AGREGADOS)
+                conn.commit()
+                print(f"LIMPEZA: {cursor.rowcount} grupos de contagem recalculados.")
+            except mysql.connector.Error as err:
+                # As remoções já foram commitadas: só avisa e segue (a API usa o COUNT(*) ou a contagem anterior)
+                print(f"LIMPEZA: AVISO: Não foi possível recalcular licitacoes_agregados ({err}).")
+                try:
+                    conn.rollback()
+                except mysql.connector.Error:
+                    pass
+            geracao = incrementar_geracao()
+            if geracao is None:
+                print("LIMPEZA: AVISO: Redis indisponível, a geração dos dados não foi incrementada (o cache da API só vence pelo timeout).")
+            else:
+                print(f"LIMPEZA: Geração dos dados incrementada para {geracao}.")
+
         if total_deleted > 0:
             print("LIMPEZA: Otimizando as tabelas (OPTIMIZE TABLE)...")
             # Lista de tabelas que foram afetadas pela exclusão em cascata
@@ -0,0 +1,217 @@
+# arquivo metricas_sync.py
+# Instrumentação do sync_api.py: contadores e histogramas de tempo por etapa (HTTP, decodificação do JSON,
+# situacaoReal, enriquecimento, banco), exportados no fim da execução como textfile do Prometheus
+# (node_exporter --collector.textfile.directory) e como relatório JSON da execução.
+# Os contadores que já existiam (limitador, pool HTTP, cache, pipeline) entram como "fontes": são lidos só na exportação.
+# Sem dependências: o formato texto do Prometheus é escrito aqui mesmo (prometheus_client não é necessário).
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+PREFIXO_METRICAS = 'radar_sync'
+# Limites (segundos) dos baldes dos histogramas: de micro-operações (situacaoReal) a páginas lentas da listagem
+BALDES_SEGUNDOS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+DESCRICOES = {
+    'http_requisicao_segundos': "Latência das requisições ao PNCP (sem a espera do limitador).",
+    'http_respostas_total': "Respostas HTTP do PNCP por tipo e status.",
+    'http_falhas_rede_total': "Timeouts e erros de conexão com o PNCP.",
+    'json_decode_segundos': "Tempo de decodificação do JSON das respostas.",
+    'situacao_real_segundos': "Tempo do cálculo da situacaoReal por licitação.",
+    'busca_subrecursos_segundos': "Busca síncrona de todos os itens ou arquivos de uma licitação.",
+    'enriquecimento_pagina_segundos': "Enriquecimento assíncrono (itens + arquivos) de uma página inteira.",
+    'db_segundos': "Tempo das etapas de banco (avaliação de estado, upserts, itens, arquivos, commit).",
+    'estagio_pipeline_segundos': "Tempo de trabalho por página em cada estágio do pipeline.",
+    'comandos_sql_total': "Comandos SQL enviados ao banco na gravação das licitações.",
+    'licitacoes_total': "Licitações tratadas por resultado (nova, atualizada, completada, sem_mudanca, invalida, falha).",
+    'paginas_total': "Páginas da listagem por resultado da gravação.",
+    'licitacoes_classificadas_total': "Licitações da listagem por classe (nova, recente, atualizacao) na via rápida.",
+    'via_rapida_bloqueios_total': "Páginas em que a via rápida desistiu porque o gravador já bloqueava as mesmas linhas.",
+    'latencia_visibilidade_commit_segundos': "Da chegada da página da API ao commit: licitações novas (via rápida) e página completa.",
+    'licitacoes_grupos_regravados_total': "Licitações regravadas por grupo de colunas (linha_inteira, texto, dados, nenhum).",
+    'jobs_enriquecimento_total': "Pedidos à fila de enriquecimento por resultado (enfileirado, absorvido por job pendente, erro).",
+}
+
+
+def _texto_rotulos(rotulos, extra=None):
+    pares = list(rotulos) + ([extra] if extra else [])
+    if not pares:
+        return ''
+    return '{' + ','.join(f'{nome}="{str(valor).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for nome, valor in pares) + '}'
+
+
+def _achatar(dados, prefixo=''):
+    """{'a': {'b': 1}} -> {'a_b': 1}. Só valores numéricos (bool vira 0/1); texto é ignorado."""
+    achatado = {}
+    for chave, valor in (dados or {}).items():
+        nome = f"{prefixo}_{chave}" if prefixo else str(chave)
+        if isinstance(valor, dict):
+            achatado.update(_achatar(valor, nome))
+        elif isinstance(valor, (int, float)):
+            achatado[nome] = float(valor)
+    return achatado
+
+
+class Histograma:
+    """Histograma de baldes fixos (cumulativos na exportação, como no Prometheus). Não é thread-safe sozinho."""
+    def __init__(self, baldes=BALDES_SEGUNDOS):
+        self.baldes = baldes
+        self.contagens = [0] * (len(baldes) + 1) # último = acima do maior balde (+Inf)
+        self.soma = 0.0
+        self.total = 0
+        self.minimo = None
+        self.maximo = None
+
+    def observar(self, valor):
+        indice = len(self.baldes)
+        for i, limite in enumerate(self.baldes):
+            if valor <= limite:
+                indice = i
+                break
+        self.contagens[indice] += 1
+        self.soma += valor
+        self.total += 1
+        self.minimo = valor if self.minimo is None else min(self.minimo, valor)
+        self.maximo = valor if self.maximo is None else max(self.maximo, valor)
+
+    def quantil(self, q):
+        """Estimativa por interpolação linear dentro do balde (a mesma ideia do histogram_quantile)."""
+        if not self.total:
+            return None
+        alvo = q * self.total
+        acumulado = 0
+        for i, contagem in enumerate(self.contagens):
+            if acumulado + contagem >= alvo and contagem:
+                inferior = self.baldes[i - 1] if i > 0 else 0.0
+                superior = self.baldes[i] if i < len(self.baldes) else self.maximo
+                return max(min(inferior + (superior - inferior) * (alvo - acumulado) / contagem, self.maximo), self.minimo)
+            acumulado += contagem
+        return self.maximo
+
+    def resumo(self):
+        if not self.total:
+            return {'contagem': 0}
+        return {
+            'contagem': self.total, 'soma_s': round(self.soma, 4), 'media_s': round(self.soma / self.total, 6),
+            'min_s': round(self.minimo, 6), 'p50_s': round(self.quantil(0.5), 6), 'p95_s': round(self.quantil(0.95), 6),
+            'p99_s': round(self.quantil(0.99), 6), 'max_s': round(self.maximo, 6),
+        }
+
+
+class MetricasSync:
+    """Registro de métricas do processo (thread-safe). Rótulos são passados como kwargs: contar('x', tipo='itens')."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.inicio = time.time()
+        self.contadores = {} # (nome, rótulos) -> valor
+        self.histogramas = {} # (nome, rótulos) -> Histograma
+        self.fontes = {} # nome -> função que devolve um dict (estatísticas já existentes em outras classes)
+
+    def contar(self, nome, valor=1, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            self.contadores[chave] = self.contadores.get(chave, 0) + valor
+
+    def observar(self, nome, segundos, **rotulos):
+        chave = (nome, tuple(sorted(rotulos.items())))
+        with self._lock:
+            histograma = self.histogramas.get(chave)
+            if histograma is None:
+                histograma = self.histogramas[chave] = Histograma()
+            histograma.observar(segundos)
+
+    @contextmanager
+    def medir(self, nome, **rotulos):
+        """with metricas.medir('db_segundos', etapa='commit'): ... (registra o tempo mesmo se der exceção)"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def resumo_histograma(self, nome, **rotulos):
+        """Percentis de UMA série ({'contagem': 0} se ainda não houve medição)."""
+        with self._lock:
+            histograma = self.histogramas.get((nome, tuple(sorted(rotulos.items()))))
+            return histograma.resumo() if histograma else {'contagem': 0}
+
+    def adicionar_fonte(self, nome, funcao):
+        self.fontes[nome] = funcao
+
+    def _ler_fontes(self):
+        valores = {}
+        for nome, funcao in self.fontes.items():
+            try:
+                valores[nome] = funcao() or {}
+            except Exception as e: # Uma fonte quebrada não pode impedir a exportação do resto
+                valores[nome] = {'erro': str(e)}
+        return valores
+
+    def resumo(self):
+        """Resumo da execução: contadores, percentis dos histogramas e as fontes."""
+        with self._lock:
+            contadores = {}
+            for (nome, rotulos), valor in sorted(self.contadores.items()):
+                contadores.setdefault(nome, {})[','.join(f"{k}={v}" for k, v in rotulos) or 'total'] = valor
+            histogramas = {}
+            for (nome, rotulos), histograma in sorted(self.histogramas.items()):
+                histogramas.setdefault(nome, {})[','.join(f"{k}={v}" for k, v in rotulos) or 'total'] = histograma.resumo()
+        return {'contadores': contadores, 'histogramas': histogramas, 'fontes': self._ler_fontes()}
+
+    def texto_prometheus(self, extras=None):
+        """Formato de exposição texto do Prometheus (versão 0.0.4)."""
+        linhas = []
+        with self._lock:
+            por_nome = {}
+            for (nome, rotulos), valor in sorted(self.contadores.items()):
+                por_nome.setdefault(nome, []).append((rotulos, valor))
+            for nome, series in por_nome.items():
+                completo = f"{PREFIXO_METRICAS}_{nome}"
+                linhas += [f"# HELP {completo} {DESCRICOES.get(nome, nome)}", f"# TYPE {completo} counter"]
+                linhas += [f"{completo}{_texto_rotulos(rotulos)} {valor}" for rotulos, valor in series]
+            por_nome = {}
+            for (nome, rotulos), histograma in sorted(self.histogramas.items()):
+                por_nome.setdefault(nome, []).append((rotulos, histograma))
+            for nome, series in por_nome.items():
+                completo = f"{PREFIXO_METRICAS}_{nome}"
+                linhas += [f"# HELP {completo} {DESCRICOES.get(nome, nome)}", f"# TYPE {completo} histogram"]
+                for rotulos, histograma in series:
+                    acumulado = 0
+                    for limite, contagem in zip(list(histograma.baldes) + ['+Inf'], histograma.contagens):
+                        acumulado += contagem
+                        linhas.append(f"{completo}_bucket{_texto_rotulos(rotulos, ('le', limite))} {acumulado}")
+                    linhas.append(f"{completo}_sum{_texto_rotulos(rotulos)} {histograma.soma}")
+                    linhas.append(f"{completo}_count{_texto_rotulos(rotulos)} {histograma.total}")
+        for fonte, dados in self._ler_fontes().items():
+            for chave, valor in sorted(_achatar(dados).items()):
+                linhas += [f"# TYPE {PREFIXO_METRICAS}_{fonte}_{chave} gauge", f"{PREFIXO_METRICAS}_{fonte}_{chave} {valor}"]
+        for chave, valor in sorted(_achatar(extras).items()):
+            linhas += [f"# TYPE {PREFIXO_METRICAS}_{chave} gauge", f"{PREFIXO_METRICAS}_{chave} {valor}"]
+        return '\n'.join(linhas) + '\n'
+
+    def exportar(self, caminho_json=None, caminho_prometheus=None, extras=None):
+        """
+        Grava o relatório JSON e/ou o textfile do Prometheus (escrita atômica: o node_exporter nunca lê arquivo pela metade).
+        'extras' = dados da execução (modo, duração, sucesso...). Retorna o resumo.
+        """
+        extras = dict(extras or {})
+        extras.setdefault('duracao_execucao_segundos', round(time.time() - self.inicio, 3))
+        extras.setdefault('ultima_execucao_timestamp_segundos', int(time.time()))
+        resumo = dict(extras, iniciado_em=datetime.fromtimestamp(self.inicio).isoformat(timespec='seconds'), **self.resumo())
+        if caminho_json:
+            os.makedirs(os.path.dirname(os.path.abspath(caminho_json)), exist_ok=True)
+            with open(caminho_json + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(resumo, f, ensure_ascii=False, indent=2, default=str)
+            os.replace(caminho_json + '.tmp', caminho_json)
+        if caminho_prometheus:
+            os.makedirs(os.path.dirname(os.path.abspath(caminho_prometheus)), exist_ok=True)
+            with open(caminho_prometheus + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(self.texto_prometheus(extras))
+            os.replace(caminho_prometheus + '.tmp', caminho_prometheus)
+        return resumo
+
+
+metricas = MetricasSync() # Registro único do processo
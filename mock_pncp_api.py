@@ -0,0 +1,307 @@
+# arquivo mock_pncp_api.py
+# Servidor local que imita os endpoints do PNCP usados pelo sync_api.py, para medir desempenho sem o PNCP de produção:
+#   GET /api/consulta/v1/contratacoes/atualizacao                       (listagem paginada, 204 no fim)
+#   GET /pncp-api/v1/orgaos/{cnpj}/compras/{ano}/{seq}/itens|arquivos   (listas paginadas, com ETag/304)
+# Dados gerados (determinísticos pela semente) ou gravados pelo arquivo bruto do sync (PNCP_ARQUIVO_BRUTO=1).
+# Endpoints de controle: /__estatisticas (contadores), /__zerar e /__mutar?fracao=0.1 (simula atualizações no PNCP).
+# Só biblioteca padrão. Uso: python mock_pncp_api.py --porta 8765 --latencia-ms 80 --taxa-429 0.02
+import os
+import re
+import sys
+import gzip
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+MODALIDADES_PADRAO = list(range(1, 14))
+ORGAOS_GERADOS = 50
+ANO_GERADO = datetime.now().year
+
+ROTA_LISTAGEM = '/api/consulta/v1/contratacoes/atualizacao'
+ROTA_SUBRECURSO = re.compile(r'^/pncp-api/v1/orgaos/(\d+)/compras/(\d+)/(\d+)/(itens|arquivos)$')
+
+
+class DadosPNCP:
+    """Licitações por modalidade + itens/arquivos por (cnpj, ano, sequencial). 'versao' muda com /__mutar."""
+    def __init__(self):
+        self.licitacoes = {} # modalidade -> [licitação]
+        self.itens = {} # 'cnpj/ano/seq' -> [item]
+        self.arquivos = {} # 'cnpj/ano/seq' -> [arquivo]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def chave(cnpj, ano, sequencial):
+        return f"{cnpj}/{ano}/{sequencial}"
+
+    def gerar(self, modalidades, por_modalidade, itens_medio, arquivos_medio, semente):
+        agora = datetime.now().replace(microsecond=0)
+        for modalidade in modalidades:
+            lista = []
+            for i in range(por_modalidade):
+                rnd = random.Random(f"{semente}:{modalidade}:{i}")
+                cnpj = f"{10000000000000 + (i % ORGAOS_GERADOS) * 7919:014d}"
+                sequencial = modalidade * 100000 + i + 1
+                abertura = agora + timedelta(days=rnd.randint(-20, 30))
+                lic = {
+                    'numeroControlePNCP': f"{cnpj}-1-{sequencial:06d}/{ANO_GERADO}",
+                    'numeroCompra': str(i + 1), 'anoCompra': ANO_GERADO, 'sequencialCompra': sequencial,
+                    'processo': f"{rnd.randint(1000, 9999)}/{ANO_GERADO}",
+                    'tipoInstrumentoConvocatorioCodigo': 1, 'tipoInstrumentoConvocatorioNome': 'Edital',
+                    'modalidadeId': modalidade, 'modalidadeNome': f"Modalidade {modalidade}",
+                    'modoDisputaId': 1, 'modoDisputaNome': 'Aberto',
+                    'situacaoCompraId': 1, 'situacaoCompraNome': 'Divulgada no PNCP',
+                    'objetoCompra': f"Aquisição de material {rnd.choice(['de escritório', 'hospitalar', 'de limpeza', 'de TI'])} - lote {i}",
+                    'informacaoComplementar': None, 'srp': rnd.random() < 0.3,
+                    'amparoLegal': {'codigo': 1, 'nome': 'Lei 14.133/2021, Art. 28, I', 'descricao': 'pregão'},
+                    'valorTotalEstimado': round(rnd.uniform(1000, 500000), 2), 'valorTotalHomologado': None,
+                    'dataAberturaProposta': (abertura - timedelta(days=10)).isoformat(),
+                    'dataEncerramentoProposta': abertura.isoformat(),
+                    'dataPublicacaoPncp': (agora - timedelta(days=1)).isoformat(),
+                    'dataInclusao': (agora - timedelta(days=1)).isoformat(),
+                    'dataAtualizacao': (agora - timedelta(hours=rnd.randint(1, 40))).isoformat(),
+                    'orgaoEntidade': {'cnpj': cnpj, 'razaoSocial': f"Órgão {i % ORGAOS_GERADOS}", 'poderId': 'E', 'esferaId': 'M'},
+                    'unidadeOrgao': {'codigoUnidade': '1', 'nomeUnidade': 'Unidade', 'codigoIbge': '2611606',
+                                     'municipioNome': 'Recife', 'ufSigla': 'PE', 'ufNome': 'Pernambuco'},
+                    'usuarioNome': 'Mock PNCP', 'linkSistemaOrigem': None, 'justificativaPresencial': None,
+                }
+                lista.append(lic)
+                chave = self.chave(cnpj, ANO_GERADO, sequencial)
+                self.itens[chave] = [
+                    {
+                        'numeroItem': n, 'descricao': f"Item {n} da compra {sequencial}", 'materialOuServicoNome': 'Material',
+                        'quantidade': rnd.randint(1, 500), 'unidadeMedida': 'UN', 'valorUnitarioEstimado': round(rnd.uniform(1, 900), 2),
+                        'valorTotal': None, 'orcamentoSigiloso': False, 'itemCategoriaNome': 'Bens móveis',
+                        'categoriaItemCatalogo': None, 'criterioJulgamentoNome': 'Menor preço', 'situacaoCompraItemNome': 'Em andamento',
+                        'tipoBeneficioNome': 'Sem benefício', 'incentivoProdutivoBasico': False, 'dataInclusao': lic['dataInclusao'],
+                        'dataAtualizacao': lic['dataAtualizacao'], 'temResultado': False, 'informacaoComplementar': None,
+                    }
+                    for n in range(1, rnd.randint(1, max(1, 2 * itens_medio - 1)) + 1)
+                ]
+                self.arquivos[chave] = [
+                    {'sequencialDocumento': n, 'titulo': f"Edital {n}.pdf", 'dataPublicacaoPncp': lic['dataPublicacaoPncp'],
+                     'anoCompra': ANO_GERADO, 'statusAtivo': True}
+                    for n in range(1, rnd.randint(0, max(0, 2 * arquivos_medio)) + 1)
+                ]
+            self.licitacoes[modalidade] = lista
+
+    def carregar_gravado(self, diretorio):
+        """Lê os segmentos .jsonl.gz do arquivo bruto do sync (a versão mais recente de cada licitação vence)."""
+        por_id = {}
+        for raiz, _, nomes in sorted(os.walk(diretorio)):
+            for nome in sorted(nomes):
+                if not nome.endswith('.jsonl.gz'):
+                    continue
+                try:
+                    with gzip.open(os.path.join(raiz, nome), 'rt', encoding='utf-8') as f:
+                        for linha in f:
+                            registro = json.loads(linha)
+                            if registro['tipo'] == 'listagem':
+                                for lic in registro['dados']:
+                                    por_id[lic['numeroControlePNCP']] = (registro['parametros']['modalidade'], lic)
+                            elif registro['tipo'] in ('itens', 'arquivos'):
+                                getattr(self, registro['tipo'])[registro['parametros']['chave']] = registro['dados']
+                except (EOFError, OSError, json.JSONDecodeError) as e:
+                    print(f"MOCK_PNCP: Segmento {nome} lido só até o erro: {e}", file=sys.stderr)
+        for modalidade, lic in por_id.values():
+            self.licitacoes.setdefault(modalidade, []).append(lic)
+
+    def mutar(self, fracao, semente):
+        """Atualiza uma fração das licitações: dataAtualizacao nova e o primeiro item com quantidade diferente."""
+        rnd = random.Random(f"{semente}:mutar:{time.time()}")
+        agora = datetime.now().replace(microsecond=0).isoformat()
+        mutadas = 0
+        with self._lock:
+            for lista in self.licitacoes.values():
+                for lic in lista:
+                    if rnd.random() >= fracao:
+                        continue
+                    lic['dataAtualizacao'] = agora
+                    itens = self.itens.get(self.chave(lic['orgaoEntidade']['cnpj'], lic['anoCompra'], lic['sequencialCompra']))
+                    if itens:
+                        itens[0] = dict(itens[0], quantidade=(itens[0].get('quantidade') or 0) + 1, dataAtualizacao=agora)
+                    mutadas += 1
+        return mutadas
+
+    def total(self):
+        return sum(len(lista) for lista in self.licitacoes.values())
+
+
+class EstatisticasMock:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.zerar()
+
+    def zerar(self):
+        with self._lock:
+            self.contadores = {'listagem': 0, 'itens': 0, 'arquivos': 0, 'licitacoes_servidas': 0,
+                               'respostas_304': 0, 'respostas_429': 0, 'respostas_5xx': 0, 'total': 0}
+            self.inicio = time.time()
+
+    def somar(self, **valores):
+        with self._lock:
+            for chave, valor in valores.items():
+                self.contadores[chave] += valor
+
+    def resumo(self):
+        with self._lock:
+            return dict(self.contadores, segundos=round(time.time() - self.inicio, 3))
+
+
+def _paginar(lista, params, tamanho_padrao=500):
+    pagina = max(int(params.get('pagina', ['1'])[0]), 1)
+    tamanho = max(int(params.get('tamanhoPagina', [str(tamanho_padrao)])[0]), 1)
+    return lista[(pagina - 1) * tamanho:pagina * tamanho], pagina, tamanho
+
+
+def _filtrar_janela(lista, params):
+    """
+    Como o PNCP: só as licitações com dataAtualizacao dentro de [dataInicial, dataFinal] (dias AAAAMMDD, inclusivos),
+    ordenadas por essa data. Sem isso as rodadas incrementais do benchmark releriam o conjunto inteiro.
+    """
+    data_inicial = params.get('dataInicial', [None])[0]
+    data_final = params.get('dataFinal', [None])[0]
+    dia = lambda lic: (lic.get('dataAtualizacao') or '')[:10].replace('-', '')
+    filtradas = [
+        lic for lic in lista
+        if (not data_inicial or dia(lic) >= data_inicial) and (not data_final or dia(lic) <= data_final)
+    ]
+    return sorted(filtradas, key=lambda lic: (lic.get('dataAtualizacao') or '', lic['numeroControlePNCP']))
+
+
+class HandlerMockPNCP(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, como o PNCP
+    dados = None
+    estatisticas = None
+    config = None
+
+    def log_message(self, formato, *args):
+        if self.config.verboso:
+            super().log_message(formato, *args)
+
+    def _responder(self, status, corpo=b'', cabecalhos=None):
+        self.send_response(status)
+        for nome, valor in (cabecalhos or {}).items():
+            self.send_header(nome, valor)
+        if corpo:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        if corpo:
+            self.wfile.write(corpo)
+
+    def _responder_json(self, status, objeto, cabecalhos=None):
+        self._responder(status, json.dumps(objeto, ensure_ascii=False).encode('utf-8'), cabecalhos)
+
+    def _falha_injetada(self):
+        """Sorteia 429/5xx conforme a configuração. Retorna True se já respondeu com erro."""
+        sorteio = random.random()
+        if sorteio < self.config.taxa_429:
+            self.estatisticas.somar(respostas_429=1)
+            self._responder_json(429, {'message': 'Too Many Requests'}, {'Retry-After': str(self.config.retry_after)})
+            return True
+        if sorteio < self.config.taxa_429 + self.config.taxa_erro:
+            self.estatisticas.somar(respostas_5xx=1)
+            self._responder_json(503, {'message': 'Service Unavailable'})
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+
+        # --- Controle do benchmark (sem latência nem falhas) ---
+        if url.path == '/__estatisticas':
+            return self._responder_json(200, dict(self.estatisticas.resumo(), licitacoes_no_mock=self.dados.total()))
+        if url.path == '/__zerar':
+            self.estatisticas.zerar()
+            return self._responder_json(200, {'ok': True})
+        if url.path == '/__mutar':
+            mutadas = self.dados.mutar(float(params.get('fracao', ['0.1'])[0]), self.config.semente)
+            return self._responder_json(200, {'mutadas': mutadas})
+
+        self.estatisticas.somar(total=1)
+        latencia = self.config.latencia_ms + random.uniform(0, self.config.jitter_ms)
+        time.sleep(latencia / 1000)
+        if self._falha_injetada():
+            return
+
+        if url.path == ROTA_LISTAGEM:
+            modalidade = int(params.get('codigoModalidadeContratacao', ['0'])[0])
+            with self.dados._lock: # /__mutar altera dataAtualizacao no lugar
+                lista = _filtrar_janela(self.dados.licitacoes.get(modalidade, []), params)
+            pagina_dados, pagina, tamanho = _paginar(lista, params)
+            self.estatisticas.somar(listagem=1, licitacoes_servidas=len(pagina_dados))
+            if not pagina_dados:
+                return self._responder(204)
+            total_paginas = (len(lista) + tamanho - 1) // tamanho
+            return self._responder_json(200, {
+                'data': pagina_dados, 'totalRegistros': len(lista), 'totalPaginas': total_paginas,
+                'numeroPagina': pagina, 'paginasRestantes': total_paginas - pagina, 'empty': False,
+            })
+
+        encontrado = ROTA_SUBRECURSO.match(url.path)
+        if encontrado:
+            cnpj, ano, sequencial, tipo = encontrado.groups()
+            self.estatisticas.somar(**{tipo: 1})
+            lista = getattr(self.dados, tipo).get(DadosPNCP.chave(cnpj, ano, sequencial), [])
+            pagina_dados, _, _ = _paginar(lista, params)
+            corpo = json.dumps(pagina_dados, ensure_ascii=False).encode('utf-8')
+            etag = '"' + hashlib.sha256(corpo).hexdigest()[:32] + '"'
+            if self.config.etag and self.headers.get('If-None-Match') == etag:
+                self.estatisticas.somar(respostas_304=1)
+                return self._responder(304, cabecalhos={'ETag': etag})
+            return self._responder(200, corpo, {'ETag': etag} if self.config.etag else None)
+
+        self._responder_json(404, {'message': f'Rota não implementada no mock: {url.path}'})
+
+
+def criar_servidor(args):
+    dados = DadosPNCP()
+    if args.gravado:
+        dados.carregar_gravado(args.gravado)
+    else:
+        dados.gerar(args.modalidades, args.licitacoes_por_modalidade, args.itens, args.arquivos, args.semente)
+    handler = type('HandlerConfigurado', (HandlerMockPNCP,), {
+        'dados': dados, 'estatisticas': EstatisticasMock(), 'config': args,
+    })
+    servidor = ThreadingHTTPServer((args.host, args.porta), handler)
+    servidor.daemon_threads = True
+    return servidor, dados
+
+
+def montar_parser():
+    parser = argparse.ArgumentParser(description="Mock local da API do PNCP para testes de carga do sync.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--modalidades', type=int, nargs='+', default=MODALIDADES_PADRAO)
+    parser.add_argument('--licitacoes-por-modalidade', type=int, default=200)
+    parser.add_argument('--itens', type=int, default=8, help="Média de itens por licitação.")
+    parser.add_argument('--arquivos', type=int, default=2, help="Média de arquivos por licitação.")
+    parser.add_argument('--gravado', help="Diretório do arquivo bruto do sync (arquivo_pncp) para servir dados reais.")
+    parser.add_argument('--latencia-ms', type=float, default=50)
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--taxa-erro', type=float, default=0.0, help="Fração de respostas 503.")
+    parser.add_argument('--taxa-429', type=float, default=0.0, help="Fração de respostas 429.")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After (s) enviado nos 429.")
+    parser.add_argument('--sem-etag', dest='etag', action='store_false', help="Não envia ETag (desliga os 304).")
+    parser.add_argument('--semente', type=int, default=42)
+    parser.add_argument('--verboso', action='store_true')
+    return parser
+
+
+if __name__ == '__main__':
+    args = montar_parser().parse_args()
+    servidor, dados = criar_servidor(args)
+    print(f"MOCK_PNCP: {dados.total()} licitações em {len(dados.licitacoes)} modalidades servidas em http://{args.host}:{args.porta}", flush=True)
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
@@ -2,145 +2,224 @@
 import os
 import sys
 import json
-import time
-import fcntl
+import threading
+import tenacity
 import mysql.connector
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # --- REUTILIZAÇÃO DA LÓGICA DO SCRIPT PRINCIPAL ---
 from sync_api import (
     get_db_connection,
+    garantir_conexao_ativa,
     fetch_licitacoes_por_atualizacao,
+    salvar_pagina_licitacoes,
     save_licitacao_to_db,
+    reprocessando_falha_dlq,
+    fechar_enriquecimento_async,
+    publicar_alteracoes_dados,
+    logar_estatisticas_conexoes_pncp,
+    logar_estatisticas_cache_subrecursos,
+    get_coordenador_leases,
     logger
 )
 
 # --- CONFIGURAÇÕES ---
+# A fila fica na tabela sync_falhas. Os arquivos abaixo são só importados (legado ou fallback do sync sem banco).
 FAILED_PAGES_FILE = "failed_pages.jsonl"
-FAILED_PAGES_DEAD_FILE = "failed_pages_dead.jsonl"
-LOCK_FILE = "sync_api.lock"  # OBRIGATÓRIO: usar o mesmo lock do script principal
-MAX_REPROCESS_ATTEMPTS = 5   # depois disso consideramos "falha final"
-BASE_BACKOFF_SECONDS = 1     # tempo base do backoff exponencial
-
+RECURSO_LEASE = "dlq"  # Lease próprio (tabela sync_leases): o reprocessamento pode rodar junto com o sync
+MAX_REPROCESS_ATTEMPTS = 8   # depois disso a falha fica com status 'morta'
+BASE_BACKOFF_SECONDS = 30    # backoff exponencial até a próxima tentativa: 30s, 1min, 2min, 4min...
+MAX_BACKOFF_SECONDS = 1800
+REPROCESS_WORKERS = int(os.getenv('REPROCESS_WORKERS', '4'))
+
+# Reivindica UMA falha vencida. SKIP LOCKED: workers (e outras instâncias) pulam as linhas já reivindicadas.
+# O lock da linha vale até o commit, que grava a página E remove a falha na mesma transação.
+SQL_REIVINDICAR_FALHA = (
+    "SELECT id, tipo, chave, modalidade_id, pagina, data_inicio, data_fim, dado, tentativas FROM sync_falhas "
+    "WHERE status = 'pendente' AND proxima_tentativa <= NOW() "
+    "ORDER BY proxima_tentativa LIMIT 1 FOR UPDATE SKIP LOCKED"
+)
+SQL_ADIAR_FALHA = (
+    "UPDATE sync_falhas SET tentativas = tentativas + 1, motivo = %s, status = %s, "
+    "proxima_tentativa = NOW() + INTERVAL %s SECOND WHERE id = %s"
+)
 
-def reprocessar_paginas_com_falha():
-    """Lê o arquivo de páginas com falha, tenta reprocessá-las e atualiza os arquivos."""
 
+def importar_arquivo_falhas_legado(conn):
+    """Move as páginas de failed_pages.jsonl (formato antigo / fallback do sync) para a tabela sync_falhas."""
     if not os.path.exists(FAILED_PAGES_FILE):
-        logger.info("REPROCESS: Arquivo de páginas com falha não encontrado. Nada a fazer.")
-        return
+        return 0
+    # Renomeia antes de ler: se o sync anexar uma linha agora, ela vai para um arquivo novo (importado na próxima vez)
+    arquivo_importacao = FAILED_PAGES_FILE + ".importando"
+    if not os.path.exists(arquivo_importacao):
+        os.replace(FAILED_PAGES_FILE, arquivo_importacao)
+
+    registros = []
+    with open(arquivo_importacao, 'r', encoding='utf-8') as f:
+        for linha in f:
+            if not linha.strip():
+                continue
+            try:
+                page_info = json.loads(linha)
+            except json.JSONDecodeError as e:
+                logger.error(f"REPROCESS: Linha inválida em {arquivo_importacao} ignorada: {e}")
+                continue
+            chave = f"{page_info['modalidade']}:{page_info['pagina']}:{page_info['data_inicio']}:{page_info['data_fim']}"
+            registros.append(('pagina', chave, page_info['modalidade'], page_info['pagina'],
+                              page_info['data_inicio'], page_info['data_fim'], None, page_info.get('motivo', 'Importado de failed_pages.jsonl')))
+
+    if registros:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO sync_falhas (tipo, chave, modalidade_id, pagina, data_inicio, data_fim, dado, motivo) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE motivo = VALUES(motivo)",
+            registros
+        )
+        conn.commit()
+        cursor.close()
+    os.remove(arquivo_importacao)
+    logger.info(f"REPROCESS: {len(registros)} páginas importadas de {FAILED_PAGES_FILE} para sync_falhas.")
+    return len(registros)
+
 
-    # Lê todas as páginas que precisam ser reprocessadas
+def _buscar_pagina(falha):
+    """Busca a página na API. Levanta exceção se a API falhar (inclusive quando o tenacity esgota as tentativas)."""
     try:
-        with open(FAILED_PAGES_FILE, 'r', encoding='utf-8') as f:
-            pages_to_reprocess = [json.loads(line) for line in f if line.strip()]
-    except (IOError, json.JSONDecodeError) as e:
-        logger.error(f"REPROCESS: Erro ao ler ou decodificar {FAILED_PAGES_FILE}: {e}")
-        return
+        licitacoes_data, _ = fetch_licitacoes_por_atualizacao(
+            falha['data_inicio'], falha['data_fim'], falha['modalidade_id'], falha['pagina']
+        )
+    except tenacity.RetryError as e:
+        raise RuntimeError(f"Todas as retentativas falharam: {e.last_attempt.exception()}") from e
+    if licitacoes_data is None:
+        raise RuntimeError("API retornou erro")
+    return licitacoes_data
+
+
+def reprocessar_proxima_falha(conn):
+    """
+    Reivindica e reprocessa UMA falha vencida. Retorna 'sucesso', 'adiada', 'morta' ou None se a fila está vazia.
+    Sucesso: a página (ou licitação) e a remoção da falha são commitadas juntas.
+    Falha: volta ao savepoint (mantendo o lock da linha) e agenda a próxima tentativa com backoff exponencial.
+    """
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(SQL_REIVINDICAR_FALHA)
+    linhas = cursor.fetchall()
+    if not linhas:
+        conn.rollback()
+        cursor.close()
+        return None
+    falha = linhas[0]
+    descricao = (f"Modalidade {falha['modalidade_id']}, Página {falha['pagina']} ({falha['data_inicio']}-{falha['data_fim']})"
+                 if falha['tipo'] == 'pagina' else f"Licitação {falha['chave']}")
+    logger.info(f"--- REPROCESS: Tentando {descricao} (tentativa {falha['tentativas'] + 1}) ---")
+    cursor.execute("SAVEPOINT falha_reivindicada")
 
-    if not pages_to_reprocess:
-        logger.info("REPROCESS: Arquivo de páginas com falha está vazio. Nada a fazer.")
-        os.remove(FAILED_PAGES_FILE)
-        return
+    try:
+        with reprocessando_falha_dlq(falha['tipo'], falha['chave']):
+            if falha['tipo'] == 'pagina':
+                licitacoes_data = _buscar_pagina(falha)
+                logger.info(f"REPROCESS: SUCESSO ao buscar {descricao}. Processando {len(licitacoes_data)} licitações.")
+                salvar_pagina_licitacoes(conn, licitacoes_data)
+            elif save_licitacao_to_db(conn, json.loads(falha['dado'])) is None:
+                raise RuntimeError("A licitação não foi gravada (veja o log acima)")
+        cursor.execute("DELETE FROM sync_falhas WHERE id = %s", (falha['id'],))
+        conn.commit()
+        cursor.close()
+        return 'sucesso'
+    except Exception as e:
+        tentativas = falha['tentativas'] + 1
+        status = 'morta' if tentativas >= MAX_REPROCESS_ATTEMPTS else 'pendente'
+        backoff = min(BASE_BACKOFF_SECONDS * (2 ** (tentativas - 1)), MAX_BACKOFF_SECONDS)
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT falha_reivindicada")
+            cursor.execute(SQL_ADIAR_FALHA, (f"{type(e).__name__}: {e}"[:2000], status, backoff, falha['id']))
+            conn.commit()
+            cursor.close()
+        except mysql.connector.Error as db_err:
+            # Conexão perdida: o lock da linha caiu junto e a falha continua vencida para a próxima execução.
+            logger.error(f"REPROCESS_DB: Não foi possível agendar a nova tentativa de {descricao} ({db_err}). Erro original: {e}")
+            raise
+        if status == 'morta':
+            logger.error(f"REPROCESS: {descricao} atingiu {tentativas} tentativas. Marcada como falha final ('morta'). Erro: {e}")
+        else:
+            logger.warning(f"REPROCESS: {descricao} falhou de novo ({e}). Próxima tentativa em {backoff}s.")
+        return status if status == 'morta' else 'adiada'
 
-    logger.info(f"REPROCESS: Encontradas {len(pages_to_reprocess)} páginas para reprocessar.")
 
+def _worker_reprocessamento(contagens, lock_contagens):
+    """Consome a fila até não haver mais falhas vencidas (cada worker com a sua conexão)."""
+    conn = None
+    try:
+        while True:
+            if not get_coordenador_leases().valida(RECURSO_LEASE):
+                logger.critical("REPROCESS: O lease da fila de falhas venceu (outra instância assumiu). Encerrando o worker.")
+                return
+            conn = garantir_conexao_ativa(conn)
+            if not conn:
+                logger.critical("REPROCESS: Worker sem conexão com o banco. Encerrando o worker.")
+                return
+            try:
+                resultado = reprocessar_proxima_falha(conn)
+            except mysql.connector.Error as e:
+                # Sem conseguir nem agendar a próxima tentativa, o worker para (evita repetir a mesma falha em loop)
+                logger.critical(f"REPROCESS: Erro de banco no worker ({e}). Encerrando o worker.")
+                return
+            if resultado is None:
+                return
+            with lock_contagens:
+                contagens[resultado] += 1
+    finally:
+        fechar_enriquecimento_async(somente_desta_thread=True)
+        if conn:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+
+def reprocessar_paginas_com_falha(max_workers=REPROCESS_WORKERS):
+    """Importa o arquivo legado e reprocessa em paralelo todas as falhas vencidas da tabela sync_falhas."""
     conn = get_db_connection()
     if not conn:
         logger.critical("REPROCESS: Não foi possível conectar ao banco de dados. Abortando.")
         return
-
-    still_failed_pages = []
-    dead_pages = []
-    success_count = 0
-
-    for page_info in pages_to_reprocess:
-        modalidade = page_info['modalidade']
-        pagina = page_info['pagina']
-        data_inicio = page_info['data_inicio']
-        data_fim = page_info['data_fim']
-
-        logger.info(f"--- REPROCESS: Tentando Modalidade {modalidade}, Página {pagina} ---")
-
-        licitacoes_data, _ = fetch_licitacoes_por_atualizacao(
-            data_inicio, data_fim, modalidade, pagina
-        )
-
-        if licitacoes_data is not None:
-            logger.info(f"REPROCESS: SUCESSO ao buscar página {pagina}. "
-                        f"Processando {len(licitacoes_data)} licitações.")
-            for lic_api in licitacoes_data:
-                try:
-                    save_licitacao_to_db(conn, lic_api)
-                    conn.commit()
-                except mysql.connector.Error as db_err:
-                    logger.error(f"REPROCESS_DB: Falha ao salvar licitação "
-                                 f"{lic_api.get('numeroControlePNCP')}: {db_err}. Rollback executado.")
-                    conn.rollback()
-                except Exception as e:
-                    logger.error(f"REPROCESS_UNEXPECTED: Erro inesperado ao salvar licitação "
-                                 f"{lic_api.get('numeroControlePNCP')}: {e}. Rollback executado.")
-                    conn.rollback()
-            success_count += 1
-            time.sleep(1)  # pequena pausa entre sucessos
-        else:
-            # Falha persistente
-            page_info.setdefault('reprocess_attempts', 0)
-            page_info['reprocess_attempts'] += 1
-            page_info['last_attempt_timestamp'] = datetime.now().isoformat()
-
-            if page_info['reprocess_attempts'] >= MAX_REPROCESS_ATTEMPTS:
-                logger.error(f"REPROCESS: Página Modalidade {modalidade}, "
-                             f"Página {pagina} atingiu {page_info['reprocess_attempts']} tentativas. "
-                             f"Movendo para {FAILED_PAGES_DEAD_FILE}.")
-                dead_pages.append(page_info)
-            else:
-                still_failed_pages.append(page_info)
-
-            # backoff exponencial: 1s, 2s, 4s, 8s...
-            backoff_time = BASE_BACKOFF_SECONDS * (2 ** (page_info['reprocess_attempts'] - 1))
-            logger.info(f"REPROCESS: Backoff de {backoff_time}s antes da próxima página.")
-            time.sleep(backoff_time)
-
-    conn.close()
-
-    # --- Atualização do arquivo de falhas com escrita atômica ---
     try:
-        tmp_file = FAILED_PAGES_FILE + ".tmp"
-        with open(tmp_file, 'w', encoding='utf-8') as f:
-            for page_info in still_failed_pages:
-                f.write(json.dumps(page_info, ensure_ascii=False) + "\n")
-        os.replace(tmp_file, FAILED_PAGES_FILE)
-        logger.info(f"REPROCESS: Arquivo de falhas atualizado. "
-                    f"{len(still_failed_pages)} páginas ainda pendentes.")
-    except IOError as e:
-        logger.critical(f"REPROCESS: Erro crítico ao escrever {FAILED_PAGES_FILE}: {e}")
-
-    # --- Registrar páginas que viraram falhas finais ---
-    if dead_pages:
-        try:
-            with open(FAILED_PAGES_DEAD_FILE, 'a', encoding='utf-8') as f:
-                for page_info in dead_pages:
-                    f.write(json.dumps(page_info, ensure_ascii=False) + "\n")
-            logger.warning(f"REPROCESS: {len(dead_pages)} páginas movidas para {FAILED_PAGES_DEAD_FILE}.")
-        except IOError as e:
-            logger.critical(f"REPROCESS: Erro crítico ao escrever {FAILED_PAGES_DEAD_FILE}: {e}")
+        importar_arquivo_falhas_legado(conn)
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM sync_falhas WHERE status = 'pendente' AND proxima_tentativa <= NOW()")
+        vencidas = cursor.fetchone()[0]
+        cursor.close()
+    finally:
+        conn.close()
+
+    if not vencidas:
+        logger.info("REPROCESS: Nenhuma falha vencida na fila. Nada a fazer.")
+        return
+    logger.info(f"REPROCESS: {vencidas} falhas vencidas na fila. Reprocessando com {max_workers} workers.")
+
+    contagens = {'sucesso': 0, 'adiada': 0, 'morta': 0}
+    lock_contagens = threading.Lock()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='reprocess_worker') as executor:
+        for _ in range(max_workers):
+            executor.submit(_worker_reprocessamento, contagens, lock_contagens)
 
+    fechar_enriquecimento_async()
+    # Páginas recuperadas gravaram licitações: recalcula os agregados e invalida o cache da API como o sync faz
+    publicar_alteracoes_dados(contagens['sucesso'])
     logger.info(f"--- Reprocessamento Concluído ---")
-    logger.info(f"Total de páginas reprocessadas com sucesso: {success_count}")
-    logger.info(f"Total de páginas ainda falhando: {len(still_failed_pages)}")
-    logger.info(f"Total de páginas em falha final: {len(dead_pages)}")
+    logger.info(f"Total de falhas reprocessadas com sucesso: {contagens['sucesso']}")
+    logger.info(f"Total de falhas adiadas para nova tentativa: {contagens['adiada']}")
+    logger.info(f"Total de falhas finais (status 'morta'): {contagens['morta']}")
+    logar_estatisticas_conexoes_pncp()
+    logar_estatisticas_cache_subrecursos()
 
 
 if __name__ == '__main__':
-    # --- Mecanismo de lock (idêntico ao script principal) ---
-    try:
-        lock_handle = open(LOCK_FILE, "w")
-        fcntl.lockf(lock_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        logger.info("REPROCESS: Lock adquirido. Iniciando reprocessamento.")
-    except IOError:
-        logger.warning("REPROCESS: Outra instância do script (principal ou reprocessamento) já está em execução. Saindo.")
+    # --- Lease da fila (só entre instâncias do reprocessamento, em qualquer máquina; o sync pode rodar em paralelo) ---
+    if not get_coordenador_leases().adquirir(RECURSO_LEASE):
+        logger.warning(f"REPROCESS: Outra instância do reprocessamento está com o lease '{RECURSO_LEASE}'. Saindo.")
         sys.exit(0)
+    logger.info("REPROCESS: Lease adquirido. Iniciando reprocessamento.")
 
     reprocessar_paginas_com_falha()
     logger.info("REPROCESS: Script de reprocessamento finalizado.")
@@ -2,16 +2,39 @@
 # Essa é a parte principal do backend que lida com a sincronização das licitações do PNCP com o banco de dados local. 
 import fcntl
 import sys
+import argparse # (Para escolher o modo de sincronização pela linha de comando)
+import threading # (Para o modo concorrente: conexões por worker e locks dos arquivos de falha)
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import mysql.connector
 from mysql.connector import errors # (Para tratamento de erros de conexão e SQL)
 import requests # (Para fazer requisições HTTP)
+import httpx # (Cliente HTTP assíncrono do estágio de enriquecimento: itens e arquivos em paralelo)
+import asyncio
+import queue # (Filas limitadas entre os estágios do pipeline de sincronização)
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter # (Pool de conexões keep-alive da sessão compartilhada)
+import hashlib # (Hash do conteúdo dos itens, para gravar só o que mudou)
+import sqlite3 # (Cache em disco das respostas de itens e arquivos)
+import zlib
+import gzip # (Segmentos .jsonl.gz do arquivo bruto das respostas do PNCP)
+import atexit
 import json # (Para lidar com dados JSON da API, embora 'requests' já faça muito disso)
 import os # (Para caminhos de arquivo)
 import time
-from datetime import datetime, date, timedelta # (Para trabalhar com datas)
+import socket # (Identificação do dono dos leases: host:pid)
+import uuid
+from datetime import datetime, date, timedelta, timezone # (Para trabalhar com datas)
+from email.utils import parsedate_to_datetime # (Retry-After no formato de data HTTP)
 import logging 
+import tenacity # (Para capturar tenacity.RetryError quando todas as retentativas falham)
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type, retry_if_exception # Importar de tenacity para usar Retentativas
 from dotenv import load_dotenv # Importe a biblioteca
+from metricas_sync import metricas # (Histogramas e contadores por etapa, exportados no fim da execução)
+from geracao_cache import incrementar_geracao, adquirir_trava # (Invalida os caches da API depois que os dados mudam)
+from redis import Redis # (Fila de enriquecimento: itens e arquivos processados pelo worker_enriquecimento.py)
+from redis.exceptions import RedisError
+from rq import Queue, Retry
+from rq.job import JobStatus
 
 load_dotenv()
 
@@ -23,7 +46,7 @@ console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO) # Logs INFO e acima irão para o console
 # Cria um handler para escrever logs em um arquivo
 # O arquivo será 'sync_api.log' na mesma pasta do script.
-log_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sync_api.log') # isso garante que o log será salvo no mesmo diretório do script
+log_file_path = os.getenv('SYNC_LOG_ARQUIVO', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sync_api.log')) # isso garante que o log será salvo no mesmo diretório do script
 file_handler = logging.FileHandler(log_file_path, mode='a') # 'a' para append
 file_handler.setLevel(logging.ERROR) # Logs Error e acima irão para o arquivo
 # Cria um formatador para definir o formato das mensagens de log
@@ -72,8 +95,247 @@ api_retry_decorator = retry(
         f"devido a: {retry_state.outcome.exception()}. Esperando {retry_state.next_action.sleep:.2f}s..."
     ) # Loga antes de cada retentativa
 )
+
+# Mesma política para o cliente assíncrono (httpx) usado no enriquecimento de itens/arquivos.
+def should_retry_httpx_error(exception_value):
+    """Equivalente ao should_retry_http_error para as exceções do httpx."""
+    if isinstance(exception_value, httpx.HTTPStatusError):
+        return exception_value.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(exception_value, httpx.TransportError) # Timeout, conexão recusada/resetada, etc.
+
+api_retry_decorator_async = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=1, max=10),
+    retry=retry_if_exception(should_retry_httpx_error),
+    before_sleep=lambda retry_state: logger.warning(
+        f"API_RETRY: Retentativa {retry_state.attempt_number} para {retry_state.fn.__name__} "
+        f"devido a: {retry_state.outcome.exception()!r}. Esperando {retry_state.next_action.sleep:.2f}s..."
+    )
+)
 # --- Fim da Configuração de Retentativas ---
 
+# ======= Cliente HTTP Compartilhado para a API do PNCP =======
+# Todas as chamadas ao PNCP (listagem, itens e arquivos) passam por UMA sessão 'requests' com pool keep-alive,
+# em vez de 'requests.get' solto (que abre um TCP+TLS novo a cada página). As retentativas continuam sendo
+# feitas pelo api_retry_decorator nas funções fetch_*, por isso o adapter não faz retry próprio (max_retries=0).
+POOL_CONEXOES_PNCP = int(os.getenv('PNCP_POOL_CONEXOES', '10')) # Conexões mantidas vivas por host. No modo concorrente é ajustado para >= workers.
+TIMEOUT_CONEXAO_PNCP = 10 # (Segundos) Tempo máximo para abrir a conexão TCP/TLS
+TIMEOUT_LISTAGEM_PNCP = 120 # (Segundos) Leitura da listagem /contratacoes/atualizacao (é lenta no PNCP)
+TIMEOUT_SUBRECURSOS_PNCP = 60 # (Segundos) Leitura de itens e arquivos
+
+# ======= Limitador Adaptativo de Requisições ao PNCP =======
+# Token bucket compartilhado por TODAS as chamadas ao PNCP (sessão 'requests' e clientes httpx de todas as threads),
+# no lugar das pausas fixas (time.sleep) entre páginas. A taxa se ajusta sozinha (AIMD): sobe um pouco a cada
+# resposta rápida e cai pela metade em 429, 5xx, erro de rede ou latência muito acima da média recente.
+# Um 'Retry-After' enviado pelo servidor pausa todas as chamadas até o prazo pedido.
+TAXA_INICIAL_PNCP = float(os.getenv('PNCP_TAXA_INICIAL', '5')) # Requisições por segundo no início da execução
+TAXA_MINIMA_PNCP = float(os.getenv('PNCP_TAXA_MINIMA', '0.5'))
+TAXA_MAXIMA_PNCP = float(os.getenv('PNCP_TAXA_MAXIMA', '40'))
+RAJADA_PNCP = 5 # Tokens acumuláveis: rajada máxima depois de um período ocioso
+INCREMENTO_TAXA_PNCP = 1.0 # Aumento aditivo: ~ +1 req/s a cada segundo de respostas boas
+FATOR_RECUO_PNCP = 0.5 # Recuo multiplicativo: taxa *= 0.5 a cada sinal de sobrecarga
+FATOR_LATENCIA_LENTA_PNCP = 3.0 # Resposta 3x mais lenta que a média recente (do mesmo tipo) = sinal de sobrecarga
+AMOSTRAS_MINIMAS_LATENCIA_PNCP = 10 # Só julga latência depois de conhecer a média
+INTERVALO_MINIMO_RECUO_PNCP = 2.0 # (Segundos) Vários erros da mesma rajada derrubam a taxa uma vez só
+RETRY_AFTER_MAXIMO_PNCP = 120 # (Segundos) Teto para um Retry-After exagerado
+
+def _segundos_retry_after(valor):
+    """Interpreta o cabeçalho Retry-After (segundos ou data HTTP). Retorna segundos (limitados) ou None."""
+    if not valor:
+        return None
+    try:
+        segundos = float(valor)
+    except (TypeError, ValueError):
+        try:
+            segundos = (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(segundos, 0.0), RETRY_AFTER_MAXIMO_PNCP)
+
+class LimitadorAdaptativoPNCP:
+    """Token bucket thread-safe com taxa controlada por AIMD. Usado pelo ClientePNCP e pelo enriquecimento assíncrono."""
+    def __init__(self, taxa_inicial=TAXA_INICIAL_PNCP, taxa_minima=TAXA_MINIMA_PNCP, taxa_maxima=TAXA_MAXIMA_PNCP, rajada=RAJADA_PNCP):
+        self._lock = threading.Lock()
+        self.taxa = taxa_inicial
+        self.taxa_minima = taxa_minima
+        self.taxa_maxima = taxa_maxima
+        self.rajada = rajada
+        self._tokens = float(rajada)
+        self._ultima_reposicao = time.monotonic()
+        self._bloqueado_ate = 0.0 # Pausa global pedida por Retry-After
+        self._ultimo_recuo = 0.0
+        self._latencia_media = {} # tipo ('listagem'/'subrecurso') -> (média móvel, amostras)
+        self.estatisticas = {
+            'requisicoes': 0, 'recuos': 0, 'respostas_429': 0, 'pausas_retry_after': 0,
+            'espera_total': 0.0, 'taxa_pico': taxa_inicial,
+        }
+
+    def reservar(self):
+        """Reserva um token e retorna quantos segundos o chamador deve esperar antes de disparar a requisição."""
+        with self._lock:
+            agora = time.monotonic()
+            self._tokens = min(self.rajada, self._tokens + (agora - self._ultima_reposicao) * self.taxa)
+            self._ultima_reposicao = agora
+            self._tokens -= 1 # Pode ficar negativo: a "dívida" vira espera para quem chegar depois
+            espera = max(0.0, -self._tokens / self.taxa, self._bloqueado_ate - agora)
+            self.estatisticas['requisicoes'] += 1
+            self.estatisticas['espera_total'] += espera
+            return espera
+
+    def aguardar(self):
+        espera = self.reservar()
+        if espera > 0:
+            time.sleep(espera)
+
+    async def aguardar_async(self):
+        espera = self.reservar()
+        if espera > 0:
+            await asyncio.sleep(espera)
+
+    def _recuar(self, agora, motivo):
+        """Recuo multiplicativo (no máximo um por INTERVALO_MINIMO_RECUO_PNCP). Chamar com o lock."""
+        if agora - self._ultimo_recuo < INTERVALO_MINIMO_RECUO_PNCP:
+            return
+        self._ultimo_recuo = agora
+        self.taxa = max(self.taxa_minima, self.taxa * FATOR_RECUO_PNCP)
+        self.estatisticas['recuos'] += 1
+        logger.warning(f"RATE_LIMIT: {motivo}. Taxa reduzida para {self.taxa:.2f} req/s.")
+
+    def registrar_resposta(self, status_code, latencia, tipo='subrecurso', retry_after=None):
+        """Alimenta o controle com o resultado de uma requisição que recebeu resposta HTTP."""
+        with self._lock:
+            agora = time.monotonic()
+            pausa = _segundos_retry_after(retry_after) if status_code in (429, 503) else None
+            if pausa:
+                self._bloqueado_ate = max(self._bloqueado_ate, agora + pausa)
+                self.estatisticas['pausas_retry_after'] += 1
+                logger.warning(f"RATE_LIMIT: PNCP pediu Retry-After de {pausa:.0f}s (HTTP {status_code}). Pausando todas as chamadas.")
+            if status_code == 429:
+                self.estatisticas['respostas_429'] += 1
+            if status_code == 429 or status_code >= 500:
+                self._recuar(agora, f"HTTP {status_code}")
+                return
+
+            media, amostras = self._latencia_media.get(tipo, (latencia, 0))
+            lenta = amostras >= AMOSTRAS_MINIMAS_LATENCIA_PNCP and latencia > FATOR_LATENCIA_LENTA_PNCP * media
+            self._latencia_media[tipo] = (0.9 * media + 0.1 * latencia, amostras + 1)
+            if lenta:
+                self._recuar(agora, f"Latência de {latencia:.2f}s ({tipo}), média recente {media:.2f}s")
+            else:
+                self.taxa = min(self.taxa_maxima, self.taxa + INCREMENTO_TAXA_PNCP / self.taxa)
+                self.estatisticas['taxa_pico'] = max(self.estatisticas['taxa_pico'], self.taxa)
+
+    def registrar_falha_rede(self):
+        """Timeout/conexão recusada também é sinal de sobrecarga."""
+        with self._lock:
+            self._recuar(time.monotonic(), "Erro de rede/timeout")
+
+    def resumo(self):
+        with self._lock:
+            return dict(self.estatisticas, taxa_atual=self.taxa)
+
+limitador_pncp = LimitadorAdaptativoPNCP()
+
+class ClientePNCP:
+    """
+    Sessão HTTP compartilhada (thread-safe para GETs) com pool de conexões keep-alive para o pncp.gov.br.
+    Também conta quantas requisições reaproveitaram uma conexão já aberta.
+    """
+    def __init__(self, tamanho_pool=POOL_CONEXOES_PNCP):
+        self.tamanho_pool = tamanho_pool
+        self.sessao = requests.Session()
+        self.sessao.headers.update({'Accept': 'application/json'})
+        # pool_connections = quantos hosts diferentes mantemos (pncp.gov.br e pouco mais); pool_maxsize = conexões por host.
+        self._adaptador = HTTPAdapter(pool_connections=4, pool_maxsize=tamanho_pool, max_retries=0)
+        self.sessao.mount('https://', self._adaptador)
+        self.sessao.mount('http://', self._adaptador)
+
+    def get(self, url, params=None, timeout=TIMEOUT_SUBRECURSOS_PNCP, tipo='subrecurso', headers=None):
+        """
+        GET pela sessão compartilhada, passando pelo limitador_pncp. 'timeout' é o tempo de leitura;
+        o de conexão é TIMEOUT_CONEXAO_PNCP. 'tipo' separa as médias de latência (listagem é bem mais lenta).
+        """
+        limitador_pncp.aguardar()
+        inicio = time.monotonic()
+        try:
+            response = self.sessao.get(url, params=params, timeout=(TIMEOUT_CONEXAO_PNCP, timeout), headers=headers)
+        except requests.exceptions.RequestException:
+            limitador_pncp.registrar_falha_rede()
+            metricas.contar('http_falhas_rede_total', tipo=tipo)
+            raise
+        latencia = time.monotonic() - inicio
+        limitador_pncp.registrar_resposta(response.status_code, latencia, tipo, response.headers.get('Retry-After'))
+        metricas.observar('http_requisicao_segundos', latencia, tipo=tipo)
+        metricas.contar('http_respostas_total', tipo=tipo, status=response.status_code)
+        return response
+
+    def estatisticas_conexoes(self):
+        """Soma os contadores dos pools do urllib3: requisições feitas x conexões novas abertas."""
+        requisicoes = 0
+        conexoes_novas = 0
+        pools = self._adaptador.poolmanager.pools
+        for chave in pools.keys():
+            pool = pools.get(chave)
+            if pool is None:
+                continue
+            requisicoes += pool.num_requests
+            conexoes_novas += pool.num_connections
+        return {
+            'requisicoes': requisicoes,
+            'conexoes_novas': conexoes_novas,
+            'conexoes_reutilizadas': max(requisicoes - conexoes_novas, 0),
+        }
+
+    def fechar(self):
+        self.sessao.close()
+
+_cliente_pncp = None
+_lock_cliente_pncp = threading.Lock()
+
+def get_cliente_pncp():
+    """Retorna o cliente PNCP do processo, criando-o na primeira chamada."""
+    global _cliente_pncp
+    if _cliente_pncp is None:
+        with _lock_cliente_pncp:
+            if _cliente_pncp is None:
+                _cliente_pncp = ClientePNCP()
+    return _cliente_pncp
+
+def configurar_cliente_pncp(tamanho_pool):
+    """Recria o cliente PNCP com outro tamanho de pool (ex: modo concorrente com mais workers que conexões)."""
+    global _cliente_pncp
+    with _lock_cliente_pncp:
+        if _cliente_pncp is not None:
+            if _cliente_pncp.tamanho_pool == tamanho_pool:
+                return _cliente_pncp
+            _cliente_pncp.fechar()
+        _cliente_pncp = ClientePNCP(tamanho_pool)
+    return _cliente_pncp
+
+def logar_estatisticas_conexoes_pncp():
+    """Loga, no fim da execução, o comportamento do limitador e quantas requisições ao PNCP reaproveitaram conexões do pool."""
+    limite = limitador_pncp.resumo()
+    if limite['requisicoes']:
+        logger.info(
+            f"RATE_LIMIT: {limite['requisicoes']} requisições, taxa final {limite['taxa_atual']:.2f} req/s "
+            f"(pico {limite['taxa_pico']:.2f}), {limite['recuos']} recuos, {limite['respostas_429']} respostas 429, "
+            f"{limite['pausas_retry_after']} pausas por Retry-After, {limite['espera_total']:.1f}s de espera acumulada."
+        )
+    if _cliente_pncp is None:
+        return
+    stats = _cliente_pncp.estatisticas_conexoes()
+    taxa = (stats['conexoes_reutilizadas'] / stats['requisicoes'] * 100) if stats['requisicoes'] else 0
+    logger.info(
+        f"HTTP_POOL: {stats['requisicoes']} requisições ao PNCP, {stats['conexoes_novas']} conexões novas, "
+        f"{stats['conexoes_reutilizadas']} reutilizações ({taxa:.1f}% de reuso)."
+    )
+# --- Fim do Cliente HTTP Compartilhado ---
+
+# Enriquecimento assíncrono: itens e arquivos de TODAS as licitações de uma página são buscados em paralelo
+# (httpx + asyncio) antes da gravação, em vez de uma licitação por vez. Desligue para voltar ao modo síncrono.
+ENRIQUECIMENTO_ASYNC = os.getenv('PNCP_ENRIQUECIMENTO_ASYNC', '1') == '1'
+LIMITE_CONCORRENCIA_ENRIQUECIMENTO = int(os.getenv('PNCP_ENRIQUECIMENTO_CONCORRENCIA', '8')) # Requisições simultâneas por página (semáforo)
+
 # =========================================================================================== #
 # ======== Configurações do Processamento das Licitações ========
 # Define o caminho para a pasta backend
@@ -87,11 +349,322 @@ CODIGOS_MODALIDADE = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13]
 # 11) Pré-qualificação, 12) Credenciamento, 13) Lei - Presencial
 
 DIAS_JANELA_SINCRONIZACAO = 2 #Periodo da busca     NUNCA DEIXAR 1 (TALVEZ O IDEAL SEJA 3) POIS EM UM DOMINGO POR EXEMPLO, OU FDS PODEM NÃO ATUALIZAR OU NÃO POSTAR, SEO LA PODE TER ALGUMA FALHA NO SISTEMA DO PNCP
-API_BASE_URL = "https://pncp.gov.br/api/consulta" # (URL base da API do PNCP)      
-API_BASE_URL_PNCP_API = "https://pncp.gov.br/pncp-api"   # Para itens e arquivos    ## PARA TODOS OS LINKS DE ARQUIVOS E ITENS USAR PAGINAÇÃO SE NECESSARIO ##
+# As URLs podem apontar para o mock local (mock_pncp_api.py) nos testes de carga (benchmark_sync.py)
+API_BASE_URL = os.getenv('PNCP_URL_CONSULTA', "https://pncp.gov.br/api/consulta") # (URL base da API do PNCP)
+API_BASE_URL_PNCP_API = os.getenv('PNCP_URL_PNCP_API', "https://pncp.gov.br/pncp-api")   # Para itens e arquivos    ## PARA TODOS OS LINKS DE ARQUIVOS E ITENS USAR PAGINAÇÃO SE NECESSARIO ##
 MAX_CONSECUTIVE_API_FAILURES = 10 # Heurística para o disjuntor de segurança. Se houver mais que esse número de falhas consecutivas, o script aborta e pula a pagina.
+# Modo concorrente (python sync_api.py --workers N): teto GLOBAL de páginas processadas ao mesmo tempo,
+# somando todas as modalidades. Cada worker usa sua própria conexão com o banco. 1 = modo sequencial de sempre.
+MAX_WORKERS_SYNC = int(os.getenv('SYNC_MAX_WORKERS', '1'))
+# Gravação em lote: a página inteira vira UM upsert multi-linha em 'licitacoes' + poucos executemany de itens/arquivos.
+# '0' volta para a gravação de uma licitação por vez (save_licitacao_to_db), útil para comparar.
+GRAVACAO_EM_LOTE_SYNC = os.getenv('SYNC_GRAVACAO_EM_LOTE', '1') == '1'
+TAMANHO_LOTE_INSERCAO_DB = 500 # Máximo de linhas por executemany de itens/arquivos (evita estourar o max_allowed_packet)
 # ======= Fim das Configurações do Processamento das Licitações ============================== #
 
+def decodificar_json(corpo, tipo='subrecurso'):
+    """json.loads medido (histograma json_decode_segundos), para separar o custo do parse do custo da rede."""
+    with metricas.medir('json_decode_segundos', tipo=tipo):
+        return json.loads(corpo)
+
+# ======= Cache em disco das respostas de itens e arquivos (/pncp-api/v1/orgaos/.../itens e /arquivos) =======
+# SQLite local, chaveado pela URL + parâmetros. Em cada busca enviamos If-None-Match / If-Modified-Since quando o PNCP
+# mandou ETag / Last-Modified (304 = sem transferir o corpo); sem esses validadores, comparamos o SHA-256 do corpo.
+# O cache só poupa transferência: ele é gravado antes do commit da página, então não serve para decidir o que já está
+# no banco. Essa decisão usa licitacoes.hashItens/hashArquivos (hash da lista da API), gravados na MESMA transação dos
+# itens/arquivos: lista com o mesmo hash = nenhuma escrita no banco (ver salvar_pagina_licitacoes_em_lote).
+# Não usamos o CacheControl: ele só embrulha a sessão 'requests' (o enriquecimento usa httpx), segue a semântica
+# de Cache-Control (o PNCP não manda cabeçalhos de cache nesses endpoints), não limita o tamanho em disco e não
+# informa ao chamador se o conteúdo mudou, que é justamente o que evita as escritas no banco.
+CACHE_SUBRECURSOS_PNCP = os.getenv('PNCP_CACHE_SUBRECURSOS', '1') == '1'
+CAMINHO_CACHE_SUBRECURSOS = os.getenv('PNCP_CACHE_CAMINHO', os.path.join(BASE_DIR, 'cache_pncp.sqlite3'))
+TAMANHO_MAXIMO_CACHE_SUBRECURSOS = int(os.getenv('PNCP_CACHE_TAMANHO_MB', '512')) * 1024 * 1024 # Acima disso, remove os menos usados (LRU)
+
+class CacheSubrecursosPNCP:
+    """Cache HTTP persistente (SQLite) com validadores, limite de tamanho (LRU) e contadores de hit/miss. Thread-safe."""
+    def __init__(self, caminho=CAMINHO_CACHE_SUBRECURSOS, tamanho_maximo=TAMANHO_MAXIMO_CACHE_SUBRECURSOS):
+        self.tamanho_maximo = tamanho_maximo
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(caminho, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS respostas (
+                chave TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                hash_conteudo TEXT NOT NULL,
+                corpo BLOB NOT NULL,
+                tamanho INTEGER NOT NULL,
+                acessado_em REAL NOT NULL
+            )""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_respostas_acesso ON respostas (acessado_em)")
+        self._tamanho_total = self._db.execute("SELECT COALESCE(SUM(tamanho), 0) FROM respostas").fetchone()[0]
+        self.estatisticas = {'hits_304': 0, 'hits_conteudo': 0, 'misses': 0, 'removidos_lru': 0}
+
+    @staticmethod
+    def montar_chave(url, params):
+        return url + '?' + '&'.join(f"{k}={params[k]}" for k in sorted(params or {}))
+
+    def obter(self, chave):
+        with self._lock:
+            row = self._db.execute("SELECT etag, last_modified, hash_conteudo, corpo FROM respostas WHERE chave = ?", (chave,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'hash_conteudo': row[2], 'corpo': row[3]}
+
+    @staticmethod
+    def cabecalhos_condicionais(entrada):
+        cabecalhos = {}
+        if entrada and entrada['etag']:
+            cabecalhos['If-None-Match'] = entrada['etag']
+        if entrada and entrada['last_modified']:
+            cabecalhos['If-Modified-Since'] = entrada['last_modified']
+        return cabecalhos
+
+    def resolver(self, chave, entrada, status_code, cabecalhos, corpo):
+        """
+        Trata a resposta (200/204/304) de uma busca condicional. Retorna (dados_json, hash_conteudo), com o SHA-256
+        do corpo (no 304, o da entrada em cache).
+        """
+        if status_code == 304 and entrada:
+            with self._lock:
+                self.estatisticas['hits_304'] += 1
+                self._db.execute("UPDATE respostas SET acessado_em = ? WHERE chave = ?", (time.time(), chave))
+            return decodificar_json(zlib.decompress(entrada['corpo'])), entrada['hash_conteudo']
+
+        corpo = corpo if status_code != 204 and corpo else b'[]'
+        dados = decodificar_json(corpo) # Antes de gravar: corpo inválido não entra no cache
+        hash_conteudo = hashlib.sha256(corpo).hexdigest()
+        inalterado = entrada is not None and entrada['hash_conteudo'] == hash_conteudo
+        corpo_comprimido = entrada['corpo'] if inalterado else zlib.compress(corpo, 1)
+        with self._lock:
+            self.estatisticas['hits_conteudo' if inalterado else 'misses'] += 1
+            anterior = self._db.execute("SELECT tamanho FROM respostas WHERE chave = ?", (chave,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO respostas (chave, etag, last_modified, hash_conteudo, corpo, tamanho, acessado_em) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chave, cabecalhos.get('ETag'), cabecalhos.get('Last-Modified'), hash_conteudo, corpo_comprimido, len(corpo_comprimido), time.time())
+            )
+            self._tamanho_total += len(corpo_comprimido) - (anterior[0] if anterior else 0)
+            if self._tamanho_total > self.tamanho_maximo:
+                self._remover_menos_usados()
+        return dados, hash_conteudo
+
+    def _remover_menos_usados(self):
+        """LRU: apaga as entradas acessadas há mais tempo até o cache ficar em 90% do limite. Chamar com o lock."""
+        alvo = self.tamanho_maximo * 0.9
+        while self._tamanho_total > alvo:
+            antigas = self._db.execute("SELECT chave, tamanho FROM respostas ORDER BY acessado_em LIMIT 500").fetchall()
+            if not antigas:
+                self._tamanho_total = 0
+                break
+            for chave, tamanho in antigas:
+                self._db.execute("DELETE FROM respostas WHERE chave = ?", (chave,))
+                self._tamanho_total -= tamanho
+                self.estatisticas['removidos_lru'] += 1
+                if self._tamanho_total <= alvo:
+                    break
+
+    def resumo(self):
+        with self._lock:
+            return dict(self.estatisticas, tamanho_mb=self._tamanho_total / (1024 * 1024))
+
+    def fechar(self):
+        with self._lock:
+            self._db.close()
+
+_cache_subrecursos = None
+_lock_cache_subrecursos = threading.Lock()
+
+def get_cache_subrecursos():
+    """Cache de itens/arquivos do processo (criado na primeira chamada), ou None se desligado/indisponível."""
+    global _cache_subrecursos, CACHE_SUBRECURSOS_PNCP
+    if not CACHE_SUBRECURSOS_PNCP:
+        return None
+    if _cache_subrecursos is None:
+        with _lock_cache_subrecursos:
+            if _cache_subrecursos is None:
+                try:
+                    _cache_subrecursos = CacheSubrecursosPNCP()
+                except sqlite3.Error as e:
+                    logger.error(f"CACHE_PNCP: Não foi possível abrir o cache em {CAMINHO_CACHE_SUBRECURSOS}: {e}. Seguindo sem cache.")
+                    CACHE_SUBRECURSOS_PNCP = False
+                    return None
+    return _cache_subrecursos
+
+def preparar_busca_subrecurso(url, params):
+    """Retorna (chave, entrada_em_cache, cabeçalhos condicionais) para uma busca de itens/arquivos."""
+    cache = get_cache_subrecursos()
+    if cache is None:
+        return None, None, {}
+    chave = cache.montar_chave(url, params)
+    entrada = cache.obter(chave)
+    return chave, entrada, cache.cabecalhos_condicionais(entrada)
+
+def resolver_resposta_subrecurso(chave, entrada, status_code, cabecalhos, corpo):
+    """Converte a resposta de itens/arquivos em (dados, hash_conteudo), passando pelo cache quando ligado."""
+    cache = get_cache_subrecursos()
+    if cache is None or chave is None:
+        corpo = corpo if status_code != 204 and corpo else b'[]'
+        return decodificar_json(corpo), hashlib.sha256(corpo).hexdigest()
+    return cache.resolver(chave, entrada, status_code, cabecalhos, corpo)
+
+def logar_estatisticas_cache_subrecursos():
+    if _cache_subrecursos is None:
+        return
+    stats = _cache_subrecursos.resumo()
+    total = stats['hits_304'] + stats['hits_conteudo'] + stats['misses']
+    taxa = ((stats['hits_304'] + stats['hits_conteudo']) / total * 100) if total else 0
+    logger.info(
+        f"CACHE_PNCP: {total} buscas de itens/arquivos: {stats['hits_304']} hits por 304, {stats['hits_conteudo']} hits por hash, "
+        f"{stats['misses']} misses ({taxa:.1f}% inalterados). {stats['removidos_lru']} entradas removidas (LRU), {stats['tamanho_mb']:.1f} MB em disco."
+    )
+# --- Fim do Cache de Itens e Arquivos ---
+
+# ======= Arquivo bruto das respostas do PNCP (listagem, itens e arquivos) =======
+# Com PNCP_ARQUIVO_BRUTO=1, cada resposta vira uma linha JSON em segmentos gzip particionados pela data da captura:
+# arquivo_pncp/AAAA/MM/DD/pncp-HHMMSS-<pid>-<n>.jsonl.gz. O segmento em escrita tem o sufixo '.parcial' e só ganha
+# o nome final ao ser fechado (rotação por tamanho, troca de dia ou fim do processo).
+# 'python sync_api.py replay --from AAAAMMDD --to AAAAMMDD' regrava esses dados pelo mesmo caminho de escrita sem
+# chamar o PNCP: serve para re-derivar colunas (ex: regras da situacaoReal) e como benchmark reproduzível de ingestão.
+ARQUIVO_BRUTO_PNCP = os.getenv('PNCP_ARQUIVO_BRUTO', '0') == '1'
+DIRETORIO_ARQUIVO_BRUTO = os.getenv('PNCP_ARQUIVO_BRUTO_DIR', os.path.join(BASE_DIR, 'arquivo_pncp'))
+TAMANHO_SEGMENTO_ARQUIVO_BRUTO = int(os.getenv('PNCP_ARQUIVO_BRUTO_SEGMENTO_MB', '64')) * 1024 * 1024 # JSON sem compressão, por segmento
+
+class ArquivoBrutoPNCP:
+    """Grava registros {tipo, capturado_em, parametros, dados} em segmentos .jsonl.gz particionados por dia. Thread-safe."""
+    def __init__(self, diretorio=None, tamanho_segmento=None):
+        self.diretorio = diretorio or DIRETORIO_ARQUIVO_BRUTO
+        self.tamanho_segmento = tamanho_segmento or TAMANHO_SEGMENTO_ARQUIVO_BRUTO
+        self._lock = threading.Lock()
+        self._arquivo = None
+        self._caminho = None
+        self._dia = None
+        self._bytes = 0
+        self._sequencia = 0
+        self.registros = 0
+
+    def _abrir_segmento(self, agora):
+        pasta = os.path.join(self.diretorio, f"{agora:%Y}", f"{agora:%m}", f"{agora:%d}")
+        os.makedirs(pasta, exist_ok=True)
+        self._sequencia += 1
+        self._caminho = os.path.join(pasta, f"pncp-{agora:%H%M%S}-{os.getpid()}-{self._sequencia:04d}.jsonl.gz")
+        self._arquivo = gzip.open(self._caminho + '.parcial', 'wt', encoding='utf-8', compresslevel=6)
+        self._dia = agora.date()
+        self._bytes = 0
+
+    def _fechar_segmento(self):
+        if self._arquivo is not None:
+            self._arquivo.close()
+            os.replace(self._caminho + '.parcial', self._caminho)
+            self._arquivo = None
+
+    def gravar(self, tipo, parametros, dados):
+        agora = datetime.now()
+        linha = json.dumps(
+            {'tipo': tipo, 'capturado_em': agora.isoformat(timespec='seconds'), 'parametros': parametros, 'dados': dados},
+            ensure_ascii=False
+        ) + '\n'
+        with self._lock:
+            if self._arquivo is None or self._dia != agora.date() or self._bytes >= self.tamanho_segmento:
+                self._fechar_segmento()
+                self._abrir_segmento(agora)
+            self._arquivo.write(linha)
+            self._bytes += len(linha)
+            self.registros += 1
+
+    def fechar(self):
+        with self._lock:
+            self._fechar_segmento()
+
+_arquivo_bruto = None
+_lock_arquivo_bruto = threading.Lock()
+
+def arquivar_resposta_bruta(tipo, parametros, dados):
+    """Guarda uma resposta no arquivo bruto, se ligado. Erro ao arquivar desliga o arquivamento, mas nunca para o sync."""
+    global _arquivo_bruto, ARQUIVO_BRUTO_PNCP
+    if not ARQUIVO_BRUTO_PNCP:
+        return
+    try:
+        if _arquivo_bruto is None:
+            with _lock_arquivo_bruto:
+                if _arquivo_bruto is None:
+                    _arquivo_bruto = ArquivoBrutoPNCP()
+                    atexit.register(fechar_arquivo_bruto) # Fecha (e renomeia) o último segmento no fim do processo
+        _arquivo_bruto.gravar(tipo, parametros, dados)
+    except (OSError, TypeError, ValueError) as e:
+        logger.error(f"ARQUIVO_BRUTO: Falha ao arquivar resposta '{tipo}' ({parametros}): {e}. Arquivamento desligado nesta execução.")
+        ARQUIVO_BRUTO_PNCP = False
+
+def fechar_arquivo_bruto():
+    if _arquivo_bruto is not None:
+        _arquivo_bruto.fechar()
+        logger.info(f"ARQUIVO_BRUTO: {_arquivo_bruto.registros} respostas arquivadas em {DIRETORIO_ARQUIVO_BRUTO}.")
+
+def ler_arquivo_bruto_do_dia(dia, diretorio=None):
+    """Registros dos segmentos FECHADOS de um dia, na ordem de gravação. Um segmento corrompido é lido até onde der."""
+    pasta = os.path.join(diretorio or DIRETORIO_ARQUIVO_BRUTO, f"{dia:%Y}", f"{dia:%m}", f"{dia:%d}")
+    if not os.path.isdir(pasta):
+        return
+    for nome in sorted(os.listdir(pasta)):
+        if nome.endswith('.parcial'):
+            logger.warning(f"ARQUIVO_BRUTO: Segmento não fechado ignorado: {os.path.join(pasta, nome)}")
+            continue
+        if not nome.endswith('.jsonl.gz'):
+            continue
+        try:
+            with gzip.open(os.path.join(pasta, nome), 'rt', encoding='utf-8') as f:
+                for linha in f:
+                    yield json.loads(linha)
+        except (EOFError, OSError, json.JSONDecodeError) as e:
+            logger.error(f"ARQUIVO_BRUTO: Segmento {nome} de {dia} lido só até o erro: {e}")
+
+def chave_subrecursos_arquivo_bruto(cnpj, ano, sequencial):
+    return f"{cnpj}/{ano}/{sequencial}"
+# --- Fim do Arquivo Bruto ---
+
+# ======= Métricas da execução (metricas_sync.py) =======
+# No fim de cada execução: relatório JSON em relatorios_sync/ e, se configurado, o textfile do Prometheus
+# (aponte para o diretório do --collector.textfile.directory do node_exporter). Vazio desliga a saída.
+DIRETORIO_RELATORIOS_SYNC = os.getenv('SYNC_RELATORIOS_DIR', os.path.join(BASE_DIR, 'relatorios_sync'))
+ARQUIVO_METRICAS_PROMETHEUS = os.getenv('SYNC_METRICAS_PROMETHEUS', '') # ex: /var/lib/node_exporter/textfile/radar_sync.prom
+
+# Estatísticas que já existiam em outras classes entram no relatório como fontes (lidas só na exportação)
+metricas.adicionar_fonte('limitador', limitador_pncp.resumo)
+metricas.adicionar_fonte('http_pool', lambda: _cliente_pncp.estatisticas_conexoes() if _cliente_pncp else {})
+metricas.adicionar_fonte('cache_subrecursos', lambda: _cache_subrecursos.resumo() if _cache_subrecursos else {})
+metricas.adicionar_fonte('arquivo_bruto', lambda: {'registros': _arquivo_bruto.registros} if _arquivo_bruto else {})
+
+def logar_resumo_metricas(resumo):
+    """Loga as etapas que mais consumiram tempo e o total de licitações por resultado."""
+    series = [
+        (nome, rotulos, dados) for nome, por_rotulo in resumo['histogramas'].items()
+        for rotulos, dados in por_rotulo.items() if dados['contagem']
+    ]
+    for nome, rotulos, dados in sorted(series, key=lambda serie: serie[2]['soma_s'], reverse=True):
+        logger.info(
+            f"METRICAS: {nome}{'' if rotulos == 'total' else '{' + rotulos + '}'}: {dados['contagem']} medições, {dados['soma_s']:.2f}s no total, "
+            f"p50 {dados['p50_s'] * 1000:.1f}ms, p95 {dados['p95_s'] * 1000:.1f}ms, máx {dados['max_s'] * 1000:.1f}ms."
+        )
+    licitacoes = resumo['contadores'].get('licitacoes_total', {})
+    if licitacoes:
+        logger.info("METRICAS: Licitações por resultado: " + ", ".join(f"{rotulo.split('=')[-1]}={valor}" for rotulo, valor in licitacoes.items()))
+
+def exportar_metricas_execucao(modo, sucesso=True):
+    """Fecha a execução: grava o relatório JSON e o textfile do Prometheus e loga o resumo. Nunca derruba o script."""
+    caminho_json = None
+    if DIRETORIO_RELATORIOS_SYNC:
+        caminho_json = os.path.join(DIRETORIO_RELATORIOS_SYNC, f"sync-{modo}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    try:
+        resumo = metricas.exportar(caminho_json, ARQUIVO_METRICAS_PROMETHEUS or None, {'modo': modo, 'execucao_sucesso': sucesso})
+    except OSError as e:
+        logger.error(f"METRICAS: Não foi possível gravar o relatório da execução: {e}")
+        return
+    logar_resumo_metricas(resumo)
+    if caminho_json:
+        logger.info(f"METRICAS: Relatório da execução gravado em {caminho_json}.")
+# --- Fim das Métricas da execução ---
+
 # ===== Validação de Dados da Licitação para decidir se continua a buscar a licitação especifca ou não ===== 
 def validar_dados_licitacao_api(licitacao_api_data):
     """
@@ -136,6 +709,55 @@ def validar_dados_licitacao_api(licitacao_api_data):
 
 # --- Configuração do Log de Falhas Persistentes ---
 FAILED_DATA_LOG_PATH = os.path.join(BASE_DIR, 'fail_licitacoes_indv.jsonl')
+# No modo concorrente vários workers podem logar falhas ao mesmo tempo; o lock evita linhas JSON misturadas.
+_lock_arquivos_falha = threading.Lock()
+
+# --- Fila de reprocessamento (DLQ) no banco: tabela sync_falhas ---
+# Páginas que falharam e licitações cuja falha é transitória (busca de itens, erro de banco) entram na fila com
+# número de tentativas e horário da próxima tentativa; reprocessar_pag_fail.py consome a fila em paralelo.
+# Falhas de validação continuam só no arquivo: reprocessar os mesmos dados inválidos falharia de novo.
+TIPOS_FALHA_REPROCESSAVEIS = ('licitacao_itens_fetch_error', 'licitacao_principal_db_error')
+SQL_REGISTRAR_FALHA_DLQ = (
+    "INSERT INTO sync_falhas (tipo, chave, modalidade_id, pagina, data_inicio, data_fim, dado, motivo) "
+    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE motivo = VALUES(motivo), dado = COALESCE(VALUES(dado), dado)"
+)
+
+_estado_dlq = threading.local()
+
+@contextmanager
+def reprocessando_falha_dlq(tipo, chave):
+    """
+    Usado pelo reprocessador: enquanto a falha (tipo, chave) é reprocessada, uma nova falha da MESMA chave não
+    é gravada na fila (o reprocessador já agenda a próxima tentativa, e a linha está travada pela própria thread).
+    """
+    _estado_dlq.em_reprocessamento = (tipo, str(chave))
+    try:
+        yield
+    finally:
+        _estado_dlq.em_reprocessamento = None
+
+def registrar_falha_dlq(tipo, chave, motivo, modalidade=None, pagina=None, data_inicio=None, data_fim=None, dado=None):
+    """
+    Grava uma falha na tabela sync_falhas ('pagina' ou 'licitacao'). Usa uma conexão própria, pois quem chama
+    pode estar no meio de uma transação que será desfeita (ou sem conexão). Retorna True se gravou.
+    """
+    if getattr(_estado_dlq, 'em_reprocessamento', None) == (tipo, str(chave)):
+        return True
+    conn = get_db_connection(max_retries=1)
+    if not conn:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute(SQL_REGISTRAR_FALHA_DLQ, (tipo, chave, modalidade, pagina, data_inicio, data_fim, dado, str(motivo)[:2000]))
+        conn.commit()
+        cursor.close()
+        return True
+    except mysql.connector.Error as e:
+        logger.error(f"DLQ_FAIL: Não foi possível registrar a falha '{tipo}' ({chave}) em sync_falhas: {e}")
+        return False
+    finally:
+        conn.close()
 
 def logar_falha_persistente(tipo_dado, dado_problematico, motivo_falha):
     """
@@ -148,9 +770,12 @@ def logar_falha_persistente(tipo_dado, dado_problematico, motivo_falha):
             "motivo_falha": motivo_falha,
             "dado": dado_problematico # O dict/lista original da API
         }
-        with open(FAILED_DATA_LOG_PATH, 'a', encoding='utf-8') as f:
+        with _lock_arquivos_falha, open(FAILED_DATA_LOG_PATH, 'a', encoding='utf-8') as f:
             f.write(json.dumps(entrada_log_falha, ensure_ascii=False) + '\n')
         logger.warning(f"FALHA_PERSISTENTE: Dados do tipo '{tipo_dado}' logados em {FAILED_DATA_LOG_PATH}. Motivo: {motivo_falha}. PNCP_ID (se aplicável): {dado_problematico.get('numeroControlePNCP', 'N/A')}")
+        if tipo_dado in TIPOS_FALHA_REPROCESSAVEIS and dado_problematico.get('numeroControlePNCP'):
+            registrar_falha_dlq('licitacao', dado_problematico['numeroControlePNCP'], motivo_falha,
+                                dado=json.dumps(dado_problematico, ensure_ascii=False))
     except Exception as e:
         logger.error(f"FALHA_LOG_DLQ: Erro ao tentar logar dados problemáticos para {FAILED_DATA_LOG_PATH}: {e}")
 # Fim da Configuração do Log de Falhas Persistentes e Validação de Dados
@@ -162,14 +787,14 @@ def fetch_itens_from_api(cnpj_orgao, ano_compra, sequencial_compra, pagina=1, ta
     """Busca uma página de itens de uma licitação com tratamento de erro robusto."""
     url = f"{API_BASE_URL_PNCP_API}/v1/orgaos/{cnpj_orgao}/compras/{ano_compra}/{sequencial_compra}/itens"
     params = {'pagina': pagina, 'tamanhoPagina': tamanho_pagina}
-    headers = {'Accept': 'application/json'}
     logger.debug(f"ITENS_API: Buscando em {url} com params {params}")
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=60)
-        response.raise_for_status()
-        if response.status_code == 204:
-            return []
-        return response.json()
+        chave_cache, entrada_cache, cabecalhos = preparar_busca_subrecurso(url, params)
+        response = get_cliente_pncp().get(url, params=params, timeout=TIMEOUT_SUBRECURSOS_PNCP, headers=cabecalhos)
+        if response.status_code != 304:
+            response.raise_for_status()
+        dados, _ = resolver_resposta_subrecurso(chave_cache, entrada_cache, response.status_code, response.headers, response.content)
+        return dados
     # --- INÍCIO DA LÓGICA DE EXCEÇÃO CORRIGIDA ---
     except requests.exceptions.HTTPError as http_err:
         if should_retry_http_error(http_err):
@@ -189,14 +814,14 @@ def fetch_arquivos_from_api(cnpj_orgao, ano_compra, sequencial_compra, pagina=1,
     """Busca uma página de arquivos de uma licitação com tratamento de erro robusto."""
     url = f"{API_BASE_URL_PNCP_API}/v1/orgaos/{cnpj_orgao}/compras/{ano_compra}/{sequencial_compra}/arquivos"
     params = {'pagina': pagina, 'tamanhoPagina': tamanho_pagina}
-    headers = {'Accept': 'application/json'}
     logger.debug(f"ARQUIVOS_API: Buscando em {url} com params {params}")
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=60)
-        response.raise_for_status()
-        if response.status_code == 204:
-            return []
-        return response.json()
+        chave_cache, entrada_cache, cabecalhos = preparar_busca_subrecurso(url, params)
+        response = get_cliente_pncp().get(url, params=params, timeout=TIMEOUT_SUBRECURSOS_PNCP, headers=cabecalhos)
+        if response.status_code != 304:
+            response.raise_for_status()
+        dados, _ = resolver_resposta_subrecurso(chave_cache, entrada_cache, response.status_code, response.headers, response.content)
+        return dados
     # --- INÍCIO DA LÓGICA DE EXCEÇÃO CORRIGIDA ---
     except requests.exceptions.HTTPError as http_err:
         if should_retry_http_error(http_err):
@@ -214,6 +839,7 @@ def fetch_arquivos_from_api(cnpj_orgao, ano_compra, sequencial_compra, pagina=1,
 
 
 ### ARQUIVOS ###
+@metricas.medir('busca_subrecursos_segundos', tipo='arquivos')
 def fetch_all_arquivos_metadata_from_api(cnpj_orgao, ano_compra, sequencial_compra):
     """
     Busca TODOS os METADADOS de arquivos de uma licitação específica da API,
@@ -244,41 +870,23 @@ def fetch_all_arquivos_metadata_from_api(cnpj_orgao, ano_compra, sequencial_comp
         if len(arquivos_pagina_metadados) < TAMANHO_PAGINA_SYNC:
             break # Sai do loop while
 
-        pagina_atual_arquivos += 1
-        time.sleep(0.2) # Pausa para não sobrecarregar a API
+        pagina_atual_arquivos += 1 # O ritmo das chamadas é controlado pelo limitador_pncp
 
     logger.info(f"ARQUIVOS (Busca Metadados): Total de {len(todos_arquivos_api_metadados)} metadados de arquivos encontrados para {cnpj_orgao}/{ano_compra}/{sequencial_compra}.")
+    arquivar_resposta_bruta('arquivos', {'chave': chave_subrecursos_arquivo_bruto(cnpj_orgao, ano_compra, sequencial_compra)}, todos_arquivos_api_metadados)
     return todos_arquivos_api_metadados
 
-def salvar_arquivos_no_banco(conn, licitacao_id_local, lista_arquivos_metadata_api, cnpj_orgao, ano_compra, sequencial_compra):
-    """
-    Salva uma lista de metadados de arquivos no banco de dados para uma licitação específica.
-    Deleta arquivos antigos dessa licitação antes de inserir os novos.
-    Constrói o link de download para cada arquivo.
-    """
-    if not lista_arquivos_metadata_api: # Se a lista estiver vazia (None ou [])
-        logger.info(f"SALVANDO_ARQUIVOS: Sem metadados de arquivos para salvar para licitação ID {licitacao_id_local}.") # Mudado para INFO
-        return # Nada a fazer
-
-    cursor = conn.cursor()
-    # Deletar arquivos antigos desta licitação antes de (re)inserir
-    try:
-        logger.debug(f"SALVANDO_ARQUIVOS: Garantindo limpeza de arquivos pré-existentes para licitação ID {licitacao_id_local} antes de inserir novos.")
-        cursor.execute("DELETE FROM arquivos_licitacao WHERE licitacao_id = %s", (licitacao_id_local,))
-        if cursor.rowcount > 0:
-            logger.debug(f"SALVANDO_ARQUIVOS: {cursor.rowcount} arquivos antigos foram efetivamente deletados para licitação ID {licitacao_id_local}.")
-    except mysql.connector.Error as e:
-        logger.exception(f"SALVANDO_ARQUIVOS: Erro no Banco de Dados ao tentar limpar arquivos antigos (lic_id {licitacao_id_local})")
-        return
-
-    sql_insert_arquivo = """
-    INSERT INTO arquivos_licitacao (
-        licitacao_id, titulo, link_download, dataPublicacaoPncp, anoCompra, statusAtivo
-    ) VALUES (%s, %s, %s, %s, %s, %s)
-    ON DUPLICATE KEY UPDATE licitacao_id = VALUES(licitacao_id);
-    """ # A parte do UPDATE não faz nada de útil, mas transforma o INSERT em um "INSERT IGNORE"
+# Arquivos também são sincronizados por diferença, identificados por (licitacao_id, sequencialDocumento)
+# (UNIQUE uk_arquivo_licitacao): só documentos novos, com título/statusAtivo alterado ou removidos da API
+# geram escrita. Requer a migração atualizar_db_sync.sql.
+COLUNAS_ARQUIVO = ('licitacao_id', 'sequencialDocumento', 'titulo', 'link_download', 'dataPublicacaoPncp', 'anoCompra', 'statusAtivo')
+SQL_UPSERT_ARQUIVO = (
+    f"INSERT INTO arquivos_licitacao ({', '.join(COLUNAS_ARQUIVO)}) VALUES ({', '.join(['%s'] * len(COLUNAS_ARQUIVO))})"
+    " ON DUPLICATE KEY UPDATE " + ', '.join(f'{col} = VALUES({col})' for col in COLUNAS_ARQUIVO[2:])
+)
 
-    # 1. Preparar a lista de tuplas
+def montar_tuplas_arquivos(licitacao_id_local, lista_arquivos_metadata_api, cnpj_orgao, ano_compra, sequencial_compra):
+    """Converte os metadados de arquivos da API nas tuplas de SQL_UPSERT_ARQUIVO, montando o link de download de cada um."""
     arquivos_para_inserir = []
     arquivos_com_dados_invalidos = 0
 
@@ -286,7 +894,7 @@ def salvar_arquivos_no_banco(conn, licitacao_id_local, lista_arquivos_metadata_a
         nome_do_arquivo = arquivo_md_api.get('titulo')
         id_do_documento_api = arquivo_md_api.get('sequencialDocumento')
 
-        if not (nome_do_arquivo and id_do_documento_api is not None):
+        if not (nome_do_arquivo and str(id_do_documento_api).isdigit()):
             logger.warning(f"SALVANDO_ARQUIVOS: Metadados do arquivo incompletos para lic_id {licitacao_id_local}. Título: {nome_do_arquivo}, ID Doc: {id_do_documento_api}. Pulando arquivo.")
             arquivos_com_dados_invalidos +=1
             continue
@@ -296,6 +904,7 @@ def salvar_arquivos_no_banco(conn, licitacao_id_local, lista_arquivos_metadata_a
 
         arquivo_db_tuple = (
             licitacao_id_local,
+            int(id_do_documento_api),
             nome_do_arquivo,
             link_de_download_individual,
             data_pub_pncp_str,
@@ -306,22 +915,117 @@ def salvar_arquivos_no_banco(conn, licitacao_id_local, lista_arquivos_metadata_a
 
     if arquivos_com_dados_invalidos > 0:
         logger.warning(f"SALVANDO_ARQUIVOS: {arquivos_com_dados_invalidos} arquivos foram pulados devido a dados incompletos para lic_id {licitacao_id_local}.")
+    return arquivos_para_inserir
 
-    # 2. Executar a inserção em lote
-    if arquivos_para_inserir:
-        try:
-            cursor.executemany(sql_insert_arquivo, arquivos_para_inserir)
-            # conn.commit() # Commit principal em save_licitacao_to_db
-            logger.info(f"SALVANDO_ARQUIVOS: {cursor.rowcount} arquivos inseridos/ignorados (ON CONFLICT) em lote para licitação ID {licitacao_id_local}.")
-            # Para ON CONFLICT DO NOTHING, rowcount pode não ser o número de itens na lista se houver conflitos.
-            # Ele geralmente reflete o número de linhas realmente modificadas/inseridas.
-            if cursor.rowcount < len(arquivos_para_inserir):
-                logger.info(f"SALVANDO_ARQUIVOS: {len(arquivos_para_inserir) - cursor.rowcount} arquivos foram ignorados devido a conflito de 'link_download' (UNIQUE) para lic_id {licitacao_id_local}.")
-        except mysql.connector.Error as e:
-            logger.exception(f"SALVANDO_ARQUIVOS: Erro no Banco de Dados durante executemany para licitação ID {licitacao_id_local}")
-            logger.debug(f"SALVANDO_ARQUIVOS: Primeiros arquivos na tentativa de lote (max 5): {arquivos_para_inserir[:5]}")
-    elif not arquivos_com_dados_invalidos:
+def _gravar_hashes_subrecurso(cursor, coluna, hashes_por_licitacao):
+    """
+    licitacoes.hashItens/hashArquivos das licitações cujos itens/arquivos acabaram de ser sincronizados, na mesma
+    transação. Hash None (lista que não veio da busca paginada com hash) = NULL: a próxima busca regrava.
+    """
+    ids = list(hashes_por_licitacao)
+    cursor.execute(
+        f"UPDATE licitacoes SET {coluna} = CASE id {' '.join(['WHEN %s THEN %s'] * len(ids))} END "
+        f"WHERE id IN ({', '.join(['%s'] * len(ids))})",
+        tuple(valor for licitacao_id in ids for valor in (licitacao_id, hashes_por_licitacao[licitacao_id])) + tuple(ids)
+    )
+    return 1
+
+def _aplicar_diff_arquivos(cursor, tuplas_por_licitacao, hashes=None):
+    """
+    Compara os arquivos da API com os do banco (UM SELECT para todas as licitações) e grava só a diferença.
+    'hashes' = {licitacao_id: hash da lista de arquivos da API}, gravado em licitacoes.hashArquivos.
+    Retorna (comandos_sql, {'inseridos': n, 'atualizados': n, 'removidos': n}). Erros do banco sobem para quem chamou.
+    """
+    ids = list(tuplas_por_licitacao)
+    cursor.execute(
+        f"SELECT id, licitacao_id, sequencialDocumento, titulo, statusAtivo FROM arquivos_licitacao WHERE licitacao_id IN ({', '.join(['%s'] * len(ids))})",
+        tuple(ids)
+    )
+    comandos = 1
+    existentes = {} # (licitacao_id, sequencialDocumento) -> (id, titulo, statusAtivo)
+    for row in cursor.fetchall():
+        row = row if isinstance(row, dict) else dict(zip(('id', 'licitacao_id', 'sequencialDocumento', 'titulo', 'statusAtivo'), row))
+        existentes[(row['licitacao_id'], row['sequencialDocumento'])] = (row['id'], row['titulo'], bool(row['statusAtivo']))
+
+    recebidos = {}
+    for tuplas in tuplas_por_licitacao.values():
+        for tupla in tuplas:
+            recebidos[(tupla[0], tupla[1])] = tupla # Documento repetido na API: vale o último
+
+    contagens = {'inseridos': 0, 'atualizados': 0, 'removidos': 0}
+    para_gravar = []
+    for chave, tupla in recebidos.items():
+        existente = existentes.get(chave)
+        if existente is None:
+            contagens['inseridos'] += 1
+            para_gravar.append(tupla)
+        elif (existente[1], existente[2]) != (tupla[2], tupla[6]): # titulo, statusAtivo
+            contagens['atualizados'] += 1
+            para_gravar.append(tupla)
+    ids_removidos = [id_arquivo for chave, (id_arquivo, _, _) in existentes.items() if chave not in recebidos]
+    contagens['removidos'] = len(ids_removidos)
+
+    if ids_removidos:
+        cursor.execute(f"DELETE FROM arquivos_licitacao WHERE id IN ({', '.join(['%s'] * len(ids_removidos))})", tuple(ids_removidos))
+        comandos += 1
+    if para_gravar:
+        comandos += _executemany_em_lotes(cursor, SQL_UPSERT_ARQUIVO, para_gravar)
+    comandos += _gravar_hashes_subrecurso(cursor, 'hashArquivos', {licitacao_id: (hashes or {}).get(licitacao_id) for licitacao_id in ids})
+    return comandos, contagens
+
+def sincronizar_arquivos(cursor, tuplas_por_licitacao, hashes=None):
+    """
+    Sincroniza por diferença os arquivos de várias licitações ({licitacao_id: tuplas de montar_tuplas_arquivos}).
+    Se o lote falhar, tenta licitação por licitação. Retorna (comandos_sql, contagens de inseridos/atualizados/removidos).
+    """
+    try:
+        comandos, contagens = _aplicar_diff_arquivos(cursor, tuplas_por_licitacao, hashes)
+        logger.info(
+            f"SALVANDO_ARQUIVOS: {len(tuplas_por_licitacao)} licitações: {contagens['inseridos']} arquivos inseridos, "
+            f"{contagens['atualizados']} atualizados, {contagens['removidos']} removidos."
+        )
+        return comandos, contagens
+    except mysql.connector.errors.OperationalError:
+        raise # Conexão perdida: a página inteira falha e vai para failed_pages.jsonl
+    except mysql.connector.Error as err:
+        if len(tuplas_por_licitacao) == 1:
+            licitacao_id, tuplas = next(iter(tuplas_por_licitacao.items()))
+            logger.exception(f"SALVANDO_ARQUIVOS: Erro no Banco de Dados ao sincronizar arquivos da licitação ID {licitacao_id}")
+            logger.debug(f"SALVANDO_ARQUIVOS: Primeiros arquivos na tentativa de lote (max 5): {tuplas[:5]}")
+            return 0, {'inseridos': 0, 'atualizados': 0, 'removidos': 0}
+        logger.error(f"SALVANDO_ARQUIVOS: Falha ao sincronizar arquivos em lote ({len(tuplas_por_licitacao)} licitações): {err}. Tentando uma licitação por vez.")
+
+    comandos_total = 0
+    contagens_total = {'inseridos': 0, 'atualizados': 0, 'removidos': 0}
+    for licitacao_id, tuplas in tuplas_por_licitacao.items():
+        comandos, contagens = sincronizar_arquivos(cursor, {licitacao_id: tuplas}, hashes)
+        comandos_total += comandos
+        for chave in contagens_total:
+            contagens_total[chave] += contagens[chave]
+    return comandos_total, contagens_total
+
+def salvar_arquivos_no_banco(conn, licitacao_id_local, lista_arquivos_metadata_api, cnpj_orgao, ano_compra, sequencial_compra):
+    """
+    Sincroniza (por diferença) os metadados de arquivos de uma licitação específica.
+    Constrói o link de download para cada arquivo.
+    Retorna as contagens {'inseridos', 'atualizados', 'removidos'}.
+    """
+    contagens = {'inseridos': 0, 'atualizados': 0, 'removidos': 0}
+    if not lista_arquivos_metadata_api: # Se a lista estiver vazia (None ou [])
+        logger.info(f"SALVANDO_ARQUIVOS: Sem metadados de arquivos para salvar para licitação ID {licitacao_id_local}.") # Mudado para INFO
+        return contagens # Nada a fazer
+
+    arquivos_para_gravar = montar_tuplas_arquivos(licitacao_id_local, lista_arquivos_metadata_api, cnpj_orgao, ano_compra, sequencial_compra)
+    if not arquivos_para_gravar:
         logger.info(f"SALVANDO_ARQUIVOS: Nenhum arquivo válido encontrado na lista para inserir para lic_id {licitacao_id_local}.")
+        return contagens
+
+    cursor = conn.cursor()
+    try:
+        _, contagens = sincronizar_arquivos(cursor, {licitacao_id_local: arquivos_para_gravar})
+    finally:
+        cursor.close()
+    return contagens
 
     
 # Conecta com banco de dados; com retry para erros de conexão.
@@ -381,14 +1085,14 @@ def fetch_licitacoes_por_atualizacao(data_inicio_str, data_fim_str, codigo_modal
     logger.info(f"SYNC_API: Buscando em {url_api_pncp} com params {params_api}")
 
     try:
-        response = requests.get(url_api_pncp, params=params_api, timeout=120)
+        response = get_cliente_pncp().get(url_api_pncp, params=params_api, timeout=TIMEOUT_LISTAGEM_PNCP, tipo='listagem')
         response.raise_for_status() # Levanta HTTPError para status 4xx/5xx
         
         if response.status_code == 204:
             logger.info(f"SYNC_API: Recebido status 204 (No Content) para {url_api_pncp} com params {params_api}.")
             return [], 0
         
-        data_api = response.json()
+        data_api = decodificar_json(response.content, 'listagem')
         return data_api.get('data'), data_api.get('paginasRestantes', 0)
 
     except requests.exceptions.HTTPError as http_err:
@@ -415,17 +1119,39 @@ def fetch_licitacoes_por_atualizacao(data_inicio_str, data_fim_str, codigo_modal
         return None, 0
 
 
-def  save_licitacao_to_db(conn, licitacao_api_item): 
-    # >>> PASSO DE VALIDAÇÃO INICIAL <<<
-    if not validar_dados_licitacao_api(licitacao_api_item):
-        logar_falha_persistente("licitacao_principal", licitacao_api_item, "Falha na validação inicial dos dados.")
-        return None # Pula o processamento desta licitação
-    
-    # MODIFICADO: Usar 'dictionary=True' para acessar colunas por nome
-    cursor = conn.cursor(dictionary=True)
-    pncp_id = licitacao_api_item.get('numeroControlePNCP') # Pega o ID para usar nos logs
-      
-    # Mapeamento de licitacao_db 
+def calcular_hash_conteudo(valores):
+    """SHA-256 (hex) dos valores já normalizados de uma linha, para detectar mudança sem comparar coluna a coluna."""
+    return hashlib.sha256(json.dumps(valores, default=str, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+# Campos do cabeçalho que, na prática, mudam junto com os documentos da licitação: retificação de edital
+# (datas de abertura/encerramento), republicação, anulação/revogação/suspensão (situação) e homologação (valor homologado).
+# Se nenhum deles mudou, a lista de arquivos não é buscada de novo (ver avaliar_estado_pagina).
+CAMPOS_ASSINATURA_DOCUMENTAL = ('situacaoCompraId', 'dataAberturaProposta', 'dataEncerramentoProposta', 'dataPublicacaoPncp', 'valorTotalHomologado')
+PULAR_ARQUIVOS_SEM_MUDANCA_DOCUMENTAL = os.getenv('SYNC_PULAR_ARQUIVOS_SEM_MUDANCA', '1') == '1'
+
+def calcular_assinatura_documental(licitacao_db_parcial):
+    """Hash dos CAMPOS_ASSINATURA_DOCUMENTAL, gravado em licitacoes.assinaturaDocumental."""
+    return calcular_hash_conteudo([licitacao_db_parcial.get(campo) for campo in CAMPOS_ASSINATURA_DOCUMENTAL])
+
+# Detecção de mudança por grupo de colunas: cada licitação guarda a impressão digital do texto pesquisável (hashTexto,
+# colunas do índice FULLTEXT idx_fts_busca) e do resto do cabeçalho (hashDados). Numa atualização, só os grupos cujo
+# hash mudou entram no UPDATE: mudar só a situação não regrava o objetoCompra, então o InnoDB não reindexa o FTS
+# (nem cresce as tabelas auxiliares dele) e o redo/binlog leva só as colunas que mudaram.
+COLUNAS_TEXTO_FTS = ('objetoCompra', 'orgaoEntidadeRazaoSocial', 'unidadeOrgaoNome', 'unidadeOrgaoMunicipioNome', 'unidadeOrgaoUfNome', 'orgaoEntidadeCnpj')
+# Regravadas sempre que a licitação é regravada (mudam a cada atualização ou dependem dos itens)
+COLUNAS_SEMPRE_ATUALIZADAS = ('dataAtualizacao', 'assinaturaDocumental', 'situacaoReal')
+
+def calcular_hashes_grupos(licitacao_db_parcial):
+    """Preenche hashTexto e hashDados (numeroControlePNCP e COLUNAS_SEMPRE_ATUALIZADAS ficam fora dos dois)."""
+    licitacao_db_parcial['hashTexto'] = calcular_hash_conteudo([licitacao_db_parcial.get(col) for col in COLUNAS_TEXTO_FTS])
+    licitacao_db_parcial['hashDados'] = calcular_hash_conteudo([
+        valor for col, valor in licitacao_db_parcial.items()
+        if col not in COLUNAS_TEXTO_FTS and col not in COLUNAS_SEMPRE_ATUALIZADAS and col not in ('numeroControlePNCP', 'hashTexto')
+    ])
+
+# Mapeamento do JSON da API para as colunas da tabela 'licitacoes' (sem a situacaoReal, que depende dos itens)
+def mapear_licitacao_api_para_db(licitacao_api_item):
+    """Converte uma licitação da API no dicionário de colunas da tabela 'licitacoes', incluindo o link_portal_pncp."""
     licitacao_db_parcial = { # isso aqui cria o dicionario parcial. Para efeito de comparação simples é como se fosse um SELECT * FROM licitacao WHERE id = ?
         'numeroControlePNCP': licitacao_api_item.get('numeroControlePNCP'),
         'numeroCompra': licitacao_api_item.get('numeroCompra'),
@@ -479,105 +1205,232 @@ def  save_licitacao_to_db(conn, licitacao_api_item):
             link_pncp_val = f"https://pncp.gov.br/app/editais/{cnpj_l}/{ano_l}/{seq_sem_zeros}"
         except ValueError: link_pncp_val = None
     licitacao_db_parcial['link_portal_pncp'] = link_pncp_val
+    licitacao_db_parcial['assinaturaDocumental'] = calcular_assinatura_documental(licitacao_db_parcial)
+    calcular_hashes_grupos(licitacao_db_parcial)
+    return licitacao_db_parcial
+
+# Colunas gravadas em 'licitacoes' (ordem do mapeamento + situacaoReal). O SQL do UPSERT é montado UMA vez aqui,
+# e não a cada licitação; só a quantidade de linhas do VALUES varia (gravação em lote da página).
+COLUNAS_LICITACAO = tuple(mapear_licitacao_api_para_db({})) + ('situacaoReal',)
+_PLACEHOLDERS_LINHA_LICITACAO = '(' + ', '.join(['%s'] * len(COLUNAS_LICITACAO)) + ')'
+_SQL_UPSERT_LICITACOES_INICIO = f"INSERT INTO licitacoes ({', '.join(f'`{col}`' for col in COLUNAS_LICITACAO)}) VALUES "
+_SQL_UPSERT_LICITACOES_FIM = " ON DUPLICATE KEY UPDATE " + ', '.join(
+    f'`{col}` = VALUES(`{col}`)' for col in COLUNAS_LICITACAO if col != 'numeroControlePNCP'
+)
 
-    # --- Determinar flag_houve_mudanca_real e obter licitacao_id_local_existente ---
-    # Esta flag e o ID são importantes para decidir se buscamos itens/arquivos e para o UPSERT.
-    licitacao_id_local_final = None
-    flag_houve_mudanca_real = False
-    
-    cursor.execute("SELECT id, dataAtualizacao FROM licitacoes WHERE numeroControlePNCP = %s", (licitacao_db_parcial['numeroControlePNCP'],))
-    row_existente = cursor.fetchone()
-    api_data_att_str = licitacao_db_parcial.get('dataAtualizacao')
-    if api_data_att_str:
-        # Substitui 'Z' (UTC) por '+00:00' para que o fromisoformat funcione universalmente
-        api_data_att_dt = datetime.fromisoformat(api_data_att_str.replace('Z', '+00:00'))
-    else:
-        api_data_att_dt = None
-
-    # --- INÍCIO DA CORREÇÃO DO UNBOUNDLOCALERROR ---
-    # Inicializamos a variável com um valor padrão ANTES do bloco condicional.
-    db_data_att_dt = None
-    # --- FIM DA CORREÇÃO ---
-
-    if row_existente:
-        # Já existe → pega ID
-        licitacao_id_local_final = row_existente['id']
-        # Comparar datas de atualização para ver se houve mudança real
-        db_data_att_val = row_existente['dataAtualizacao']
-
-        logger.info(f"REGITRO_NO_BANCO_ENCONTRADO ({pncp_id}): Registro já existe. API data: {api_data_att_dt}, DB data: {db_data_att_dt}")
-
-        # O valor do banco agora será um objeto datetime.
-        if isinstance(db_data_att_val, datetime):
-            db_data_att_dt = db_data_att_val
-        elif isinstance(db_data_att_val, str): # Fallback para o caso de algum valor ser string
-             try:
-                db_data_att_dt = datetime.fromisoformat(db_data_att_val.replace('Z', '+00:00'))
-             except (ValueError, TypeError):
-                db_data_att_dt = None
-        
-        # Vou deixar essa parte so para ter certeza que deu certo ------
-        # Converter db_data_att_val para date
-        #if isinstance(db_data_att_val, datetime):
-        #    db_data_att_dt = db_data_att_val.date()
-        #elif isinstance(db_data_att_val, date):
-        #    db_data_att_dt = db_data_att_val
-        #elif isinstance(db_data_att_val, str):
-        #    try:
-        #        db_data_att_dt = datetime.strptime(db_data_att_val, '%Y-%m-%d').date()
-        #    except (ValueError, TypeError):
-        #        db_data_att_dt = None # Trata data mal formatada no banco
-        #else:
-        #    db_data_att_dt = None # Já era o padrão, mas deixamos explícito
-
-
-        # Só marca como "mudou" se a API tiver data mais recente
-        if api_data_att_dt and (not db_data_att_dt or api_data_att_dt > db_data_att_dt):
-            flag_houve_mudanca_real = True
-            logger.info(f"OLHANDO_O_BANCO ({pncp_id}): API é MAIS RECENTE. Marcado para ATUALIZAR.")
-        else:
-            logger.debug(f"OLHANDO_O_BANCO ({pncp_id}): DB já está atualizado. PULANDO salvamento principal.")
-    else:
-        # Não existe no banco → é nova
-        flag_houve_mudanca_real = True # Nova licitação, considera como mudança
-        logger.info(f"OLHANDO_O_BANCO ({pncp_id}): Registro NOVO. Marcado para INSERIR.")
+# Colunas de cada grupo (com o próprio hash). 'dados' = todo o resto, menos a chave e as COLUNAS_SEMPRE_ATUALIZADAS.
+COLUNAS_GRUPO_LICITACAO = {
+    'texto': COLUNAS_TEXTO_FTS + ('hashTexto',),
+    'dados': tuple(
+        col for col in COLUNAS_LICITACAO
+        if col not in COLUNAS_TEXTO_FTS + COLUNAS_SEMPRE_ATUALIZADAS + ('numeroControlePNCP', 'hashTexto')
+    ),
+}
+_SQL_UPSERT_POR_GRUPOS = {} # frozenset(grupos) -> (colunas, início do SQL, placeholders de uma linha, fim do SQL)
+
+def _sql_upsert_grupos(grupos):
+    if grupos not in _SQL_UPSERT_POR_GRUPOS:
+        colunas = tuple(
+            col for col in COLUNAS_LICITACAO
+            if col == 'numeroControlePNCP' or col in COLUNAS_SEMPRE_ATUALIZADAS
+            or any(col in COLUNAS_GRUPO_LICITACAO[grupo] for grupo in grupos)
+        )
+        _SQL_UPSERT_POR_GRUPOS[grupos] = (
+            colunas,
+            f"INSERT INTO licitacoes ({', '.join(f'`{col}`' for col in colunas)}) VALUES ",
+            '(' + ', '.join(['%s'] * len(colunas)) + ')',
+            " ON DUPLICATE KEY UPDATE " + ', '.join(f'`{col}` = VALUES(`{col}`)' for col in colunas if col != 'numeroControlePNCP'),
+        )
+    return _SQL_UPSERT_POR_GRUPOS[grupos]
 
-    # --- Buscar Itens (SEMPRE que houver mudança ou for nova, OU se não tiver itens e quisermos popular) ---    
-    itens_da_licitacao_api = [] # Lista de itens buscados da API
-    necessita_buscar_itens = False
-    if flag_houve_mudanca_real:
-        necessita_buscar_itens = True
-    elif licitacao_id_local_final: # Se já existe no DB mas não houve mudança na dataAtualizacao
-        # CORREÇÃO: Adicionado alias 'AS total' e acesso por chave de dicionário.
-        cursor.execute("SELECT COUNT(id) AS total FROM itens_licitacao WHERE licitacao_id = %s", (licitacao_id_local_final,))
-        resultado = cursor.fetchone()
-        # CORREÇÃO: Verifica se o resultado não é None e acessa pela chave 'total'.
-        if resultado and resultado['total'] == 0:
-            necessita_buscar_itens = True # Se não há itens, busca para popular
-
-
-    if necessita_buscar_itens and licitacao_db_parcial['orgaoEntidadeCnpj'] and licitacao_db_parcial['anoCompra'] and licitacao_db_parcial['sequencialCompra'] is not None:
-        logger.info(f"INFO (save_db): Iniciando busca de ITENS para {licitacao_db_parcial['numeroControlePNCP']} (para definir situacaoReal e salvar)")
-        # fetch_all_itens_for_licitacao agora SÓ BUSCA e retorna a lista de itens da API
-        # O salvamento dos itens será feito DEPOIS de salvar a licitação principal.
-        itens_brutos_api = fetch_all_itens_for_licitacao_APENAS_BUSCA(
-            licitacao_db_parcial['orgaoEntidadeCnpj'], 
-            licitacao_db_parcial['anoCompra'], 
-            licitacao_db_parcial['sequencialCompra']
+def grupos_alterados(licitacao_db, estado):
+    """
+    Grupos de colunas a regravar numa licitação que já está no banco (frozenset, pode ser vazio), ou None para
+    gravar a linha inteira (licitação nova). Hash NULL (linha de antes da migração) conta como mudança.
+    """
+    if not estado['existe']:
+        return None
+    return frozenset(
+        grupo for grupo, coluna_hash in (('texto', 'hashTexto'), ('dados', 'hashDados'))
+        if estado['hashes'].get(coluna_hash) is None or estado['hashes'][coluna_hash] != licitacao_db.get(coluna_hash)
+    )
+
+def contar_grupos_regravados(lista_grupos):
+    """Métrica por grupo regravado: 'linha_inteira' (nova) ou 'nenhum' (só as COLUNAS_SEMPRE_ATUALIZADAS)."""
+    for grupos in lista_grupos:
+        if grupos is None:
+            metricas.contar('licitacoes_grupos_regravados_total', grupo='linha_inteira')
+        elif not grupos:
+            metricas.contar('licitacoes_grupos_regravados_total', grupo='nenhum')
+        for grupo in grupos or ():
+            metricas.contar('licitacoes_grupos_regravados_total', grupo=grupo)
+
+def montar_sql_upsert_licitacoes(quantidade_linhas, grupos=None):
+    """
+    INSERT ... ON DUPLICATE KEY UPDATE de 'licitacoes' com 'quantidade_linhas' linhas no VALUES.
+    Com 'grupos' (ver grupos_alterados), só a chave, as COLUNAS_SEMPRE_ATUALIZADAS e as colunas desses grupos.
+    """
+    if grupos is None:
+        return _SQL_UPSERT_LICITACOES_INICIO + ', '.join([_PLACEHOLDERS_LINHA_LICITACAO] * quantidade_linhas) + _SQL_UPSERT_LICITACOES_FIM
+    _, inicio, placeholders, fim = _sql_upsert_grupos(grupos)
+    return inicio + ', '.join([placeholders] * quantidade_linhas) + fim
+
+def parametros_upsert_licitacao(licitacao_db, grupos=None):
+    """Valores de uma licitação (já com situacaoReal) na ordem de COLUNAS_LICITACAO (ou das colunas dos 'grupos')."""
+    colunas = COLUNAS_LICITACAO if grupos is None else _sql_upsert_grupos(grupos)[0]
+    return tuple(licitacao_db.get(col) for col in colunas)
+
+def tem_chaves_subrecursos(licitacao_db_parcial):
+    """True se a licitação tem CNPJ, ano e sequencial, necessários para montar as URLs de itens e arquivos."""
+    return bool(
+        licitacao_db_parcial.get('orgaoEntidadeCnpj') and licitacao_db_parcial.get('anoCompra')
+        and licitacao_db_parcial.get('sequencialCompra') is not None
+    )
+
+# Estado de uma página inteira em UMA consulta: id, dataAtualizacao e contagem de itens/arquivos de cada licitação.
+SQL_ESTADO_LICITACOES = """
+    SELECT l.id, l.numeroControlePNCP, l.dataAtualizacao, l.assinaturaDocumental, l.hashTexto, l.hashDados, l.enriquecimentoPendente,
+           l.hashItens, l.hashArquivos,
+           (SELECT COUNT(*) FROM itens_licitacao i WHERE i.licitacao_id = l.id) AS total_itens,
+           (SELECT COUNT(*) FROM arquivos_licitacao a WHERE a.licitacao_id = l.id) AS total_arquivos
+    FROM licitacoes l
+    WHERE l.numeroControlePNCP IN ({})"""
+
+def _para_datetime(valor):
+    """dataAtualizacao (datetime do banco ou string ISO da API, com ou sem 'Z') -> datetime, ou None."""
+    if isinstance(valor, datetime):
+        return valor
+    if isinstance(valor, str):
+        try:
+            # Substitui 'Z' (UTC) por '+00:00' para que o fromisoformat funcione universalmente
+            return datetime.fromisoformat(valor.replace('Z', '+00:00'))
+        except (ValueError, TypeError):
+            return None
+    return None
+
+# Decide, olhando o banco, se cada licitação da página mudou e se itens/arquivos precisam ser buscados na API
+def avaliar_estado_pagina(cursor, licitacoes_db, logar=True):
+    """
+    Compara a dataAtualizacao da API com a do banco e verifica se faltam itens/arquivos, para a página inteira
+    com UMA consulta (SQL_ESTADO_LICITACOES). Retorna {numeroControlePNCP: estado}, onde estado tem:
+    licitacao_id (None se nova), existe, mudou, buscar_itens, buscar_arquivos.
+    'cursor' precisa ser dictionary=True. 'logar=False' é usado pelo estágio de enriquecimento para não duplicar logs.
+    """
+    pncp_ids = list(dict.fromkeys(lic['numeroControlePNCP'] for lic in licitacoes_db if lic.get('numeroControlePNCP')))
+    if not pncp_ids:
+        return {}
+    cursor.execute(SQL_ESTADO_LICITACOES.format(', '.join(['%s'] * len(pncp_ids))), tuple(pncp_ids))
+    rows_existentes = {row['numeroControlePNCP']: row for row in cursor.fetchall()}
+
+    estados = {}
+    for licitacao_db_parcial in licitacoes_db:
+        pncp_id = licitacao_db_parcial.get('numeroControlePNCP')
+        if not pncp_id:
+            continue
+        row_existente = rows_existentes.get(pncp_id)
+        api_data_att_dt = _para_datetime(licitacao_db_parcial.get('dataAtualizacao'))
+        flag_houve_mudanca_real = False
+        buscar_itens = buscar_arquivos = False
+        desatualizada = False
+
+        if row_existente:
+            db_data_att_dt = _para_datetime(row_existente['dataAtualizacao'])
+            desatualizada = bool(api_data_att_dt and db_data_att_dt and api_data_att_dt < db_data_att_dt)
+            if logar:
+                logger.info(f"REGITRO_NO_BANCO_ENCONTRADO ({pncp_id}): Registro já existe. API data: {api_data_att_dt}, DB data: {row_existente['dataAtualizacao']}")
+            # Só marca como "mudou" se a API tiver data mais recente
+            if api_data_att_dt and (not db_data_att_dt or api_data_att_dt > db_data_att_dt):
+                flag_houve_mudanca_real = True
+                if logar:
+                    logger.info(f"OLHANDO_O_BANCO ({pncp_id}): API é MAIS RECENTE. Marcado para ATUALIZAR.")
+                # Mudou só o que não tem relação com documentos (e os arquivos já estão no banco): não busca arquivos de novo
+                buscar_arquivos = not (
+                    PULAR_ARQUIVOS_SEM_MUDANCA_DOCUMENTAL and row_existente['total_arquivos'] > 0
+                    and row_existente['assinaturaDocumental'] == licitacao_db_parcial.get('assinaturaDocumental')
+                    and not row_existente['enriquecimentoPendente'] & PENDENTE_ARQUIVOS
+                )
+                if logar and not buscar_arquivos:
+                    logger.debug(f"OLHANDO_O_BANCO ({pncp_id}): Cabeçalho sem mudança documental. PULANDO busca de arquivos.")
+            else:
+                if logar:
+                    logger.debug(f"OLHANDO_O_BANCO ({pncp_id}): DB já está atualizado. PULANDO salvamento principal.")
+                # Não mudou: itens/arquivos só são buscados se ainda não existem no banco ou ficaram pendentes
+                # de uma versão anterior (enriquecimento em fila que não chegou a gravar)
+                buscar_itens = row_existente['total_itens'] == 0 or bool(row_existente['enriquecimentoPendente'] & PENDENTE_ITENS)
+                buscar_arquivos = row_existente['total_arquivos'] == 0 or bool(row_existente['enriquecimentoPendente'] & PENDENTE_ARQUIVOS)
+                if logar and buscar_arquivos:
+                    logger.info(f"INFO (ARQUIVOS): Licitação {pncp_id} (ID: {row_existente['id']}) sem arquivos no banco. Marcando para buscar arquivos")
+        else:
+            # Não existe no banco → é nova
+            flag_houve_mudanca_real = True # Nova licitação, considera como mudança
+            buscar_arquivos = True
+            if logar:
+                logger.info(f"OLHANDO_O_BANCO ({pncp_id}): Registro NOVO. Marcado para INSERIR.")
+
+        # Itens: SEMPRE que houver mudança ou for nova. Arquivos: decididos acima.
+        estados[pncp_id] = {
+            'licitacao_id': row_existente['id'] if row_existente else None,
+            'existe': row_existente is not None,
+            'mudou': flag_houve_mudanca_real,
+            'desatualizada': desatualizada, # Banco tem versão mais nova que a da API (ou do arquivo bruto)
+            'buscar_itens': flag_houve_mudanca_real or buscar_itens,
+            'buscar_arquivos': buscar_arquivos,
+            'total_itens': row_existente['total_itens'] if row_existente else 0,
+            'total_arquivos': row_existente['total_arquivos'] if row_existente else 0,
+            'hashes': {col: row_existente[col] for col in ('hashTexto', 'hashDados', 'hashItens', 'hashArquivos')} if row_existente else {},
+            'pendente': row_existente['enriquecimentoPendente'] if row_existente else 0, # Bits PENDENTE_ITENS/ARQUIVOS
+        }
+    return estados
+
+def avaliar_estado_licitacao(cursor, licitacao_db_parcial, logar=True):
+    """Estado de UMA licitação (mesmo formato de avaliar_estado_pagina). Usado pela gravação individual."""
+    return avaliar_estado_pagina(cursor, [licitacao_db_parcial], logar)[licitacao_db_parcial.get('numeroControlePNCP')]
+
+def precisa_gravar(estado):
+    """False quando a licitação não mudou e já tem itens e arquivos no banco: nada a fazer nela."""
+    return estado['mudou'] or estado['buscar_itens'] or estado['buscar_arquivos']
+
+# Enriquecimento pendente (licitacoes.enriquecimentoPendente, bits): marcado na MESMA transação do cabeçalho quando
+# itens/arquivos ficam para a fila, e limpo por quem os grava. Enquanto a marca existir, avaliar_estado_pagina manda
+# buscar de novo, mesmo com a dataAtualizacao já em dia: Redis fora do ar ao enfileirar, sync morto entre o commit e o
+# enfileiramento ou job que esgotou as retentativas não deixam a licitação com itens/arquivos velhos para sempre.
+PENDENTE_ITENS = 1
+PENDENTE_ARQUIVOS = 2
+
+def bits_pendentes(buscar_itens, buscar_arquivos):
+    return (PENDENTE_ITENS if buscar_itens else 0) | (PENDENTE_ARQUIVOS if buscar_arquivos else 0)
+
+def marcar_enriquecimento_pendente(cursor, bits_por_pncp_id):
+    """Acrescenta as marcas {numeroControlePNCP: bits}. Um UPDATE por combinação de bits. Retorna os comandos SQL."""
+    por_bits = {}
+    for pncp_id, bits in bits_por_pncp_id.items():
+        if bits:
+            por_bits.setdefault(bits, []).append(pncp_id)
+    for bits, pncp_ids in por_bits.items():
+        cursor.execute(
+            f"UPDATE licitacoes SET enriquecimentoPendente = enriquecimentoPendente | %s "
+            f"WHERE numeroControlePNCP IN ({', '.join(['%s'] * len(pncp_ids))})",
+            (bits, *pncp_ids)
         )
-        if itens_brutos_api is None: # Se a busca de itens falhou criticamente
-            logger.error(f"ITENS_FETCH_FAIL: Falha crítica ao buscar itens para {licitacao_db_parcial['numeroControlePNCP']}. A licitação pode ficar inconsistente.")
-            logar_falha_persistente(
-                "licitacao_itens_fetch_error",
-                licitacao_api_item, # Loga a licitação principal
-                f"Falha crítica ao buscar itens para PNCP ID {licitacao_db_parcial['numeroControlePNCP']}."
-            )            
-            return None # Para abortar o processamento desta licitação
-        elif itens_brutos_api:
-            itens_da_licitacao_api = itens_brutos_api
-            # Guardamos para usar na lógica de situacaoReal e para salvar depois
-    
-    # --- LÓGICA PARA DEFINIR licitacao_db_parcial['situacaoReal'] ---
+    return len(por_bits)
+
+def limpar_enriquecimento_pendente(cursor, bits_por_licitacao_id):
+    """Tira as marcas {licitacao_id: bits} de itens/arquivos que acabaram de ser gravados. Retorna os comandos SQL."""
+    por_bits = {}
+    for licitacao_id, bits in bits_por_licitacao_id.items():
+        if bits:
+            por_bits.setdefault(bits, []).append(licitacao_id)
+    for bits, licitacao_ids in por_bits.items():
+        cursor.execute(
+            f"UPDATE licitacoes SET enriquecimentoPendente = enriquecimentoPendente & ~%s "
+            f"WHERE id IN ({', '.join(['%s'] * len(licitacao_ids))})",
+            (bits, *licitacao_ids)
+        )
+    return len(por_bits)
+
+# --- LÓGICA PARA DEFINIR a 'situacaoReal' ---
+def calcular_situacao_real(licitacao_db_parcial, itens_da_licitacao_api):
+    """Calcula a situacaoReal (status do Radar) a partir do status da API, das datas e do status do primeiro item."""
     hoje_date = date.today()
     data_encerramento_str = licitacao_db_parcial.get('dataEncerramentoProposta')
     status_compra_api = licitacao_db_parcial.get('situacaoCompraId')
@@ -617,7 +1470,6 @@ def  save_licitacao_to_db(conn, licitacao_api_item):
                         # Se o status do primeiro item NÃO for "em andamento" e NÃO for um dos que encerram,
                         # ele se torna "Em Julgamento/Propostas Encerradas"
                         situacao_real_calculada = "Em Julgamento/Propostas Encerradas"
-                        # status_item_para_julgamento = itens_da_licitacao_api[0].get('situacaoCompraItemNome') # Não usado, pode remover
                         encerra_por_item_ou_julgamento = True
                 else: # Se o primeiro item não tem 'situacaoCompraItemNome'
                     # O que fazer aqui? Por enquanto, não define encerra_por_item_ou_julgamento, então a lógica abaixo baseada em datas será usada.
@@ -649,45 +1501,102 @@ def  save_licitacao_to_db(conn, licitacao_api_item):
         # vai usar o 'situacao_real_calculada = "Desconhecida"' inicial.
         # Se você espera mais casos, precisa tratar outros status_compra_api.
 
-    licitacao_db_parcial['situacaoReal'] = situacao_real_calculada
-    # --- FIM DA LÓGICA situacaoReal ---
+    return situacao_real_calculada
+# --- FIM DA LÓGICA situacaoReal ---
 
 
-    # SQL UPSERT para MariaDB (INSERT ... ON DUPLICATE KEY UPDATE)
-    colunas = licitacao_db_parcial.keys()
-    placeholders = ', '.join(['%s'] * len(colunas))
-    colunas_str = ', '.join(f'`{col}`' for col in colunas)
-    
-    updates_str = ', '.join([f'`{col}` = VALUES(`{col}`)' for col in colunas if col != 'numeroControlePNCP'])
+def  save_licitacao_to_db(conn, licitacao_api_item, enriquecimento=None): 
+    """
+    Grava (UPSERT) uma licitação e, quando necessário, seus itens e arquivos. Não faz commit.
+    'enriquecimento' (opcional) traz itens/arquivos já buscados pelo estágio assíncrono:
+    {'itens': [...] ou None, 'arquivos': [...] ou None}. Chave ausente = buscar aqui mesmo, de forma síncrona.
+    """
+    # >>> PASSO DE VALIDAÇÃO INICIAL <<<
+    if not validar_dados_licitacao_api(licitacao_api_item):
+        logar_falha_persistente("licitacao_principal", licitacao_api_item, "Falha na validação inicial dos dados.")
+        metricas.contar('licitacoes_total', resultado='invalida')
+        return None # Pula o processamento desta licitação
     
-    sql_upsert_licitacao = f"""
-    INSERT INTO licitacoes ({colunas_str})
-    VALUES ({placeholders})
-    ON DUPLICATE KEY UPDATE {updates_str}
-    """  
+    # MODIFICADO: Usar 'dictionary=True' para acessar colunas por nome
+    cursor = conn.cursor(dictionary=True)
+    pncp_id = licitacao_api_item.get('numeroControlePNCP') # Pega o ID para usar nos logs
+    enriquecimento = enriquecimento or {}
+      
+    # Mapeamento de licitacao_db 
+    licitacao_db_parcial = mapear_licitacao_api_para_db(licitacao_api_item)
+
+    # --- Determinar flag_houve_mudanca_real e obter licitacao_id_local_existente ---
+    # Esta flag e o ID são importantes para decidir se buscamos itens/arquivos e para o UPSERT.
+    with metricas.medir('db_segundos', etapa='estado'):
+        estado = avaliar_estado_licitacao(cursor, licitacao_db_parcial)
+    licitacao_id_local_final = estado['licitacao_id']
+    flag_houve_mudanca_real = estado['mudou']
+
+    # --- Buscar Itens (SEMPRE que houver mudança ou for nova, OU se não tiver itens e quisermos popular) ---    
+    itens_da_licitacao_api = [] # Lista de itens buscados da API
+    necessita_buscar_itens = estado['buscar_itens']
+
+    if necessita_buscar_itens and tem_chaves_subrecursos(licitacao_db_parcial):
+        if 'itens' in enriquecimento:
+            # Já buscados (em paralelo) pelo estágio de enriquecimento da página
+            itens_brutos_api = enriquecimento['itens']
+        else:
+            logger.info(f"INFO (save_db): Iniciando busca de ITENS para {licitacao_db_parcial['numeroControlePNCP']} (para definir situacaoReal e salvar)")
+            # fetch_all_itens_for_licitacao agora SÓ BUSCA e retorna a lista de itens da API
+            # O salvamento dos itens será feito DEPOIS de salvar a licitação principal.
+            itens_brutos_api = fetch_all_itens_for_licitacao_APENAS_BUSCA(
+                licitacao_db_parcial['orgaoEntidadeCnpj'], 
+                licitacao_db_parcial['anoCompra'], 
+                licitacao_db_parcial['sequencialCompra']
+            )
+        if itens_brutos_api is None: # Se a busca de itens falhou criticamente
+            logger.error(f"ITENS_FETCH_FAIL: Falha crítica ao buscar itens para {licitacao_db_parcial['numeroControlePNCP']}. A licitação pode ficar inconsistente.")
+            logar_falha_persistente(
+                "licitacao_itens_fetch_error",
+                licitacao_api_item, # Loga a licitação principal
+                f"Falha crítica ao buscar itens para PNCP ID {licitacao_db_parcial['numeroControlePNCP']}."
+            )            
+            metricas.contar('licitacoes_total', resultado='falha')
+            return None # Para abortar o processamento desta licitação
+        elif itens_brutos_api:
+            itens_da_licitacao_api = itens_brutos_api
+            # Guardamos para usar na lógica de situacaoReal e para salvar depois
     
+    with metricas.medir('situacao_real_segundos'):
+        licitacao_db_parcial['situacaoReal'] = calcular_situacao_real(licitacao_db_parcial, itens_da_licitacao_api)
+
+    # Completada agora com itens (ex: gravada antes pela via rápida): regrava o cabeçalho por causa da situacaoReal
+    if estado['existe'] and itens_da_licitacao_api and not estado['desatualizada']:
+        flag_houve_mudanca_real = True
+
     try:
         if flag_houve_mudanca_real:
-            # Prepara os parâmetros como uma tupla na ordem correta
-            params = tuple(licitacao_db_parcial.values())
-            cursor.execute(sql_upsert_licitacao, params)
+            # SQL UPSERT para MariaDB (INSERT ... ON DUPLICATE KEY UPDATE), com os parâmetros na ordem de COLUNAS_LICITACAO
+            grupos = grupos_alterados(licitacao_db_parcial, estado) # Existente: só os grupos de colunas que mudaram
+            with metricas.medir('db_segundos', etapa='upsert'):
+                cursor.execute(montar_sql_upsert_licitacoes(1, grupos), parametros_upsert_licitacao(licitacao_db_parcial, grupos))
+            metricas.contar('comandos_sql_total')
+            contar_grupos_regravados([grupos])
 
             logger.debug(f"SALVANDO ({pncp_id}): UPSERT executado.")
             
             # Lógica para obter o ID após INSERT ou UPDATE
             if cursor.lastrowid:
                 licitacao_id_local_final = cursor.lastrowid
+                metricas.contar('licitacoes_total', resultado='nova')
                 logger.info(f"INFO (SAVE_DB): Licitação {licitacao_db_parcial['numeroControlePNCP']} INSERIDA. ID: {licitacao_id_local_final}.")
             else:
                 # Se foi um UPDATE, precisamos buscar o ID
                 cursor.execute("SELECT id FROM licitacoes WHERE numeroControlePNCP = %s", (licitacao_db_parcial['numeroControlePNCP'],))
                 id_row = cursor.fetchone()
+                metricas.contar('comandos_sql_total')
+                metricas.contar('licitacoes_total', resultado='atualizada' if estado['mudou'] else 'completada')
                 if id_row: 
                     licitacao_id_local_final = id_row['id']
                     logger.info(f"INFO (SAVE_DB): Licitação {licitacao_db_parcial['numeroControlePNCP']} ATUALIZADA. ID: {licitacao_id_local_final}.")
 
-        elif row_existente:
-            licitacao_id_local_final = row_existente['id'] # Em MariaDB, o resultado é uma tupla
+        elif estado['existe']:
+            metricas.contar('licitacoes_total', resultado='completada' if precisa_gravar(estado) else 'sem_mudanca')
             logger.info(f"INFO (SAVE_DB): Licitação {licitacao_db_parcial['numeroControlePNCP']} já atualizada. ID: {licitacao_id_local_final}.")
 
     except mysql.connector.Error as err:
@@ -697,6 +1606,7 @@ def  save_licitacao_to_db(conn, licitacao_api_item):
             licitacao_api_item,
             f"Erro MariaDB durante UPSERT: {err}"
         )
+        metricas.contar('licitacoes_total', resultado='falha')
         cursor.close()
         return None
         
@@ -705,61 +1615,58 @@ def  save_licitacao_to_db(conn, licitacao_api_item):
         return None 
 
     # --- SALVAR ITENS E ARQUIVOS (usando licitacao_id_local_final e os itens_da_licitacao_api) ---
-    # Somente se houve mudança real ou se os itens não existiam antes (essa lógica de "não existiam antes" foi feita para buscar_sub_detalhes)
-    # A flag_houve_mudanca_real já cobre o caso de ser novo ou atualizado.
-    # Se não houve mudança e os itens já existem, podemos pular o re-salvamento deles se não mudaram.
-    # Mas para garantir consistência com 'situacaoReal', talvez seja bom sempre processar itens se 'flag_houve_mudanca_real'
-    # ou se 'necessita_buscar_itens' era true.
-    
+    # Somente se houve mudança real ou se os itens não existiam antes (decidido em avaliar_estado_licitacao).
     if necessita_buscar_itens and itens_da_licitacao_api: # Se buscamos e obtivemos itens
-        salvar_itens_no_banco(conn, licitacao_id_local_final, itens_da_licitacao_api) # Nova função para apenas salvar
+        with metricas.medir('db_segundos', etapa='itens'):
+            salvar_itens_no_banco(conn, licitacao_id_local_final, itens_da_licitacao_api) # Nova função para apenas salvar
+
+    pendente_gravado = PENDENTE_ITENS if necessita_buscar_itens else 0 # Daqui em diante os itens já foram buscados
 
     # --- SALVAR ARQUIVOS (se necessário) ---
-    necessita_buscar_arquivos = False # Definir uma flag para arquivos
-    if flag_houve_mudanca_real: # Se a licitação principal mudou
-        necessita_buscar_arquivos = True
-    elif licitacao_id_local_final: # Se a licitação já existe no DB
-        # Verificamos se já existem arquivos para ela no banco
-        # Se não existirem, marcamos para buscar para saber se há arquivos na API dessa vez
-        cursor.execute("SELECT COUNT(id) as total FROM arquivos_licitacao WHERE licitacao_id = %s", (licitacao_id_local_final,))
-        resultado_contagem = cursor.fetchone()
-        if resultado_contagem and resultado_contagem['total'] == 0:
-            necessita_buscar_arquivos = True
-            logger.info(f"INFO (ARQUIVOS): Licitação {licitacao_db_parcial['numeroControlePNCP']} (ID: {licitacao_id_local_final}) sem arquivos no banco. Marcando para buscar itens")
-
-    if necessita_buscar_arquivos:
+    if estado['buscar_arquivos']:
         # Verifica se temos os dados necessários para formar a URL da API de arquivos
         cnpj_lic = licitacao_db_parcial.get('orgaoEntidadeCnpj')
         ano_lic = licitacao_db_parcial.get('anoCompra')
         seq_lic = licitacao_db_parcial.get('sequencialCompra')
 
-        if cnpj_lic and ano_lic and seq_lic is not None:
-            # 1. Busca todos os metadados dos arquivos da API
-            lista_arquivos_metadata = fetch_all_arquivos_metadata_from_api(
-                cnpj_lic,
-                ano_lic,
-                seq_lic
-            )
+        if tem_chaves_subrecursos(licitacao_db_parcial):
+            # 1. Busca todos os metadados dos arquivos da API (ou usa os que o enriquecimento já trouxe)
+            if 'arquivos' in enriquecimento:
+                lista_arquivos_metadata = enriquecimento['arquivos']
+            else:
+                lista_arquivos_metadata = fetch_all_arquivos_metadata_from_api(
+                    cnpj_lic,
+                    ano_lic,
+                    seq_lic
+                )
 
             # 2. Se a busca de metadados foi bem-sucedida (não retornou None)
             #    e temos um ID local para a licitação, então salvamos no banco.
             if lista_arquivos_metadata is not None and licitacao_id_local_final is not None:
-                salvar_arquivos_no_banco(
-                    conn, # A conexão com o banco
-                    licitacao_id_local_final, # O ID da licitação no nosso banco
-                    lista_arquivos_metadata, # A lista de metadados que acabamos de buscar
-                    cnpj_lic, # CNPJ da licitação (para montar o link de download)
-                    ano_lic,  # Ano da licitação
-                    seq_lic   # Sequencial da licitação
-                )
+                with metricas.medir('db_segundos', etapa='arquivos'):
+                    salvar_arquivos_no_banco(
+                        conn, # A conexão com o banco
+                        licitacao_id_local_final, # O ID da licitação no nosso banco
+                        lista_arquivos_metadata, # A lista de metadados que acabamos de buscar
+                        cnpj_lic, # CNPJ da licitação (para montar o link de download)
+                        ano_lic,  # Ano da licitação
+                        seq_lic   # Sequencial da licitação
+                    )
+                pendente_gravado |= PENDENTE_ARQUIVOS
             elif lista_arquivos_metadata is None:
                 logger.error(f"AVISO (ARQUIVOS): Não foi possível buscar metadados de arquivos para Lic. ID {licitacao_id_local_final}, salvamento de arquivos pulado.")
+                # Zera a assinatura documental para que o próximo sync busque os arquivos de novo
+                cursor.execute("UPDATE licitacoes SET assinaturaDocumental = NULL WHERE id = %s", (licitacao_id_local_final,))
         else:
             logger.error(f"AVISO (ARQUIVOS): Dados insuficientes (CNPJ, Ano, Sequencial) para buscar arquivos da licitação {licitacao_db_parcial.get('numeroControlePNCP')}.")
+
+    if estado['pendente'] & pendente_gravado:
+        limpar_enriquecimento_pendente(cursor, {licitacao_id_local_final: estado['pendente'] & pendente_gravado})
     
     return licitacao_id_local_final # A função continua retornando o ID da licitação
 
 # Nova função para buscar itens sem salvar (para desacoplar)
+@metricas.medir('busca_subrecursos_segundos', tipo='itens')
 def fetch_all_itens_for_licitacao_APENAS_BUSCA(cnpj_orgao, ano_compra, sequencial_compra):
     todos_itens_api = []
     pagina_atual_itens = 1
@@ -774,11 +1681,618 @@ def fetch_all_itens_for_licitacao_APENAS_BUSCA(cnpj_orgao, ano_compra, sequencia
         todos_itens_api.extend(itens_pagina)
         if len(itens_pagina) < TAMANHO_PAGINA_SYNC: break
         pagina_atual_itens += 1
-        time.sleep(0.2)
     logger.info(f"ITENS (Busca): Total de {len(todos_itens_api)} itens encontrados para {cnpj_orgao}/{ano_compra}/{sequencial_compra}.")
+    arquivar_resposta_bruta('itens', {'chave': chave_subrecursos_arquivo_bruto(cnpj_orgao, ano_compra, sequencial_compra)}, todos_itens_api)
     return todos_itens_api
 
 
+# ======= GRAVAÇÃO EM LOTE DE UMA PÁGINA =======
+def _executemany_em_lotes(cursor, sql, tuplas):
+    """executemany em blocos de TAMANHO_LOTE_INSERCAO_DB linhas. Retorna quantos comandos foram enviados ao banco."""
+    comandos = 0
+    for inicio in range(0, len(tuplas), TAMANHO_LOTE_INSERCAO_DB):
+        cursor.executemany(sql, tuplas[inicio:inicio + TAMANHO_LOTE_INSERCAO_DB])
+        comandos += 1
+    return comandos
+
+def salvar_pagina_licitacoes_em_lote(conn, licitacoes_data, enriquecimentos=None, regravar=False, pendentes_enriquecimento=None):
+    """
+    Versão em lote do save_licitacao_to_db para uma página inteira. Não faz commit.
+    Todas as licitações novas/alteradas vão em UM upsert multi-linha, os IDs das novas são resolvidos em UMA consulta,
+    e itens/arquivos do lote são regravados com um DELETE ... IN (...) e poucos executemany.
+    'regravar=True' (replay do arquivo bruto) regrava mesmo sem dataAtualizacao nova, exceto por cima de versão mais nova.
+    Com 'pendentes_enriquecimento' (lista), itens/arquivos NÃO são buscados: as licitações que precisam deles entram na
+    lista como (numeroControlePNCP, buscar_itens, buscar_arquivos), para a fila de enriquecimento depois do commit, e ficam
+    marcadas em enriquecimentoPendente na mesma transação.
+    Retorna o número de comandos SQL enviados ao banco (para medir os round trips por página).
+    """
+    enriquecimentos = enriquecimentos or {}
+    comandos_sql = 0
+    registros = {} # numeroControlePNCP -> dados da licitação (se repetir na página, vale a última)
+    inalteradas = set() # Sem mudança e completas: puladas sem mais nenhum acesso ao banco
+
+    cursor = conn.cursor(dictionary=True)
+    try:
+        # 1. Validação, mapeamento e decisão do que precisa ser gravado/buscado (UMA consulta para a página)
+        validas = []
+        for lic_api in licitacoes_data:
+            if not validar_dados_licitacao_api(lic_api):
+                logar_falha_persistente("licitacao_principal", lic_api, "Falha na validação inicial dos dados.")
+                continue
+            validas.append((lic_api, mapear_licitacao_api_para_db(lic_api)))
+        with metricas.medir('db_segundos', etapa='estado'):
+            estados = avaliar_estado_pagina(cursor, [lic_db for _, lic_db in validas])
+        if validas:
+            comandos_sql += 1
+        for lic_api, lic_db in validas:
+            estado = estados[lic_db['numeroControlePNCP']]
+            if regravar and not estado['desatualizada']:
+                # Re-derivação: itens sempre (entram na situacaoReal); arquivos só se vieram no arquivo bruto
+                estado.update(mudou=True, buscar_itens=True,
+                              buscar_arquivos=estado['buscar_arquivos'] or 'arquivos' in (enriquecimentos.get(lic_db['numeroControlePNCP']) or {}))
+            if not precisa_gravar(estado):
+                # Sem mudança e completa (já tem itens e arquivos): nenhum trabalho a mais no banco
+                inalteradas.add(lic_db['numeroControlePNCP'])
+                continue
+            registros[lic_db['numeroControlePNCP']] = {
+                'api': lic_api, 'db': lic_db, 'estado': estado, 'itens': [], 'arquivos': None,
+                'hash_itens': None, 'hash_arquivos': None, # Hash da lista da API (busca paginada do enriquecimento)
+            }
+
+        # 2a. Enriquecimento em fila: só o cabeçalho é gravado aqui. A situacaoReal das já existentes usa o primeiro
+        # item que está no banco (a definitiva é recalculada pelo job, com os itens novos)
+        if pendentes_enriquecimento is not None:
+            itens_no_banco = primeiro_item_no_banco(cursor, [reg['estado']['licitacao_id'] for reg in registros.values() if reg['estado']['licitacao_id']])
+            if itens_no_banco:
+                comandos_sql += 1
+            for pncp_id, reg in registros.items():
+                lic_db, estado = reg['db'], reg['estado']
+                if (estado['buscar_itens'] or estado['buscar_arquivos']) and tem_chaves_subrecursos(lic_db):
+                    pendentes_enriquecimento.append((pncp_id, estado['buscar_itens'], estado['buscar_arquivos']))
+                    reg['pendente'] = bits_pendentes(estado['buscar_itens'], estado['buscar_arquivos'])
+                with metricas.medir('situacao_real_segundos'):
+                    lic_db['situacaoReal'] = calcular_situacao_real(lic_db, itens_no_banco.get(estado['licitacao_id'], []))
+
+        # 2. Itens/arquivos: usa o que o enriquecimento já trouxe; o que faltar é buscado aqui, de forma síncrona
+        for pncp_id, reg in list(registros.items()):
+            if pendentes_enriquecimento is not None:
+                break
+            lic_db, estado = reg['db'], reg['estado']
+            enriquecimento = enriquecimentos.get(pncp_id) or {}
+            if estado['buscar_itens'] and tem_chaves_subrecursos(lic_db):
+                if 'itens' in enriquecimento:
+                    itens = enriquecimento['itens']
+                    reg['hash_itens'] = enriquecimento.get('itens_hash')
+                else:
+                    itens = fetch_all_itens_for_licitacao_APENAS_BUSCA(lic_db['orgaoEntidadeCnpj'], lic_db['anoCompra'], lic_db['sequencialCompra'])
+                if itens is None:
+                    logger.error(f"ITENS_FETCH_FAIL: Falha crítica ao buscar itens para {pncp_id}. A licitação pode ficar inconsistente.")
+                    logar_falha_persistente("licitacao_itens_fetch_error", reg['api'], f"Falha crítica ao buscar itens para PNCP ID {pncp_id}.")
+                    metricas.contar('licitacoes_total', resultado='falha')
+                    del registros[pncp_id] # Mesmo comportamento do save_licitacao_to_db: aborta esta licitação
+                    continue
+                if not isinstance(itens, list):
+                    logger.error(f"SALVANDO_ITENS: ERRO DE TIPO DE DADO. Esperava uma lista, recebeu {type(itens)}. Licitação {pncp_id}.")
+                    itens = []
+                reg['itens'] = itens
+            with metricas.medir('situacao_real_segundos'):
+                lic_db['situacaoReal'] = calcular_situacao_real(lic_db, reg['itens'])
+
+            if estado['buscar_arquivos']:
+                if not tem_chaves_subrecursos(lic_db):
+                    logger.error(f"AVISO (ARQUIVOS): Dados insuficientes (CNPJ, Ano, Sequencial) para buscar arquivos da licitação {pncp_id}.")
+                elif 'arquivos' in enriquecimento:
+                    reg['arquivos'] = enriquecimento['arquivos']
+                    reg['hash_arquivos'] = enriquecimento.get('arquivos_hash')
+                else:
+                    reg['arquivos'] = fetch_all_arquivos_metadata_from_api(lic_db['orgaoEntidadeCnpj'], lic_db['anoCompra'], lic_db['sequencialCompra'])
+                if tem_chaves_subrecursos(lic_db) and reg['arquivos'] is None:
+                    logger.error(f"AVISO (ARQUIVOS): Não foi possível buscar metadados de arquivos para {pncp_id}, salvamento de arquivos pulado.")
+                    lic_db['assinaturaDocumental'] = None # Força buscar os arquivos de novo no próximo sync
+
+        # 3. UPSERT multi-linha das licitações novas/alteradas. Licitação completada agora com itens (ex: gravada
+        # antes pela via rápida) também regrava o cabeçalho: a situacaoReal depende dos itens.
+        alterados = [
+            reg for reg in registros.values()
+            if reg['estado']['mudou'] or (reg['itens'] and reg['estado']['buscar_itens'] and not reg['estado']['desatualizada'])
+        ]
+        # Um UPSERT multi-linha por combinação de grupos alterados (novas: linha inteira; existentes: só o que mudou)
+        por_grupos = {}
+        for reg in alterados:
+            reg['grupos'] = grupos_alterados(reg['db'], reg['estado'])
+            por_grupos.setdefault(reg['grupos'], []).append(reg)
+        contar_grupos_regravados(reg['grupos'] for reg in alterados)
+        for grupos, regs_grupo in por_grupos.items():
+            try:
+                with metricas.medir('db_segundos', etapa='upsert'):
+                    cursor.execute(
+                        montar_sql_upsert_licitacoes(len(regs_grupo), grupos),
+                        tuple(valor for reg in regs_grupo for valor in parametros_upsert_licitacao(reg['db'], grupos))
+                    )
+                comandos_sql += 1
+            except mysql.connector.errors.OperationalError:
+                raise
+            except mysql.connector.Error as err:
+                # Uma linha ruim derruba o comando inteiro: isola regravando uma a uma
+                logger.error(f"LOTE_DB: UPSERT em lote de {len(regs_grupo)} licitações falhou ({err}). Gravando uma a uma.")
+                sql_uma_linha = montar_sql_upsert_licitacoes(1, grupos)
+                for reg in regs_grupo:
+                    try:
+                        cursor.execute(sql_uma_linha, parametros_upsert_licitacao(reg['db'], grupos))
+                        comandos_sql += 1
+                    except mysql.connector.errors.OperationalError:
+                        raise
+                    except mysql.connector.Error as err_linha:
+                        logger.exception(f"SAVE_DB: Erro MariaDB ao salvar principal {reg['db']['numeroControlePNCP']}: {err_linha}")
+                        logar_falha_persistente("licitacao_principal_db_error", reg['api'], f"Erro MariaDB durante UPSERT: {err_linha}")
+                        metricas.contar('licitacoes_total', resultado='falha')
+                        del registros[reg['db']['numeroControlePNCP']]
+
+        # 4. IDs das licitações recém-inseridas, todos em UMA consulta
+        sem_id = [pncp_id for pncp_id, reg in registros.items() if not reg['estado']['licitacao_id']]
+        if sem_id:
+            with metricas.medir('db_segundos', etapa='ids'):
+                cursor.execute(
+                    f"SELECT id, numeroControlePNCP FROM licitacoes WHERE numeroControlePNCP IN ({', '.join(['%s'] * len(sem_id))})",
+                    tuple(sem_id)
+                )
+            comandos_sql += 1
+            for row in cursor.fetchall():
+                registros[row['numeroControlePNCP']]['estado']['licitacao_id'] = row['id']
+
+        # 4a. Fila: a marca de pendente vai no mesmo commit do cabeçalho (o job a limpa quando gravar)
+        if pendentes_enriquecimento is not None:
+            comandos_sql += marcar_enriquecimento_pendente(cursor, {pncp_id: reg.get('pendente', 0) for pncp_id, reg in registros.items()})
+
+        # 5. Itens e arquivos do lote inteiro
+        iguais_no_banco = 0
+        itens_por_licitacao = {}
+        arquivos_por_licitacao = {}
+        hashes_itens = {}
+        hashes_arquivos = {}
+        pendentes_gravados = {} # licitacao_id -> bits de enriquecimento pendente resolvidos nesta página
+        for pncp_id, reg in registros.items():
+            licitacao_id = reg['estado']['licitacao_id']
+            if not licitacao_id:
+                logger.critical(f"AVISO CRÍTICO (SAVE_DB): Falha ao obter ID local para {pncp_id}")
+                continue
+            estado = reg['estado']
+            if estado['pendente'] and pendentes_enriquecimento is None:
+                pendentes_gravados[licitacao_id] = estado['pendente'] & bits_pendentes(estado['buscar_itens'], reg['arquivos'] is not None)
+            if reg['itens']:
+                # Mesma lista que a última gravação commitada (hash no banco): nada a gravar
+                if reg['hash_itens'] and reg['hash_itens'] == estado['hashes'].get('hashItens'):
+                    iguais_no_banco += 1
+                else:
+                    tuplas = montar_tuplas_itens(licitacao_id, reg['itens'])
+                    if tuplas:
+                        itens_por_licitacao[licitacao_id] = tuplas
+                        hashes_itens[licitacao_id] = reg['hash_itens']
+            if reg['arquivos']:
+                lic_db = reg['db']
+                if reg['hash_arquivos'] and reg['hash_arquivos'] == estado['hashes'].get('hashArquivos'):
+                    iguais_no_banco += 1
+                else:
+                    tuplas = montar_tuplas_arquivos(licitacao_id, reg['arquivos'], lic_db['orgaoEntidadeCnpj'], lic_db['anoCompra'], lic_db['sequencialCompra'])
+                    if tuplas:
+                        arquivos_por_licitacao[licitacao_id] = tuplas
+                        hashes_arquivos[licitacao_id] = reg['hash_arquivos']
+        if itens_por_licitacao:
+            with metricas.medir('db_segundos', etapa='itens'):
+                comandos_sql += sincronizar_itens(cursor, itens_por_licitacao, hashes_itens)
+        if arquivos_por_licitacao:
+            with metricas.medir('db_segundos', etapa='arquivos'):
+                comandos_sql += sincronizar_arquivos(cursor, arquivos_por_licitacao, hashes_arquivos)[0]
+        if pendentes_gravados:
+            comandos_sql += limpar_enriquecimento_pendente(cursor, pendentes_gravados)
+    finally:
+        cursor.close()
+
+    novas = sum(1 for reg in registros.values() if not reg['estado']['existe'])
+    atualizadas = sum(1 for reg in registros.values() if reg['estado']['existe'] and reg['estado']['mudou'])
+    completadas = len(registros) - novas - atualizadas
+    for resultado, quantidade in (('nova', novas), ('atualizada', atualizadas), ('completada', completadas),
+                                  ('sem_mudanca', len(inalteradas)), ('invalida', len(licitacoes_data) - len(validas))):
+        if quantidade:
+            metricas.contar('licitacoes_total', quantidade, resultado=resultado)
+    metricas.contar('comandos_sql_total', comandos_sql)
+    logger.info(
+        f"LOTE_DB: {len(licitacoes_data)} licitações na página ({novas} novas, {atualizadas} atualizadas, "
+        f"{completadas} completadas com itens/arquivos, {len(inalteradas)} sem mudança) gravadas com {comandos_sql} comandos SQL. "
+        f"{iguais_no_banco} listas de itens/arquivos iguais às do banco (hash) puladas."
+    )
+    return comandos_sql
+
+
+
+# ======= FILA DE ENRIQUECIMENTO (rq + Redis): itens e arquivos fora da transação da página =======
+# Com SYNC_ENRIQUECIMENTO_FILA=1 o sync grava só os cabeçalhos (a vazão passa a depender só das páginas da listagem)
+# e, depois do commit da página, enfileira um job por licitação que precisa de itens/arquivos. Os jobs rodam no
+# worker_enriquecimento.py: mais vazão = mais processos/máquinas apontando para o mesmo Redis.
+# job_id determinístico por licitação: no máximo um job esperando e um em execução (pedidos repetidos são absorvidos).
+# Redis fora do ar no início da execução = itens/arquivos buscados pelo próprio sync, como antes.
+ENRIQUECIMENTO_EM_FILA = os.getenv('SYNC_ENRIQUECIMENTO_FILA', '0') == '1'
+REDIS_URL_SYNC = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+NOME_FILA_ENRIQUECIMENTO = 'enriquecimento_pncp'
+INTERVALOS_RETRY_ENRIQUECIMENTO = [30, 120, 300, 900, 1800] # Segundos entre as retentativas do job (o worker sobe com scheduler)
+TIMEOUT_JOB_ENRIQUECIMENTO = 600 # Licitação com milhares de itens pode levar minutos
+TTL_RESULTADO_ENRIQUECIMENTO = 3600
+TTL_FALHA_ENRIQUECIMENTO = 7 * 24 * 3600 # Jobs que esgotaram as retentativas ficam na FailedJobRegistry por uma semana
+_STATUS_JOB_ESPERANDO = (JobStatus.QUEUED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+_fila_enriquecimento = None # None = ainda não verificada; False = desligada ou Redis indisponível nesta execução
+_lock_fila_enriquecimento = threading.Lock()
+_conn_job_enriquecimento = None # Conexão reaproveitada entre os jobs do mesmo processo worker
+
+def get_fila_enriquecimento():
+    """Fila rq do enriquecimento, ou None se desligada/Redis indisponível (o Redis é testado uma vez por execução)."""
+    global _fila_enriquecimento
+    if not ENRIQUECIMENTO_EM_FILA:
+        return None
+    if _fila_enriquecimento is None:
+        with _lock_fila_enriquecimento:
+            if _fila_enriquecimento is None:
+                try:
+                    conexao = Redis.from_url(REDIS_URL_SYNC)
+                    conexao.ping()
+                    _fila_enriquecimento = Queue(NOME_FILA_ENRIQUECIMENTO, connection=conexao)
+                    logger.info(f"FILA_ENRIQUECIMENTO: Itens e arquivos serão enfileirados em '{NOME_FILA_ENRIQUECIMENTO}' ({REDIS_URL_SYNC}).")
+                except RedisError as e:
+                    logger.error(f"FILA_ENRIQUECIMENTO: Redis indisponível em {REDIS_URL_SYNC} ({e}). Itens e arquivos serão buscados pelo próprio sync nesta execução.")
+                    _fila_enriquecimento = False
+    return _fila_enriquecimento or None
+
+def id_job_enriquecimento(pncp_id, seguinte=False):
+    """job_id determinístico da licitação. 'seguinte' = job que espera o que está em execução terminar."""
+    job_id = 'enriquecer-' + pncp_id.replace(':', '-') # rq não aceita ':' no id
+    return job_id + '-seguinte' if seguinte else job_id
+
+def primeiro_item_no_banco(cursor, licitacao_ids):
+    """{licitacao_id: [{'situacaoCompraItemNome': ...}]} com o primeiro item gravado de cada licitação (para a situacaoReal)."""
+    if not licitacao_ids:
+        return {}
+    cursor.execute(
+        "SELECT i.licitacao_id, i.situacaoCompraItemNome FROM itens_licitacao i "
+        "JOIN (SELECT MIN(id) AS id FROM itens_licitacao WHERE licitacao_id IN (" + ", ".join(["%s"] * len(licitacao_ids)) + ") "
+        "GROUP BY licitacao_id) primeiros ON primeiros.id = i.id",
+        tuple(licitacao_ids)
+    )
+    return {row['licitacao_id']: [{'situacaoCompraItemNome': row['situacaoCompraItemNome']}] for row in cursor.fetchall()}
+
+def _enfileirar_enriquecimento(fila, pncp_id, buscar_itens, buscar_arquivos):
+    """Enfileira o job da licitação, com deduplicação pelo job_id. Retorna 'enfileirado' ou 'absorvido'."""
+    for seguinte in (False, True):
+        job_id = id_job_enriquecimento(pncp_id, seguinte)
+        job = fila.fetch_job(job_id)
+        status = job.get_status(refresh=False) if job else None
+        if status in _STATUS_JOB_ESPERANDO:
+            # Já há um job esperando: ele vai buscar os dados atuais no PNCP. Só amplia o que ele deve buscar.
+            if (buscar_itens and not job.kwargs.get('buscar_itens')) or (buscar_arquivos and not job.kwargs.get('buscar_arquivos')):
+                job.kwargs = dict(job.kwargs, buscar_itens=job.kwargs.get('buscar_itens') or buscar_itens,
+                                  buscar_arquivos=job.kwargs.get('buscar_arquivos') or buscar_arquivos)
+                job.save()
+            return 'absorvido'
+        if status == JobStatus.STARTED:
+            continue # Em execução (talvez com dados antigos): o pedido vai para o job '-seguinte'
+        if job:
+            job.delete() # Terminado/falho: sai dos registros do rq antes de reaproveitar o id
+        fila.enqueue(
+            'sync_api.enriquecer_licitacao_enfileirada', # Pelo nome: o sync roda como __main__
+            kwargs={'pncp_id': pncp_id, 'buscar_itens': bool(buscar_itens), 'buscar_arquivos': bool(buscar_arquivos)},
+            job_id=job_id, retry=Retry(max=len(INTERVALOS_RETRY_ENRIQUECIMENTO), interval=INTERVALOS_RETRY_ENRIQUECIMENTO),
+            job_timeout=TIMEOUT_JOB_ENRIQUECIMENTO, result_ttl=TTL_RESULTADO_ENRIQUECIMENTO, failure_ttl=TTL_FALHA_ENRIQUECIMENTO,
+            description=f"Itens/arquivos de {pncp_id}",
+        )
+        return 'enfileirado'
+    return 'absorvido' # Um em execução e outro esperando: nada a acrescentar
+
+def enfileirar_enriquecimentos(pendentes):
+    """
+    Enfileira os jobs das licitações de uma página JÁ commitada: [(numeroControlePNCP, buscar_itens, buscar_arquivos)].
+    Erro no Redis não desfaz a página: a marca enriquecimentoPendente (gravada no commit da página) faz o próximo sync
+    pedir os itens/arquivos dessas licitações de novo.
+    """
+    fila = get_fila_enriquecimento()
+    contagens = {'enfileirado': 0, 'absorvido': 0, 'erro': 0}
+    for pncp_id, buscar_itens, buscar_arquivos in pendentes:
+        try:
+            contagens[_enfileirar_enriquecimento(fila, pncp_id, buscar_itens, buscar_arquivos)] += 1
+        except RedisError as e:
+            logger.error(f"FILA_ENRIQUECIMENTO: Não foi possível enfileirar {pncp_id}: {e}")
+            contagens['erro'] += 1
+    for resultado, quantidade in contagens.items():
+        if quantidade:
+            metricas.contar('jobs_enriquecimento_total', quantidade, resultado=resultado)
+    logger.info(f"FILA_ENRIQUECIMENTO: {contagens['enfileirado']} jobs enfileirados, {contagens['absorvido']} já pendentes, {contagens['erro']} erros.")
+    return contagens
+
+# Publicação do que os jobs mudam: a situacaoReal definitiva (calculada com os itens) muda as buscas e contagens da API.
+# Cada processo worker acumula as licitações alteradas e uma thread publica (agregados + geração) no máximo uma vez a
+# cada INTERVALO_PUBLICACAO_ENRIQUECIMENTO segundos somando todos os workers (trava no Redis que só vence, sem liberar).
+# O que sobrou do último intervalo é publicado na volta seguinte da thread, ou na saída do worker de processo único
+# (com --processos > 1, a próxima publicação de qualquer sync ou worker cobre o que ficou).
+INTERVALO_PUBLICACAO_ENRIQUECIMENTO = int(os.getenv('SYNC_ENRIQUECIMENTO_INTERVALO_PUBLICACAO', '60')) # Segundos
+CHAVE_TRAVA_PUBLICACAO_ENRIQUECIMENTO = 'radar:trava_publicacao_enriquecimento'
+_alteracoes_enriquecimento = 0
+_lock_alteracoes_enriquecimento = threading.Lock()
+_thread_publicacao_enriquecimento = None
+
+def registrar_alteracao_enriquecimento():
+    """Chamar depois do commit de um job que mudou o que a API mostra (situacaoReal)."""
+    global _alteracoes_enriquecimento, _thread_publicacao_enriquecimento
+    with _lock_alteracoes_enriquecimento:
+        _alteracoes_enriquecimento += 1
+        if _thread_publicacao_enriquecimento is None:
+            _thread_publicacao_enriquecimento = threading.Thread(
+                target=_publicar_alteracoes_enriquecimento_periodicamente, name='publicacao_enriquecimento', daemon=True
+            )
+            _thread_publicacao_enriquecimento.start()
+
+def publicar_alteracoes_enriquecimento(forcar=False):
+    """Publica as alterações acumuladas pelos jobs deste processo. 'forcar' ignora o intervalo (saída do worker)."""
+    global _alteracoes_enriquecimento
+    if not _alteracoes_enriquecimento:
+        return
+    if not forcar and adquirir_trava(CHAVE_TRAVA_PUBLICACAO_ENRIQUECIMENTO, INTERVALO_PUBLICACAO_ENRIQUECIMENTO) is None:
+        return # Outro worker publicou há pouco (ou o Redis não respondeu): fica para a próxima volta
+    with _lock_alteracoes_enriquecimento:
+        alteracoes, _alteracoes_enriquecimento = _alteracoes_enriquecimento, 0
+    logger.info(f"FILA_ENRIQUECIMENTO: Publicando {alteracoes} licitações com situacaoReal alterada pelos jobs.")
+    publicar_alteracoes_dados(alteracoes)
+
+def _publicar_alteracoes_enriquecimento_periodicamente():
+    while True:
+        time.sleep(INTERVALO_PUBLICACAO_ENRIQUECIMENTO)
+        try:
+            publicar_alteracoes_enriquecimento()
+        except Exception:
+            logger.exception("FILA_ENRIQUECIMENTO: Erro ao publicar as alterações dos jobs. Tentando de novo na próxima volta.")
+
+def _limpar_pendente_do_job(cursor, licitacao, bits):
+    # Só se o cabeçalho ainda é o que o job leu: se um sync gravou versão mais nova no meio, a marca dela fica
+    # (o job '-seguinte' a limpa; se ele não chegou a ser enfileirado, o próximo sync pede de novo)
+    cursor.execute(
+        "UPDATE licitacoes SET enriquecimentoPendente = enriquecimentoPendente & ~%s WHERE id = %s AND dataAtualizacao <=> %s",
+        (bits, licitacao['id'], licitacao['dataAtualizacao'])
+    )
+
+def enriquecer_licitacao_enfileirada(pncp_id, buscar_itens=True, buscar_arquivos=True):
+    """
+    Job rq (worker_enriquecimento.py): busca e grava itens e/ou arquivos de UMA licitação já gravada pelo sync
+    e recalcula a situacaoReal com os itens. Levanta exceção em falha da API ou do banco, para o rq retentar.
+    """
+    global _conn_job_enriquecimento
+    _conn_job_enriquecimento = conn = garantir_conexao_ativa(_conn_job_enriquecimento)
+    if not conn:
+        raise RuntimeError("Sem conexão com o banco de dados")
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(
+            "SELECT id, numeroControlePNCP, orgaoEntidadeCnpj, anoCompra, sequencialCompra, situacaoCompraId, "
+            "dataAberturaProposta, dataEncerramentoProposta, dataAtualizacao, situacaoReal FROM licitacoes WHERE numeroControlePNCP = %s",
+            (pncp_id,)
+        )
+        licitacao = cursor.fetchone()
+        if not licitacao:
+            logger.warning(f"FILA_ENRIQUECIMENTO: Licitação {pncp_id} não está no banco. Job ignorado.")
+            conn.rollback()
+            return 'ausente'
+        cnpj, ano, sequencial = licitacao['orgaoEntidadeCnpj'], licitacao['anoCompra'], licitacao['sequencialCompra']
+
+        if buscar_itens:
+            itens = fetch_all_itens_for_licitacao_APENAS_BUSCA(cnpj, ano, sequencial)
+            if itens is None:
+                raise RuntimeError(f"Falha ao buscar os itens de {pncp_id}")
+            with metricas.medir('db_segundos', etapa='itens'):
+                salvar_itens_no_banco(conn, licitacao['id'], itens)
+            # calcular_situacao_real espera as datas no formato da API (texto ISO)
+            lic_db = {chave: valor.isoformat() if isinstance(valor, datetime) else valor for chave, valor in licitacao.items()}
+            situacao_real = calcular_situacao_real(lic_db, itens)
+            situacao_mudou = situacao_real != licitacao['situacaoReal']
+            if situacao_mudou:
+                cursor.execute("UPDATE licitacoes SET situacaoReal = %s WHERE id = %s", (situacao_real, licitacao['id']))
+            _limpar_pendente_do_job(cursor, licitacao, PENDENTE_ITENS)
+            conn.commit()
+            if situacao_mudou:
+                registrar_alteracao_enriquecimento() # Itens ficam gravados mesmo se os arquivos falharem (a retentativa acha o diff vazio)
+
+        if buscar_arquivos:
+            arquivos = fetch_all_arquivos_metadata_from_api(cnpj, ano, sequencial)
+            if arquivos is None:
+                # Como no sync: força buscar os arquivos de novo, mesmo se este job esgotar as retentativas
+                cursor.execute("UPDATE licitacoes SET assinaturaDocumental = NULL WHERE id = %s", (licitacao['id'],))
+                conn.commit()
+                raise RuntimeError(f"Falha ao buscar os arquivos de {pncp_id}")
+            with metricas.medir('db_segundos', etapa='arquivos'):
+                salvar_arquivos_no_banco(conn, licitacao['id'], arquivos, cnpj, ano, sequencial)
+            _limpar_pendente_do_job(cursor, licitacao, PENDENTE_ARQUIVOS)
+            conn.commit()
+        return 'ok'
+    except Exception:
+        try:
+            conn.rollback()
+        except mysql.connector.Error:
+            pass
+        raise
+    finally:
+        cursor.close()
+# --- Fim da Fila de Enriquecimento ---
+
+
+# ======= ENRIQUECIMENTO ASSÍNCRONO (itens + arquivos de uma página inteira em paralelo) =======
+# Cada thread (principal ou worker do modo concorrente) mantém seu próprio event loop e seu AsyncClient,
+# para reaproveitar as conexões keep-alive entre páginas. Os pares (loop, cliente) são fechados no fim da execução.
+_estado_async = threading.local()
+_loops_enriquecimento = []
+_lock_loops_enriquecimento = threading.Lock()
+
+def _executar_no_loop_da_thread(coro_factory):
+    """Roda a corrotina criada por coro_factory(cliente) no event loop desta thread."""
+    if getattr(_estado_async, 'loop', None) is None:
+        _estado_async.loop = asyncio.new_event_loop()
+        _estado_async.cliente = None
+    loop = _estado_async.loop
+
+    async def _com_cliente():
+        if _estado_async.cliente is None:
+            _estado_async.cliente = httpx.AsyncClient(
+                headers={'Accept': 'application/json'},
+                timeout=httpx.Timeout(TIMEOUT_SUBRECURSOS_PNCP, connect=TIMEOUT_CONEXAO_PNCP),
+                limits=httpx.Limits(
+                    max_connections=LIMITE_CONCORRENCIA_ENRIQUECIMENTO,
+                    max_keepalive_connections=LIMITE_CONCORRENCIA_ENRIQUECIMENTO
+                ),
+            )
+            with _lock_loops_enriquecimento:
+                _loops_enriquecimento.append((loop, _estado_async.cliente))
+        return await coro_factory(_estado_async.cliente)
+
+    return loop.run_until_complete(_com_cliente())
+
+def fechar_enriquecimento_async(somente_desta_thread=False):
+    """
+    Fecha os AsyncClients e event loops criados pelas threads (chamado no fim da sincronização).
+    Com somente_desta_thread=True fecha apenas o par da thread atual (ex: fim do estágio de enriquecimento do pipeline).
+    """
+    loop_atual = getattr(_estado_async, 'loop', None)
+    with _lock_loops_enriquecimento:
+        if somente_desta_thread:
+            pares = [par for par in _loops_enriquecimento if par[0] is loop_atual]
+        else:
+            pares = list(_loops_enriquecimento)
+        for par in pares:
+            _loops_enriquecimento.remove(par)
+    if somente_desta_thread or loop_atual is not None:
+        _estado_async.__dict__.clear()
+    for loop, cliente in pares:
+        try:
+            loop.run_until_complete(cliente.aclose())
+            loop.close()
+        except Exception as e:
+            logger.warning(f"ENRIQUECIMENTO_ASYNC: Erro ao fechar cliente assíncrono: {e}")
+
+@api_retry_decorator_async
+async def _buscar_pagina_subrecurso_async(cliente, semaforo, url, pagina):
+    """
+    Busca UMA página de itens ou arquivos (mesmo tratamento de erros de fetch_itens_from_api), com requisição
+    condicional ao cache. Retorna (dados, hash_conteudo) ou None em falha não retentável.
+    """
+    params = {'pagina': pagina, 'tamanhoPagina': TAMANHO_PAGINA_SYNC}
+    async with semaforo: # Limita as requisições simultâneas da página inteira
+        try:
+            chave_cache, entrada_cache, cabecalhos = preparar_busca_subrecurso(url, params)
+            await limitador_pncp.aguardar_async()
+            inicio = time.monotonic()
+            try:
+                response = await cliente.get(url, params=params, headers=cabecalhos)
+            except httpx.TransportError:
+                limitador_pncp.registrar_falha_rede()
+                metricas.contar('http_falhas_rede_total', tipo='subrecurso')
+                raise
+            latencia = time.monotonic() - inicio
+            limitador_pncp.registrar_resposta(response.status_code, latencia, 'subrecurso', response.headers.get('Retry-After'))
+            metricas.observar('http_requisicao_segundos', latencia, tipo='subrecurso')
+            metricas.contar('http_respostas_total', tipo='subrecurso', status=response.status_code)
+            if response.status_code != 304: # httpx trata 304 como erro no raise_for_status
+                response.raise_for_status()
+            return resolver_resposta_subrecurso(chave_cache, entrada_cache, response.status_code, response.headers, response.content)
+        except httpx.HTTPStatusError as http_err:
+            if should_retry_httpx_error(http_err):
+                logger.warning(f"ENRIQUECIMENTO_ASYNC: Erro HTTP retentável {http_err.response.status_code} em {url}. Deixando tenacity tratar.")
+                raise
+            logger.error(f"ENRIQUECIMENTO_ASYNC: Erro HTTP NÃO RETENTÁVEL em {url} (pág {pagina}): {http_err}")
+            return None
+        except httpx.TransportError as net_err:
+            logger.warning(f"ENRIQUECIMENTO_ASYNC: Erro de rede retentável ({type(net_err).__name__}) em {url}. Deixando tenacity tratar.")
+            raise
+        except Exception:
+            logger.exception(f"ENRIQUECIMENTO_ASYNC: Erro GERAL INESPERADO em {url} (pág {pagina})")
+            return None
+
+async def _buscar_todas_paginas_subrecurso_async(cliente, semaforo, url):
+    """
+    Percorre a paginação de itens ou arquivos. Retorna (lista completa, hash da lista) ou None em falha crítica.
+    O hash da lista combina os hashes de todas as páginas (comparado com licitacoes.hashItens/hashArquivos).
+    """
+    todos = []
+    pagina = 1
+    hash_lista = hashlib.sha256()
+    while True:
+        try:
+            resultado = await _buscar_pagina_subrecurso_async(cliente, semaforo, url, pagina)
+        except tenacity.RetryError as e:
+            logger.error(f"ENRIQUECIMENTO_ASYNC: Todas as retentativas falharam para {url} (pág {pagina}). Causa final: {e}")
+            return None
+        if resultado is None:
+            return None
+        dados_pagina, hash_pagina = resultado
+        hash_lista.update(hash_pagina.encode('ascii'))
+        if not dados_pagina:
+            break
+        todos.extend(dados_pagina)
+        if len(dados_pagina) < TAMANHO_PAGINA_SYNC:
+            break
+        pagina += 1
+    return todos, hash_lista.hexdigest()
+
+async def _enriquecer_licitacao_async(cliente, semaforo, alvo):
+    """Busca itens e/ou arquivos de UMA licitação, os dois ao mesmo tempo."""
+    lic_db = alvo['licitacao_db']
+    base_url = f"{API_BASE_URL_PNCP_API}/v1/orgaos/{lic_db['orgaoEntidadeCnpj']}/compras/{lic_db['anoCompra']}/{lic_db['sequencialCompra']}"
+    buscas = {}
+    if alvo['buscar_itens']:
+        buscas['itens'] = _buscar_todas_paginas_subrecurso_async(cliente, semaforo, f"{base_url}/itens")
+    if alvo['buscar_arquivos']:
+        buscas['arquivos'] = _buscar_todas_paginas_subrecurso_async(cliente, semaforo, f"{base_url}/arquivos")
+    resultados = await asyncio.gather(*buscas.values(), return_exceptions=True)
+    enriquecimento = {}
+    for chave, resultado in zip(buscas, resultados):
+        if isinstance(resultado, BaseException):
+            logger.error(f"ENRIQUECIMENTO_ASYNC: Erro inesperado buscando {chave} de {lic_db['numeroControlePNCP']}: {resultado!r}")
+            resultado = None
+        if resultado is not None:
+            arquivar_resposta_bruta(chave, {'chave': chave_subrecursos_arquivo_bruto(lic_db['orgaoEntidadeCnpj'], lic_db['anoCompra'], lic_db['sequencialCompra'])}, resultado[0])
+        # 'itens_hash'/'arquivos_hash': igual ao do banco = mesma lista já gravada, permite pular a gravação
+        enriquecimento[chave], enriquecimento[f'{chave}_hash'] = resultado if resultado is not None else (None, None)
+    return lic_db['numeroControlePNCP'], enriquecimento
+
+def enriquecer_pagina_async(conn, licitacoes_data):
+    """
+    Estágio de enriquecimento de uma página: descobre (no banco) quais licitações precisam de itens/arquivos
+    e busca todos eles em paralelo, limitado por LIMITE_CONCORRENCIA_ENRIQUECIMENTO.
+    Retorna {numeroControlePNCP: {'itens': [...]/None, 'arquivos': [...]/None}} para passar ao save_licitacao_to_db.
+    """
+    alvos = []
+    candidatas = []
+    for lic_api in licitacoes_data:
+        lic_db = mapear_licitacao_api_para_db(lic_api)
+        # Licitações inválidas são tratadas (e logadas) na gravação; aqui só ignoramos.
+        if lic_db.get('numeroControlePNCP') and lic_db.get('dataAtualizacao') and tem_chaves_subrecursos(lic_db):
+            candidatas.append(lic_db)
+    cursor = conn.cursor(dictionary=True)
+    try:
+        estados = avaliar_estado_pagina(cursor, candidatas, logar=False)
+    finally:
+        cursor.close()
+    for lic_db in candidatas:
+        estado = estados[lic_db['numeroControlePNCP']]
+        if estado['buscar_itens'] or estado['buscar_arquivos']:
+            alvos.append({'licitacao_db': lic_db, 'buscar_itens': estado['buscar_itens'], 'buscar_arquivos': estado['buscar_arquivos']})
+
+    if not alvos:
+        return {}
+
+    async def _enriquecer_todas(cliente):
+        semaforo = asyncio.Semaphore(LIMITE_CONCORRENCIA_ENRIQUECIMENTO)
+        return await asyncio.gather(*(_enriquecer_licitacao_async(cliente, semaforo, alvo) for alvo in alvos))
+
+    inicio = time.monotonic()
+    resultados = _executar_no_loop_da_thread(_enriquecer_todas)
+    duracao = time.monotonic() - inicio
+    metricas.observar('enriquecimento_pagina_segundos', duracao)
+    logger.info(f"ENRIQUECIMENTO_ASYNC: Itens/arquivos de {len(alvos)} licitações buscados em paralelo em {duracao:.2f}s.")
+    return dict(resultados)
+
 
 # Função defensiva para extrair valores primitivos (Valores primitivos é str, int, float, bool, None)
 def get_primitive_value(data, key, sub_key='nome'):
@@ -800,33 +2314,24 @@ def get_primitive_value(data, key, sub_key='nome'):
     logger.warning(f"SALVANDO_ITENS: Valor inesperado do tipo {type(value)} para a chave '{key}'. Convertendo para None. Valor: {value}")
     return None
 
-# Função que salva os itens no banco de dados
-def salvar_itens_no_banco(conn, licitacao_id_local, lista_itens_api):
-    if not lista_itens_api:
-        logger.info(f"SALVANDO_ITENS: Sem itens para salvar para licitação ID {licitacao_id_local}.")
-        return
-
-    if not isinstance(lista_itens_api, list):
-        logger.error(f"SALVANDO_ITENS: ERRO DE TIPO DE DADO. Esperava uma lista, recebeu {type(lista_itens_api)}. Licitação ID: {licitacao_id_local}.")
-        return
-    
-    cursor = conn.cursor()
-    try:
-        logger.debug(f"SALVANDO_ITENS: Limpando itens pré-existentes para licitação ID {licitacao_id_local}.")
-        cursor.execute("DELETE FROM itens_licitacao WHERE licitacao_id = %s", (licitacao_id_local,))
-    except mysql.connector.Error as e:
-        logger.exception(f"SALVANDO_ITENS: Erro MariaDB ao limpar itens antigos (lic_id {licitacao_id_local})")
-        return
-
-    sql_insert_item = """
-    INSERT INTO itens_licitacao (
-        licitacao_id, numeroItem, descricao, materialOuServicoNome, quantidade,
-        unidadeMedida, valorUnitarioEstimado, valorTotal, orcamentoSigiloso,
-        itemCategoriaNome, categoriaItemCatalogo, criterioJulgamentoNome,
-        situacaoCompraItemNome, tipoBeneficioNome, incentivoProdutivoBasico, dataInclusao,
-        dataAtualizacao, temResultado, informacaoComplementar
-    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"""
+# Itens são sincronizados por diferença, e não mais com DELETE + INSERT de tudo:
+# cada item é identificado por (licitacao_id, numeroItem) (UNIQUE uk_item_licitacao) e carrega um hash
+# do seu conteúdo (hashConteudo). Só itens novos/alterados são gravados e só os que sumiram da API são apagados.
+# Requer a migração atualizar_db_sync.sql.
+COLUNAS_ITEM = (
+    'licitacao_id', 'numeroItem', 'descricao', 'materialOuServicoNome', 'quantidade',
+    'unidadeMedida', 'valorUnitarioEstimado', 'valorTotal', 'orcamentoSigiloso',
+    'itemCategoriaNome', 'categoriaItemCatalogo', 'criterioJulgamentoNome',
+    'situacaoCompraItemNome', 'tipoBeneficioNome', 'incentivoProdutivoBasico', 'dataInclusao',
+    'dataAtualizacao', 'temResultado', 'informacaoComplementar', 'hashConteudo'
+)
+SQL_UPSERT_ITEM = (
+    f"INSERT INTO itens_licitacao ({', '.join(COLUNAS_ITEM)}) VALUES ({', '.join(['%s'] * len(COLUNAS_ITEM))})"
+    " ON DUPLICATE KEY UPDATE " + ', '.join(f'{col} = VALUES({col})' for col in COLUNAS_ITEM[2:])
+)
 
+def montar_tuplas_itens(licitacao_id_local, lista_itens_api):
+    """Converte os itens da API nas tuplas de SQL_UPSERT_ITEM (itens sem 'numeroItem' são pulados)."""
     itens_para_inserir = []
     itens_com_dados_invalidos = 0
 
@@ -843,9 +2348,7 @@ def salvar_itens_no_banco(conn, licitacao_id_local, lista_itens_api):
         data_inclusao_str = item_api.get('dataInclusao')
         data_atualizacao_str = item_api.get('dataAtualizacao')
 
-        item_db_tuple = (
-            licitacao_id_local,
-            get_primitive_value(item_api, 'numeroItem'),
+        conteudo_item = (
             get_primitive_value(item_api, 'descricao'),
             get_primitive_value(item_api, 'materialOuServicoNome'),
             get_primitive_value(item_api, 'quantidade'),
@@ -864,30 +2367,103 @@ def salvar_itens_no_banco(conn, licitacao_id_local, lista_itens_api):
             bool(item_api.get('temResultado')),
             get_primitive_value(item_api, 'informacaoComplementar')
         )
+        # numeroItem é VARCHAR no banco: normalizamos para str para casar com o que vem do SELECT
+        item_db_tuple = (licitacao_id_local, str(get_primitive_value(item_api, 'numeroItem'))) + conteudo_item + (calcular_hash_conteudo(conteudo_item),)
         itens_para_inserir.append(item_db_tuple)
 
     if itens_com_dados_invalidos > 0:
         logger.warning(f"SALVANDO_ITENS: {itens_com_dados_invalidos} itens pulados por dados inválidos para lic_id {licitacao_id_local}.")
+    return itens_para_inserir
 
-    if itens_para_inserir:
+def _aplicar_diff_itens(cursor, tuplas_por_licitacao, hashes=None):
+    """
+    Compara os itens da API com os do banco (UM SELECT para todas as licitações) e grava só a diferença:
+    upsert dos novos/alterados e DELETE ... WHERE id IN (...) dos removidos. 'hashes' vai para licitacoes.hashItens.
+    Retorna (comandos_sql, gravados, removidos, iguais). Erros do banco sobem para quem chamou.
+    """
+    ids = list(tuplas_por_licitacao)
+    cursor.execute(
+        f"SELECT id, licitacao_id, numeroItem, hashConteudo FROM itens_licitacao WHERE licitacao_id IN ({', '.join(['%s'] * len(ids))})",
+        tuple(ids)
+    )
+    comandos = 1
+    existentes = {} # (licitacao_id, numeroItem) -> (id, hashConteudo)
+    for row in cursor.fetchall():
+        row = row if isinstance(row, dict) else dict(zip(('id', 'licitacao_id', 'numeroItem', 'hashConteudo'), row))
+        existentes[(row['licitacao_id'], row['numeroItem'])] = (row['id'], row['hashConteudo'])
+
+    para_gravar = {}
+    for tuplas in tuplas_por_licitacao.values():
+        for tupla in tuplas:
+            para_gravar[(tupla[0], tupla[1])] = tupla # Item repetido na API: vale o último
+    ids_removidos = [id_item for chave, (id_item, _) in existentes.items() if chave not in para_gravar]
+    iguais = 0
+    for chave, tupla in list(para_gravar.items()):
+        existente = existentes.get(chave)
+        if existente and existente[1] == tupla[-1]:
+            del para_gravar[chave]
+            iguais += 1
+
+    if ids_removidos:
+        cursor.execute(f"DELETE FROM itens_licitacao WHERE id IN ({', '.join(['%s'] * len(ids_removidos))})", tuple(ids_removidos))
+        comandos += 1
+    if para_gravar:
+        comandos += _executemany_em_lotes(cursor, SQL_UPSERT_ITEM, list(para_gravar.values()))
+    comandos += _gravar_hashes_subrecurso(cursor, 'hashItens', {licitacao_id: (hashes or {}).get(licitacao_id) for licitacao_id in ids})
+    return comandos, len(para_gravar), len(ids_removidos), iguais
+
+def sincronizar_itens(cursor, tuplas_por_licitacao, hashes=None):
+    """
+    Sincroniza por diferença os itens de várias licitações ({licitacao_id: tuplas de montar_tuplas_itens}).
+    Se o lote falhar, tenta licitação por licitação, para que um item ruim não derrube os outros.
+    Retorna quantos comandos foram enviados ao banco.
+    """
+    try:
+        comandos, gravados, removidos, iguais = _aplicar_diff_itens(cursor, tuplas_por_licitacao, hashes)
+        logger.info(f"SALVANDO_ITENS: {len(tuplas_por_licitacao)} licitações: {gravados} itens novos/alterados, {removidos} removidos, {iguais} sem mudança.")
+        return comandos
+    except mysql.connector.errors.OperationalError:
+        raise # Conexão perdida: a página inteira falha e vai para failed_pages.jsonl
+    except mysql.connector.Error as err:
+        if len(tuplas_por_licitacao) == 1:
+            licitacao_id, tuplas = next(iter(tuplas_por_licitacao.items()))
+            logger.exception(f"SALVANDO_ITENS: Erro no Banco de Dados ao sincronizar itens da licitação ID {licitacao_id}")
+            logger.debug(f"SALVANDO_ITENS: Dados que causaram a falha (primeiro item): {tuplas[0]}")
+            logar_falha_persistente("item_api_db_error", {'licitacao_id': licitacao_id, 'primeiro_item': tuplas[0]}, f"Erro MariaDB: {err}")
+            return 0
+        logger.error(f"SALVANDO_ITENS: Falha ao sincronizar itens em lote ({len(tuplas_por_licitacao)} licitações): {err}. Tentando uma licitação por vez.")
+
+    return sum(sincronizar_itens(cursor, {licitacao_id: tuplas}, hashes) for licitacao_id, tuplas in tuplas_por_licitacao.items())
+
+# Função que salva os itens no banco de dados
+def salvar_itens_no_banco(conn, licitacao_id_local, lista_itens_api):
+    if not lista_itens_api:
+        logger.info(f"SALVANDO_ITENS: Sem itens para salvar para licitação ID {licitacao_id_local}.")
+        return
+
+    if not isinstance(lista_itens_api, list):
+        logger.error(f"SALVANDO_ITENS: ERRO DE TIPO DE DADO. Esperava uma lista, recebeu {type(lista_itens_api)}. Licitação ID: {licitacao_id_local}.")
+        return
+
+    itens_para_gravar = montar_tuplas_itens(licitacao_id_local, lista_itens_api)
+    if itens_para_gravar:
+        cursor = conn.cursor()
         try:
-            cursor.executemany(sql_insert_item, itens_para_inserir)
-            logger.info(f"SALVANDO_ITENS: {cursor.rowcount} itens inseridos em lote para licitação ID {licitacao_id_local}.")
-        except mysql.connector.Error as e:
-            logger.exception(f"SALVANDO_ITENS: Erro no Banco de Dados durante executemany para licitação ID {licitacao_id_local}")
-            # Log dos dados problemáticos para depuração
-            logger.debug(f"SALVANDO_ITENS: Dados que causaram a falha (primeiro item): {itens_para_inserir[0]}")
-            # Loga o dado bruto da API no nosso arquivo de DLQ de dados
-            try:
-                logar_falha_persistente("item_api_db_error", lista_itens_api[0], f"InterfaceError: {e}")
-            except Exception as log_err:
-                logger.error(f"Falha ao registrar erro persistente: {log_err}")
+            sincronizar_itens(cursor, {licitacao_id_local: itens_para_gravar})
+        finally:
+            cursor.close()
 
 
     
-# SUGESTÃO 2+5: Função para logar páginas que falharam em um arquivo .jsonl
+# SUGESTÃO 2+5: Função para logar páginas que falharam (fila de reprocessamento)
 def logar_pagina_falha(modalidade, pagina, data_inicio, data_fim, motivo):
-    """Loga os parâmetros de uma página que falhou em um arquivo .jsonl para reprocessamento."""
+    """
+    Registra uma página que falhou na tabela sync_falhas (reprocessada por reprocessar_pag_fail.py).
+    Se o banco não aceitar a gravação, cai para o arquivo failed_pages.jsonl (importado pelo reprocessador).
+    """
+    chave = f"{modalidade}:{pagina}:{data_inicio}:{data_fim}"
+    if registrar_falha_dlq('pagina', chave, motivo, modalidade, pagina, data_inicio, data_fim):
+        return
     try:
         falha = {
             "timestamp": datetime.now().isoformat(),
@@ -898,160 +2474,1359 @@ def logar_pagina_falha(modalidade, pagina, data_inicio, data_fim, motivo):
             "data_fim": data_fim
         }
         # Usamos um arquivo dedicado para facilitar o reprocessamento automático
-        with open("failed_pages.jsonl", "a", encoding='utf-8') as f:
+        with _lock_arquivos_falha, open("failed_pages.jsonl", "a", encoding='utf-8') as f:
             f.write(json.dumps(falha, ensure_ascii=False) + "\n")
     except Exception as e:
         logger.error(f"DLQ_FAIL: Falha ao tentar logar página com erro em failed_pages.jsonl: {e}")
 
-# Função para logar falhas persistentes em um arquivo .jsonl. E para buscar depois.
-def sync_licitacoes_ultima_janela_anual():
-    conn = get_db_connection()
-    if not conn: return
+# Garante que a conexão está ativa antes de cada uso.
+def garantir_conexao_ativa(conn):
+    """
+    Verifica a conexão com 'ping' e, se ela tiver caído, tenta reconectar até 3 vezes com espera progressiva.
+    Retorna uma conexão utilizável ou None se não foi possível restabelecer.
+    """
+    if conn is None:
+        logger.warning("Conexão inexistente. Tentando criar nova conexão...")
+        conn = get_db_connection()
+    else:
+        try:
+            # 'ping(reconnect=False)' apenas verifica, sem tentar reconectar automaticamente.
+            conn.ping(reconnect=False, attempts=1, delay=0)
+        except (mysql.connector.Error, AttributeError) as err:
+            # Se chegar aqui, signica que primeiro deu um falso positivo ou a conexão foi perdida.
+            logger.warning(f"Conexão com o banco perdida ou inválida ({type(err).__name__}). Tentando reconectar...")
+            conn = None
+            for attempt in range(1, 4):
+                conn = get_db_connection()
+                if conn and conn.is_connected():
+                    logger.info(f"Reconexão bem-sucedida (tentativa {attempt}/3).")
+                    break
+                else:
+                    logger.warning(f"Falha ao reconectar (tentativa {attempt}/3). Tentando novamente em {2*attempt}s...")
+                    time.sleep(2 * attempt)
+    if not conn or not conn.is_connected():
+        return None
+    return conn
+
+# Busca UMA página da listagem na API (com o tratamento do erro final do tenacity e registro da falha)
+def buscar_pagina_listagem(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str):
+    """
+    Retorna (licitacoes_data, paginas_restantes). licitacoes_data é None em caso de falha
+    (já registrada em failed_pages.jsonl) e [] quando acabaram os dados.
+    """
+    # --- Bloco de try/except para capturar o erro final do Tenacity ---
+    try:
+        licitacoes_data, paginas_restantes = fetch_licitacoes_por_atualizacao(
+            data_inicio_api_str, data_fim_api_str, modalidade_id_sync, pagina_atual
+        )
+    except tenacity.RetryError as e: # Captura se todas as retentativas falharem
+        logger.error(f"API_RETRY_FAIL: Todas as retentativas falharam para a página {pagina_atual} da modalidade {modalidade_id_sync}. Causa final: {e}")
+        licitacoes_data = None # Trata como falha para a lógica abaixo
+        paginas_restantes = -1 # Apenas para garantir que o fluxo continue
+    # --- Fim do bloco de captura ---
+
+    if licitacoes_data is None:
+        motivo_falha = f"API retornou erro na página {pagina_atual} da modalidade {modalidade_id_sync}"
+        logger.error(motivo_falha + ", após todas as retentativas.")
+        logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, motivo_falha)
+        return None, paginas_restantes
+
+    if not licitacoes_data:
+        logger.info(f"SINCRONIZAÇÃO MODALIDADE: Fim dos dados para modalidade {modalidade_id_sync} na página {pagina_atual} (página vazia ou 204 No Content).")
+        return [], 0
+
+    arquivar_resposta_bruta('listagem', {
+        'modalidade': modalidade_id_sync, 'pagina': pagina_atual, 'data_inicio': data_inicio_api_str,
+        'data_fim': data_fim_api_str, 'paginas_restantes': paginas_restantes,
+    }, licitacoes_data)
+    return licitacoes_data, paginas_restantes
+
+def salvar_pagina_licitacoes(conn, licitacoes_data, enriquecimentos=None, pendentes_enriquecimento=None):
+    """
+    Salva as licitações da página na transação corrente, SEM commit (quem chama decide quando commitar).
+    Com 'pendentes_enriquecimento' (lista), grava só os cabeçalhos e deixa itens/arquivos para a fila (ver enfileirar_enriquecimentos).
+    """
+    if pendentes_enriquecimento is not None:
+        salvar_pagina_licitacoes_em_lote(conn, licitacoes_data, pendentes_enriquecimento=pendentes_enriquecimento)
+        return
+    # Itens e arquivos já buscados em paralelo (estágio de enriquecimento). Se não vieram, busca agora.
+    if enriquecimentos is None:
+        enriquecimentos = enriquecer_pagina_async(conn, licitacoes_data) if ENRIQUECIMENTO_ASYNC else {}
+
+    if GRAVACAO_EM_LOTE_SYNC:
+        salvar_pagina_licitacoes_em_lote(conn, licitacoes_data, enriquecimentos)
+    else:
+        for lic_api in licitacoes_data:
+            save_licitacao_to_db(conn, lic_api, enriquecimentos.get(lic_api.get('numeroControlePNCP')))
+
+# Grava as licitações de UMA página em uma única transação (commit por página)
+def gravar_pagina_licitacoes(conn, modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, licitacoes_data, enriquecimentos=None):
+    """
+    Salva todas as licitações da página e faz UM commit. Em erro, faz rollback (se possível)
+    e registra a página em failed_pages.jsonl. Retorna True se a página foi commitada.
+    """
+    logger.info(f"SINCRONIZAÇÃO MODALIDADE: Modalidade {modalidade_id_sync}, Página {pagina_atual}: Processando {len(licitacoes_data)} licitações.")
 
+    # --- INÍCIO DA MELHORIA: COMMIT EM LOTE POR PÁGINA ---
+    # Fila de enriquecimento ativa: a página grava só cabeçalhos e os jobs são enfileirados DEPOIS do commit
+    pendentes_enriquecimento = [] if get_fila_enriquecimento() else None
+    try:
+        # Processa todas as licitações da página DENTRO de uma única transação
+        salvar_pagina_licitacoes(conn, licitacoes_data, enriquecimentos, pendentes_enriquecimento)
+
+        # O commit só acontece aqui, UMA VEZ para a página inteira
+        with metricas.medir('db_segundos', etapa='commit'):
+            conn.commit()
+        metricas.contar('paginas_total', resultado='gravada')
+        logger.info(f"Página {pagina_atual} da modalidade {modalidade_id_sync} commitada com sucesso.")
+        if pendentes_enriquecimento:
+            enfileirar_enriquecimentos(pendentes_enriquecimento)
+        return True
+
+    except mysql.connector.errors.OperationalError as op_err:
+        # Captura especificamente o erro de "Lost connection"
+        logger.error(f"Erro operacional de DB (ex: conexão perdida) no lote da página {pagina_atual}. Erro: {op_err}")
+        # Não tentamos rollback, pois a conexão está provavelmente morta.
+        # A verificação de conexão antes da próxima página cuidará da reconexão.
+        motivo_falha = f"Erro operacional de DB no lote da página {pagina_atual}: {op_err}"
+        logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, motivo_falha)
+
+    except Exception as e:
+        # Para outros erros de BD, tentamos o rollback
+        logger.error(f"Falha ao processar o lote da página {pagina_atual}. Rollback executado. Erro: {e}")
+        try:
+            conn.rollback()
+        except mysql.connector.Error as rb_err:
+            logger.error(f"Erro adicional durante o rollback: {rb_err}")
+        motivo_falha = f"Erro de banco de dados no lote da página {pagina_atual}: {e}"
+        logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, motivo_falha)
+
+    metricas.contar('paginas_total', resultado='falha')
+    return False
+
+# Processa UMA página da listagem (busca na API + gravação com commit único). Usada pelos workers do modo concorrente.
+def processar_pagina_sync(conn, modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, via_rapida=False):
+    """
+    Busca uma página de licitações da API e salva todas elas DENTRO de uma única transação.
+    Com 'via_rapida', as licitações novas são commitadas antes (sem itens/arquivos), e a página completa depois.
+    Retorna uma tupla (status, paginas_restantes, quantidade_licitacoes), onde status é
+    'ok', 'vazia' (fim dos dados), 'falha_api' ou 'falha_db'.
+    """
+    licitacoes_data, paginas_restantes = buscar_pagina_listagem(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str)
+    if licitacoes_data is None:
+        return 'falha_api', paginas_restantes, 0
+    if not licitacoes_data:
+        return 'vazia', 0, 0
+    visto_em = time.monotonic()
+    if via_rapida and VIA_RAPIDA_SYNC:
+        gravar_via_rapida(conn, licitacoes_data, visto_em)
+    if gravar_pagina_licitacoes(conn, modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, licitacoes_data):
+        registrar_latencia_pagina(licitacoes_data, visto_em)
+        return 'ok', paginas_restantes, len(licitacoes_data)
+    return 'falha_db', paginas_restantes, 0
+
+def calcular_janela_sincronizacao():
+    """Retorna (data_inicio_api_str, data_fim_api_str) da janela de DIAS_JANELA_SINCRONIZACAO dias até agora."""
     agora = datetime.now()
     data_fim_periodo_dt = agora
     data_inicio_periodo_dt = agora - timedelta(days=DIAS_JANELA_SINCRONIZACAO)
+    return format_datetime_for_api(data_inicio_periodo_dt), format_datetime_for_api(data_fim_periodo_dt)
+
+
+# ======= COORDENAÇÃO POR LEASES (tabela sync_leases) =======
+# Substitui o lock de arquivo sync_api.lock, que serializava todos os scripts em uma máquina só. Cada job reserva
+# só os recursos que usa ('sync:modalidade:N', 'backfill:fatia:ID', 'dlq', 'status'), com validade (TTL) renovada
+# por uma thread de heartbeat. Jobs sem conflito rodam juntos, inclusive em máquinas diferentes; se o dono morre,
+# o lease vence e a próxima execução assume. Quem perde o lease (sem renovar por mais que o TTL) para de trabalhar nele.
+# Sem a tabela (atualizar_db_sync.sql não aplicado), cai para um lock de arquivo local por recurso.
+LEASE_TTL_SEGUNDOS = int(os.getenv('SYNC_LEASE_TTL', '120'))
+INTERVALO_HEARTBEAT_LEASE = max(LEASE_TTL_SEGUNDOS / 3, 1)
+
+class CoordenadorLeases:
+    """Leases do processo (thread-safe), com uma conexão própria em autocommit. adquirir() nunca espera."""
+    def __init__(self, ttl=None):
+        self.ttl = ttl or LEASE_TTL_SEGUNDOS
+        self.dono = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock() # Protege os dicionários
+        self._lock_conn = threading.Lock() # Protege a conexão (heartbeat x adquirir/liberar)
+        self._conn = None
+        self._leases = {} # recurso -> validade local (time.monotonic()), sempre antes do expira_em do banco
+        self._locks_arquivo = {} # recurso -> arquivo com fcntl.lockf (sem a tabela sync_leases)
+        self._sem_tabela = False
+        self._parar = threading.Event()
+        self._heartbeat = None
+
+    def _executar(self, sql, parametros, buscar=False):
+        with self._lock_conn:
+            self._conn = garantir_conexao_ativa(self._conn)
+            if not self._conn:
+                raise mysql.connector.errors.OperationalError("Sem conexão com o banco para os leases")
+            self._conn.autocommit = True
+            cursor = self._conn.cursor(dictionary=True)
+            try:
+                cursor.execute(sql, parametros)
+                return cursor.fetchone() if buscar else cursor.rowcount
+            finally:
+                cursor.close()
+
+    def adquirir(self, recurso):
+        """True se o lease ficou com este processo (livre, vencido ou já nosso). Ocupado por outro dono: loga e devolve False."""
+        if self._sem_tabela:
+            return self._adquirir_arquivo(recurso)
+        inicio = time.monotonic()
+        try:
+            obtido = self._executar(
+                "INSERT IGNORE INTO sync_leases (recurso, dono, expira_em) VALUES (%s, %s, NOW(3) + INTERVAL %s SECOND)",
+                (recurso, self.dono, self.ttl)
+            ) == 1
+            if not obtido:
+                # Assume o lease vencido (dono morto) ou renova o nosso. 'dono' por último: o SET é avaliado em ordem.
+                obtido = self._executar(
+                    "UPDATE sync_leases SET token = IF(dono = %s, token, token + 1), adquirido_em = IF(dono = %s, adquirido_em, NOW()), "
+                    "dono = %s, expira_em = NOW(3) + INTERVAL %s SECOND WHERE recurso = %s AND (dono = %s OR expira_em < NOW(3))",
+                    (self.dono, self.dono, self.dono, self.ttl, recurso, self.dono)
+                ) == 1
+            if not obtido:
+                atual = self._executar("SELECT dono, expira_em FROM sync_leases WHERE recurso = %s", (recurso,), buscar=True)
+                if atual:
+                    logger.info(f"LEASE: '{recurso}' está com {atual['dono']} (vence em {atual['expira_em']}).")
+                return False
+        except mysql.connector.errors.ProgrammingError as e:
+            logger.error(f"LEASE: Tabela sync_leases indisponível ({e}). Rode atualizar_db_sync.sql. Usando locks de arquivo locais.")
+            self._sem_tabela = True
+            return self._adquirir_arquivo(recurso)
+        except mysql.connector.Error as e:
+            logger.error(f"LEASE: Não foi possível adquirir '{recurso}' ({e}). O recurso fica para a próxima execução.")
+            return False
+        with self._lock:
+            self._leases[recurso] = inicio + self.ttl
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._renovar, name='heartbeat_leases', daemon=True)
+                self._heartbeat.start()
+        return True
+
+    def _adquirir_arquivo(self, recurso):
+        arquivo = open(os.path.join(BASE_DIR, f"lease-{recurso.replace(':', '_')}.lock"), "w")
+        try:
+            fcntl.lockf(arquivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            arquivo.close()
+            return False
+        with self._lock:
+            self._locks_arquivo[recurso] = arquivo
+            self._leases[recurso] = float('inf') # Lock de arquivo não vence: cai junto com o processo
+        return True
+
+    def valida(self, recurso):
+        """O lease ainda é deste processo? Checado antes de cada unidade de trabalho (página, fatia, falha)."""
+        with self._lock:
+            validade = self._leases.get(recurso)
+        return validade is not None and time.monotonic() < validade
+
+    def _renovar(self):
+        """Heartbeat: renova todos os leases do processo a cada INTERVALO_HEARTBEAT_LEASE segundos."""
+        while not self._parar.wait(INTERVALO_HEARTBEAT_LEASE):
+            with self._lock:
+                recursos = [recurso for recurso in self._leases if recurso not in self._locks_arquivo]
+            for recurso in recursos:
+                inicio = time.monotonic()
+                try:
+                    renovado = self._executar(
+                        "UPDATE sync_leases SET expira_em = NOW(3) + INTERVAL %s SECOND WHERE recurso = %s AND dono = %s",
+                        (self.ttl, recurso, self.dono)
+                    ) == 1
+                except mysql.connector.Error as e:
+                    logger.warning(f"LEASE: Heartbeat de '{recurso}' falhou ({e}). Tentando de novo em {INTERVALO_HEARTBEAT_LEASE:.0f}s.")
+                    continue
+                with self._lock:
+                    if recurso not in self._leases:
+                        continue # Liberado enquanto renovava
+                    if renovado:
+                        self._leases[recurso] = inicio + self.ttl
+                    else:
+                        del self._leases[recurso]
+                        logger.error(f"LEASE: '{recurso}' venceu e foi assumido por outro processo. O trabalho nele será interrompido.")
+
+    def liberar(self, recurso):
+        with self._lock:
+            conhecido = self._leases.pop(recurso, None) is not None
+            arquivo = self._locks_arquivo.pop(recurso, None)
+        if arquivo:
+            arquivo.close()
+        elif conhecido:
+            try:
+                self._executar("DELETE FROM sync_leases WHERE recurso = %s AND dono = %s", (recurso, self.dono))
+            except mysql.connector.Error as e:
+                logger.warning(f"LEASE: Não foi possível liberar '{recurso}' ({e}). Ele vence sozinho em até {self.ttl}s.")
+
+    def liberar_todos(self):
+        with self._lock:
+            recursos = list(self._leases)
+        for recurso in recursos:
+            self.liberar(recurso)
+        self._parar.set()
+        with self._lock_conn:
+            if self._conn:
+                try:
+                    self._conn.close()
+                except mysql.connector.Error:
+                    pass
+                self._conn = None
+
+_coordenador_leases = None
+_lock_coordenador_leases = threading.Lock()
+
+def get_coordenador_leases():
+    """Coordenador de leases do processo, criado na primeira chamada (libera tudo ao sair)."""
+    global _coordenador_leases
+    if _coordenador_leases is None:
+        with _lock_coordenador_leases:
+            if _coordenador_leases is None:
+                _coordenador_leases = CoordenadorLeases()
+                atexit.register(_coordenador_leases.liberar_todos)
+    return _coordenador_leases
+
+def recurso_modalidade(modalidade):
+    return f"sync:modalidade:{modalidade}"
+
+def reservar_modalidades(modalidades=None):
+    """Adquire o lease de cada modalidade e devolve só as reservadas (as outras estão com outra execução)."""
+    coordenador = get_coordenador_leases()
+    modalidades = modalidades or CODIGOS_MODALIDADE
+    reservadas = [mod for mod in modalidades if coordenador.adquirir(recurso_modalidade(mod))]
+    ocupadas = [mod for mod in modalidades if mod not in reservadas]
+    if ocupadas:
+        logger.warning(f"LEASE: Modalidades {ocupadas} estão com outra execução e foram puladas nesta.")
+    return reservadas
+
+def liberar_modalidades(modalidades):
+    coordenador = get_coordenador_leases()
+    for mod in modalidades:
+        coordenador.liberar(recurso_modalidade(mod))
+
+
+# ======= ESTADO DA SINCRONIZAÇÃO (marca d'água + checkpoint por modalidade, tabela sync_estado) =======
+# Em vez de reler sempre os últimos DIAS_JANELA_SINCRONIZACAO dias, cada modalidade começa da sua marca d'água
+# (fim da janela da última execução COMPLETA), menos uma pequena sobreposição de segurança. Durante a execução,
+# a última página tratada (commitada ou enviada para failed_pages.jsonl) é gravada como checkpoint: se o script cair,
+# a próxima execução retoma a MESMA janela a partir da página seguinte. Sem a tabela, volta à janela fixa.
+# Obs: a API filtra por DIA (dataInicial/dataFinal = AAAAMMDD), então o dia da marca d'água é relido.
+SOBREPOSICAO_MARCA_DAGUA_HORAS = float(os.getenv('SYNC_SOBREPOSICAO_HORAS', '6'))
+
+def planejar_modalidades(conn, modalidades=None):
+    """
+    Decide a janela e a página inicial de cada modalidade e marca as novas execuções como 'em andamento'.
+    Retorna {modalidade: plano}, com plano = {'data_inicio', 'data_fim' (AAAAMMDD), 'janela_fim' (datetime),
+    'pagina_inicial', 'persistir' (False se a tabela sync_estado não existir)}.
+    """
+    modalidades = modalidades or CODIGOS_MODALIDADE
+    agora = datetime.now()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute(
+            f"SELECT modalidade_id, marca_dagua, janela_inicio, janela_fim, ultima_pagina_commitada, em_andamento "
+            f"FROM sync_estado WHERE modalidade_id IN ({', '.join(['%s'] * len(modalidades))})",
+            tuple(modalidades)
+        )
+        estados = {row['modalidade_id']: row for row in cursor.fetchall()}
+    except mysql.connector.errors.ProgrammingError as e:
+        logger.error(f"SYNC_ESTADO: Tabela sync_estado indisponível ({e}). Rode atualizar_db_sync.sql. Usando a janela fixa de {DIAS_JANELA_SINCRONIZACAO} dias, sem checkpoints.")
+        data_inicio_api_str, data_fim_api_str = calcular_janela_sincronizacao()
+        cursor.close()
+        return {
+            mod: {'data_inicio': data_inicio_api_str, 'data_fim': data_fim_api_str, 'janela_fim': agora, 'pagina_inicial': 1, 'persistir': False}
+            for mod in modalidades
+        }
 
-    data_inicio_api_str = format_datetime_for_api(data_inicio_periodo_dt)
-    data_fim_api_str = format_datetime_for_api(data_fim_periodo_dt)
+    planos = {}
+    for mod in modalidades:
+        row = estados.get(mod)
+        if row and row['em_andamento'] and row['janela_inicio'] and row['janela_fim']:
+            # Execução interrompida: mesma janela, a partir da página seguinte ao último checkpoint
+            planos[mod] = {
+                'data_inicio': format_datetime_for_api(row['janela_inicio']), 'data_fim': format_datetime_for_api(row['janela_fim']),
+                'janela_fim': row['janela_fim'], 'pagina_inicial': row['ultima_pagina_commitada'] + 1, 'persistir': True,
+            }
+            logger.info(f"SYNC_ESTADO: Modalidade {mod}: retomando execução interrompida ({planos[mod]['data_inicio']} a {planos[mod]['data_fim']}) na página {planos[mod]['pagina_inicial']}.")
+            continue
 
-    logger.info(f"SYNC ANUAL: Iniciando sincronização para licitações atualizadas entre {data_inicio_api_str} e {data_fim_api_str}")
+        if row and row['marca_dagua']:
+            janela_inicio = row['marca_dagua'] - timedelta(hours=SOBREPOSICAO_MARCA_DAGUA_HORAS)
+        else:
+            janela_inicio = agora - timedelta(days=DIAS_JANELA_SINCRONIZACAO) # Primeira execução: janela padrão
+        planos[mod] = {
+            'data_inicio': format_datetime_for_api(janela_inicio), 'data_fim': format_datetime_for_api(agora),
+            'janela_fim': agora, 'pagina_inicial': 1, 'persistir': True,
+        }
+        cursor.execute(
+            "INSERT INTO sync_estado (modalidade_id, janela_inicio, janela_fim, ultima_pagina_commitada, em_andamento) "
+            "VALUES (%s, %s, %s, 0, TRUE) ON DUPLICATE KEY UPDATE janela_inicio = VALUES(janela_inicio), "
+            "janela_fim = VALUES(janela_fim), ultima_pagina_commitada = 0, em_andamento = TRUE",
+            (mod, janela_inicio, agora)
+        )
+        logger.info(f"SYNC_ESTADO: Modalidade {mod}: janela {planos[mod]['data_inicio']} a {planos[mod]['data_fim']} (marca d'água: {row['marca_dagua'] if row else 'nenhuma'}).")
+    conn.commit()
+    cursor.close()
+    return planos
+
+def registrar_checkpoint_modalidade(conn, plano, modalidade, pagina):
+    """Grava a última página tratada da execução em andamento (nunca volta para trás)."""
+    if not plano['persistir']:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE sync_estado SET ultima_pagina_commitada = GREATEST(ultima_pagina_commitada, %s) WHERE modalidade_id = %s",
+            (pagina, modalidade)
+        )
+        conn.commit()
+        cursor.close()
+    except mysql.connector.Error as e:
+        logger.warning(f"SYNC_ESTADO: Não foi possível gravar o checkpoint da modalidade {modalidade} (página {pagina}): {e}")
 
-    licitacoes_processadas_total = 0
-    
-    for modalidade_id_sync in CODIGOS_MODALIDADE:
-        logger.info(f"\n--- SINCRONIZAÇÃO MODALIDADE: Processando Modalidade {modalidade_id_sync} ---")
-        pagina_atual = 1
-        paginas_processadas_modalidade = 0
-        erros_consecutivos_api = 0 
+def concluir_modalidade(conn, plano, modalidade):
+    """Execução completa da modalidade: a marca d'água avança para o fim da janela e o checkpoint é zerado."""
+    if not plano['persistir']:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE sync_estado SET marca_dagua = %s, em_andamento = FALSE, ultima_pagina_commitada = 0, "
+            "janela_inicio = NULL, janela_fim = NULL WHERE modalidade_id = %s",
+            (plano['janela_fim'], modalidade)
+        )
+        conn.commit()
+        cursor.close()
+        logger.info(f"SYNC_ESTADO: Modalidade {modalidade} concluída. Marca d'água avançada para {plano['janela_fim']}.")
+    except mysql.connector.Error as e:
+        logger.warning(f"SYNC_ESTADO: Não foi possível avançar a marca d'água da modalidade {modalidade}: {e}")
+
+
+# ======= VIA RÁPIDA: licitações novas commitadas antes do enriquecimento =======
+# Uma licitação nova (numeroControlePNCP fora do banco) não espera itens/arquivos nem as regravações da página:
+# o cabeçalho é commitado logo (situacaoReal pelas datas) e o notificacoes.py já pode avisar os usuários.
+# Itens, arquivos e a situacaoReal definitiva vêm depois, pelo caminho normal da mesma página (que a completa).
+# Só INSERE ("ON DUPLICATE KEY UPDATE id = id"): se o caminho normal gravou antes, a linha completa não é tocada.
+VIA_RAPIDA_SYNC = os.getenv('SYNC_VIA_RAPIDA', '1') == '1'
+HORAS_PUBLICACAO_RECENTE = float(os.getenv('SYNC_VIA_RAPIDA_HORAS', '24')) # Só classifica (relatório): já no banco, publicada há menos disso
+TAMANHO_FILA_VIA_RAPIDA = 10 # Páginas esperando a via rápida. Cheia = a página segue só pelo caminho normal
+# No pipeline a via rápida tem conexão própria e o gravador pode estar com as mesmas linhas bloqueadas (transação da
+# página ainda aberta). Em vez de esperar o innodb_lock_wait_timeout do servidor (50s), o INSERT desiste logo:
+# SET STATEMENT vale só para ele, sem mudar a sessão (que no modo concorrente é a mesma do caminho normal).
+ESPERA_BLOQUEIO_VIA_RAPIDA = 1 # Segundos (mínimo do innodb_lock_wait_timeout)
+_SQL_INSERIR_SE_NOVA_FIM = " ON DUPLICATE KEY UPDATE id = id"
+_ERROS_BLOQUEIO_MARIADB = (1205, 1213) # Lock wait timeout, deadlock
+
+def _publicada_recentemente(licitacao_db, agora):
+    publicacao = _para_datetime(licitacao_db.get('dataPublicacaoPncp'))
+    if publicacao is None:
+        return False
+    return (agora - publicacao.replace(tzinfo=None)) <= timedelta(hours=HORAS_PUBLICACAO_RECENTE)
+
+def gravar_via_rapida(conn, licitacoes_data, visto_em):
+    """
+    Insere e commita, em UMA transação, só as licitações da página que ainda não estão no banco (sem itens/arquivos).
+    'visto_em' (time.monotonic() da chegada da página) mede a latência visibilidade -> commit. Retorna quantas inseriu.
+    Erro aqui não é falha da página: o caminho normal grava as mesmas licitações logo depois.
+    """
+    candidatas = {}
+    for lic_api in licitacoes_data:
+        lic_db = mapear_licitacao_api_para_db(lic_api)
+        # Validação completa (e o log de inválidas) fica com o caminho normal
+        if lic_db.get('numeroControlePNCP') and lic_db.get('dataAtualizacao') and tem_chaves_subrecursos(lic_db):
+            candidatas[lic_db['numeroControlePNCP']] = lic_db
+    if not candidatas:
+        return 0
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT numeroControlePNCP FROM licitacoes WHERE numeroControlePNCP IN ({', '.join(['%s'] * len(candidatas))})",
+            tuple(candidatas)
+        )
+        existentes = {row[0] for row in cursor.fetchall()}
+        agora = datetime.now()
+        novas = [lic_db for pncp_id, lic_db in candidatas.items() if pncp_id not in existentes]
+        recentes = sum(1 for pncp_id in existentes if _publicada_recentemente(candidatas[pncp_id], agora))
+        for classe, quantidade in (('nova', len(novas)), ('recente', recentes), ('atualizacao', len(existentes) - recentes)):
+            if quantidade:
+                metricas.contar('licitacoes_classificadas_total', quantidade, classe=classe)
+        if not novas:
+            conn.rollback() # Encerra a transação de leitura
+            return 0
+
+        for lic_db in novas:
+            lic_db['situacaoReal'] = calcular_situacao_real(lic_db, [])
+        sql = (
+            f"SET STATEMENT innodb_lock_wait_timeout = {ESPERA_BLOQUEIO_VIA_RAPIDA} FOR "
+            + _SQL_UPSERT_LICITACOES_INICIO + ', '.join([_PLACEHOLDERS_LINHA_LICITACAO] * len(novas)) + _SQL_INSERIR_SE_NOVA_FIM
+        )
+        with metricas.medir('db_segundos', etapa='via_rapida'):
+            cursor.execute(sql, tuple(valor for lic_db in novas for valor in parametros_upsert_licitacao(lic_db)))
+            conn.commit()
+        metricas.contar('comandos_sql_total', 2)
+    except mysql.connector.Error as e:
+        if getattr(e, 'errno', None) in _ERROS_BLOQUEIO_MARIADB:
+            # O gravador da página já está com essas linhas: ele mesmo as commita em seguida
+            metricas.contar('via_rapida_bloqueios_total')
+            logger.info(f"VIA_RAPIDA: Licitações novas da página bloqueadas pelo gravador ({e.errno}); ficam com o caminho normal.")
+        else:
+            logger.warning(f"VIA_RAPIDA: Não foi possível gravar as licitações novas da página ({e}). Elas seguem pelo caminho normal.")
+        try:
+            conn.rollback()
+        except mysql.connector.Error:
+            pass
+        return 0
+    finally:
+        cursor.close()
 
+    latencia = time.monotonic() - visto_em
+    for _ in novas:
+        metricas.observar('latencia_visibilidade_commit_segundos', latencia, via='rapida')
+    logger.info(f"VIA_RAPIDA: {len(novas)} licitações novas commitadas {latencia:.2f}s após a chegada da página (itens/arquivos vêm depois).")
+    return len(novas)
+
+def registrar_latencia_pagina(licitacoes_data, visto_em):
+    """Latência visibilidade -> commit de cada licitação de uma página gravada pelo caminho normal (completo)."""
+    latencia = time.monotonic() - visto_em
+    for _ in licitacoes_data:
+        metricas.observar('latencia_visibilidade_commit_segundos', latencia, via='pagina')
+
+def logar_latencia_via_rapida():
+    """p50/p95 da chegada na API até o commit: licitações novas (via rápida) x página completa."""
+    for via in ('rapida', 'pagina'):
+        dados = metricas.resumo_histograma('latencia_visibilidade_commit_segundos', via=via)
+        if dados['contagem']:
+            logger.info(
+                f"VIA_RAPIDA: Visibilidade -> commit ({'licitações novas, via rápida' if via == 'rapida' else 'página completa'}): "
+                f"{dados['contagem']} licitações, p50 {dados['p50_s']:.2f}s, p95 {dados['p95_s']:.2f}s."
+            )
+
+def _estagio_via_rapida(fila_rapida, abortar):
+    """Estágio paralelo à busca: grava as licitações novas de cada página com uma conexão própria."""
+    conn = None
+    try:
         while True:
-            if LIMITE_PAGINAS_TESTE_SYNC is not None and paginas_processadas_modalidade >= LIMITE_PAGINAS_TESTE_SYNC:
-                logger.info(f"SINCRONIZAÇÃO MODALIDADE: Limite de {LIMITE_PAGINAS_TESTE_SYNC} páginas atingido para modalidade {modalidade_id_sync}.")
+            item = fila_rapida.get()
+            if item is _FIM_PIPELINE:
                 break
+            if abortar.is_set():
+                continue # Só esvazia a fila até o fim
+            licitacoes_data, visto_em = item
+            conn = garantir_conexao_ativa(conn)
+            if conn:
+                gravar_via_rapida(conn, licitacoes_data, visto_em)
+    except Exception:
+        logger.exception("VIA_RAPIDA: Erro inesperado. As próximas páginas seguem só pelo caminho normal.")
+    finally:
+        if conn:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+
+# ======= PIPELINE DO MODO SEQUENCIAL: busca de páginas -> enriquecimento -> gravação =======
+# Três estágios em threads separadas, ligados por filas LIMITADAS (backpressure): enquanto o banco grava a
+# página N, o enriquecimento já busca itens/arquivos da página N+1 e o pré-carregador já baixa a página N+2.
+# Se um estágio mais à frente ficar lento, as filas enchem e os estágios anteriores esperam (não acumulam memória).
+# O commit continua sendo UM por página, e logar_pagina_falha continua registrando a página que falhou.
+TAMANHO_FILA_PIPELINE = 3 # Páginas em espera entre um estágio e outro
+_FIM_PIPELINE = object() # Sentinela que indica o fim dos dados para o próximo estágio
+
+class _ModalidadeConcluida:
+    """Marcador enviado pela busca quando a modalidade terminou normalmente (gravador avança a marca d'água)."""
+    def __init__(self, modalidade_id):
+        self.modalidade_id = modalidade_id
+
+class EstatisticasPipeline:
+    """Tempo ocupado por estágio e profundidade das filas, para descobrir qual estágio limita a vazão."""
+    def __init__(self, estagios, filas):
+        self._lock = threading.Lock()
+        self.inicio = time.monotonic()
+        self.ocupado = {estagio: 0.0 for estagio in estagios}
+        self.paginas = {estagio: 0 for estagio in estagios}
+        self.amostras_fila = {fila: [] for fila in filas}
+
+    def registrar_trabalho(self, estagio, segundos):
+        metricas.observar('estagio_pipeline_segundos', segundos, estagio=estagio)
+        with self._lock:
+            self.ocupado[estagio] += segundos
+            self.paginas[estagio] += 1
+
+    def amostrar_fila(self, nome_fila, fila):
+        with self._lock:
+            self.amostras_fila[nome_fila].append(fila.qsize())
+
+    def resumo(self):
+        duracao = max(time.monotonic() - self.inicio, 1e-9)
+        with self._lock:
+            estagios = {
+                estagio: {
+                    'ocupado_s': round(segundos, 2),
+                    'ocupacao_pct': round(segundos / duracao * 100, 1),
+                    'paginas': self.paginas[estagio],
+                }
+                for estagio, segundos in self.ocupado.items()
+            }
+            filas = {
+                nome: {
+                    'media': round(sum(amostras) / len(amostras), 2) if amostras else 0,
+                    'maxima': max(amostras) if amostras else 0,
+                }
+                for nome, amostras in self.amostras_fila.items()
+            }
+        gargalo = max(estagios, key=lambda e: estagios[e]['ocupado_s']) if estagios else None
+        return {'duracao_s': round(duracao, 2), 'estagios': estagios, 'filas': filas, 'gargalo': gargalo}
+
+    def logar_resumo(self):
+        resumo = self.resumo()
+        for estagio, dados in resumo['estagios'].items():
+            logger.info(f"PIPELINE: Estágio '{estagio}': ocupado {dados['ocupado_s']}s ({dados['ocupacao_pct']}% de {resumo['duracao_s']}s), {dados['paginas']} páginas.")
+        for nome, dados in resumo['filas'].items():
+            logger.info(f"PIPELINE: Fila '{nome}': profundidade média {dados['media']}, máxima {dados['maxima']} (limite {TAMANHO_FILA_PIPELINE}).")
+        logger.info(f"PIPELINE: Estágio que limita a vazão: '{resumo['gargalo']}'.")
+        return resumo
+
+def _colocar_na_fila(fila, item, abortar):
+    """put() que desiste se o pipeline foi abortado (evita thread presa com a fila cheia)."""
+    while not abortar.is_set():
+        try:
+            fila.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
 
-            # --- INÍCIO DA CORREÇÃO DE CONEXÃO PERDIDA (VERSÃO APRIMORADA) ---
-            # Garante que a conexão está ativa antes de cada uso.
-            # Caso contrário, tenta reconectar até 3 vezes com espera progressiva.
-            if conn is None:
-                logger.warning("Conexão inexistente. Tentando criar nova conexão...")
-                conn = get_db_connection()
-            else:
-                try:
-                    # 'ping(reconnect=False)' apenas verifica, sem tentar reconectar automaticamente.
-                    conn.ping(reconnect=False, attempts=1, delay=0)
-                except (mysql.connector.Error, AttributeError) as err:
-                    # Se chegar aqui, signica que primeiro deu um falso positivo ou a conexão foi perdida.
-                    logger.warning(f"Conexão com o banco perdida ou inválida ({type(err).__name__}). Tentando reconectar...")
-                    conn = None
-                    for attempt in range(1, 4):
-                        conn = get_db_connection()
-                        if conn and conn.is_connected():
-                            logger.info(f"Reconexão bem-sucedida (tentativa {attempt}/3).")
-                            break
-                        else:
-                            logger.warning(f"Falha ao reconectar (tentativa {attempt}/3). Tentando novamente em {2*attempt}s...")
-                            time.sleep(2 * attempt)
-            if not conn or not conn.is_connected():
-                logger.critical("Falha ao restabelecer conexão com o banco após múltiplas tentativas. Abortando script.")
-                return
+def _estagio_busca_paginas(fila_paginas, estatisticas, abortar, planos, fila_rapida=None):
+    """
+    Estágio 1: percorre modalidades e páginas na API (mesmo controle de fluxo e disjuntor de sempre).
+    Com 'fila_rapida', cada página também vai para a via rápida (sem esperar: fila cheia = só o caminho normal).
+    """
+    try:
+        for modalidade_id_sync in planos: # Só as modalidades com lease desta execução
+            logger.info(f"\n--- SINCRONIZAÇÃO MODALIDADE: Processando Modalidade {modalidade_id_sync} ---")
+            plano = planos[modalidade_id_sync]
+            data_inicio_api_str, data_fim_api_str = plano['data_inicio'], plano['data_fim']
+            pagina_atual = plano['pagina_inicial']
+            concluida = False
+            paginas_buscadas_modalidade = 0
+            erros_consecutivos_api = 0
 
-            
-            # --- Bloco de try/except para capturar o erro final do Tenacity ---
-            try:
-                licitacoes_data, paginas_restantes = fetch_licitacoes_por_atualizacao(
-                    data_inicio_api_str, data_fim_api_str, modalidade_id_sync, pagina_atual
-                )
-            except tenacity.RetryError as e: # Captura se todas as retentativas falharem
-                logger.error(f"API_RETRY_FAIL: Todas as retentativas falharam para a página {pagina_atual} da modalidade {modalidade_id_sync}. Causa final: {e}")
-                licitacoes_data = None # Trata como falha para a lógica abaixo
-                paginas_restantes = -1 # Apenas para garantir que o fluxo continue
-            # --- Fim do bloco de captura ---
-
-            if licitacoes_data is None:
-                erros_consecutivos_api += 1
-                motivo_falha = f"API retornou erro na página {pagina_atual} da modalidade {modalidade_id_sync}"
-                logger.error(motivo_falha + ", após todas as retentativas.")
-                
-                logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, motivo_falha)
-                
-                if erros_consecutivos_api >= MAX_CONSECUTIVE_API_FAILURES:
-                    logger.critical(f"CIRCUIT BREAKER: {erros_consecutivos_api} falhas consecutivas de API. Abortando a modalidade {modalidade_id_sync} por segurança.")
+            while not abortar.is_set():
+                if LIMITE_PAGINAS_TESTE_SYNC is not None and paginas_buscadas_modalidade >= LIMITE_PAGINAS_TESTE_SYNC:
+                    logger.info(f"SINCRONIZAÇÃO MODALIDADE: Limite de {LIMITE_PAGINAS_TESTE_SYNC} páginas atingido para modalidade {modalidade_id_sync}.")
+                    break
+                if not get_coordenador_leases().valida(recurso_modalidade(modalidade_id_sync)):
+                    logger.critical(f"LEASE: Modalidade {modalidade_id_sync} perdeu o lease. Parando a busca dela (a próxima execução retoma do checkpoint).")
+                    break
+
+                inicio = time.monotonic()
+                licitacoes_data, paginas_restantes = buscar_pagina_listagem(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str)
+                estatisticas.registrar_trabalho('busca', time.monotonic() - inicio)
+
+                if licitacoes_data is None:
+                    erros_consecutivos_api += 1
+                    if erros_consecutivos_api >= MAX_CONSECUTIVE_API_FAILURES:
+                        logger.critical(f"CIRCUIT BREAKER: {erros_consecutivos_api} falhas consecutivas de API. Abortando a modalidade {modalidade_id_sync} por segurança.")
+                        break
+                    logger.warning(f"Avançando para a próxima página da modalidade {modalidade_id_sync}...")
+                    pagina_atual += 1
+                    continue
+
+                erros_consecutivos_api = 0
+                if not licitacoes_data:
+                    concluida = True
+                    break
+
+                paginas_buscadas_modalidade += 1
+                visto_em = time.monotonic()
+                if fila_rapida is not None:
+                    try:
+                        fila_rapida.put_nowait((licitacoes_data, visto_em))
+                    except queue.Full:
+                        logger.warning(f"VIA_RAPIDA: Fila cheia. Página {pagina_atual} da modalidade {modalidade_id_sync} segue só pelo caminho normal.")
+                if not _colocar_na_fila(fila_paginas, (modalidade_id_sync, pagina_atual, licitacoes_data, visto_em), abortar):
+                    return
+                estatisticas.amostrar_fila('paginas', fila_paginas)
+
+                logger.info(f"SINCRONIZAÇÃO MODALIDADE: Página {pagina_atual} buscada. {paginas_restantes} páginas restantes.")
+                if paginas_restantes == 0:
+                    logger.info(f"SINCRONIZAÇÃO MODALIDADE: API indicou ser a última página para a modalidade {modalidade_id_sync}.")
+                    concluida = True
                     break
 
-                logger.warning(f"Avançando para a próxima página da modalidade {modalidade_id_sync}...")
                 pagina_atual += 1
-                time.sleep(1)
+
+            # Só uma modalidade percorrida até o fim avança a marca d'água (disjuntor/limite de teste/aborto não)
+            if concluida and not _colocar_na_fila(fila_paginas, _ModalidadeConcluida(modalidade_id_sync), abortar):
+                return
+    except Exception:
+        logger.exception("PIPELINE: Erro inesperado no estágio de busca de páginas. Encerrando a busca.")
+    finally:
+        _colocar_na_fila(fila_paginas, _FIM_PIPELINE, abortar)
+
+def _estagio_enriquecimento(fila_paginas, fila_gravacao, estatisticas, abortar):
+    """Estágio 2: busca itens/arquivos da página em paralelo. Usa uma conexão própria (só leitura, autocommit)."""
+    conn = get_db_connection() if ENRIQUECIMENTO_ASYNC and not get_fila_enriquecimento() else None
+    try:
+        while True:
+            item = fila_paginas.get()
+            if item is _FIM_PIPELINE:
+                break
+            if isinstance(item, _ModalidadeConcluida):
+                # Repassa o marcador na ordem: o gravador só o recebe depois das páginas da modalidade
+                if not _colocar_na_fila(fila_gravacao, item, abortar):
+                    return
                 continue
+            modalidade_id_sync, pagina_atual, licitacoes_data, visto_em = item
+            inicio = time.monotonic()
+            enriquecimentos = None # None = o gravador busca por conta própria (fallback)
+            if get_fila_enriquecimento():
+                enriquecimentos = {} # Itens/arquivos vão para a fila de enriquecimento: nada a buscar neste estágio
+            elif ENRIQUECIMENTO_ASYNC:
+                try:
+                    conn = garantir_conexao_ativa(conn)
+                    if conn:
+                        # autocommit: cada consulta enxerga o que o gravador já commitou (sem snapshot antigo do REPEATABLE READ)
+                        conn.autocommit = True
+                        enriquecimentos = enriquecer_pagina_async(conn, licitacoes_data)
+                except Exception as e:
+                    logger.warning(f"PIPELINE: Enriquecimento da página {pagina_atual} (modalidade {modalidade_id_sync}) falhou ({e}). O gravador buscará itens/arquivos.")
+            else:
+                enriquecimentos = {}
+            estatisticas.registrar_trabalho('enriquecimento', time.monotonic() - inicio)
+            if not _colocar_na_fila(fila_gravacao, (modalidade_id_sync, pagina_atual, licitacoes_data, enriquecimentos, visto_em), abortar):
+                return
+            estatisticas.amostrar_fila('gravacao', fila_gravacao)
+    except Exception:
+        logger.exception("PIPELINE: Erro inesperado no estágio de enriquecimento. Abortando o pipeline.")
+        abortar.set()
+    finally:
+        fechar_enriquecimento_async(somente_desta_thread=True) # O loop/cliente assíncrono pertence a esta thread
+        if conn:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+        _colocar_na_fila(fila_gravacao, _FIM_PIPELINE, abortar)
 
-            erros_consecutivos_api = 0
-            
-            if not licitacoes_data:
-                logger.info(f"SINCRONIZAÇÃO MODALIDADE: Fim dos dados para modalidade {modalidade_id_sync} na página {pagina_atual} (página vazia ou 204 No Content).")
+# Sincronização padrão (modo sequencial, agora em pipeline)
+def sync_licitacoes_ultima_janela_anual():
+    conn = get_db_connection()
+    if not conn: return
+
+    modalidades = reservar_modalidades()
+    if not modalidades:
+        logger.warning("SYNC ANUAL: Todas as modalidades estão com outras execuções. Nada a fazer.")
+        conn.close()
+        return
+    planos = planejar_modalidades(conn, modalidades)
+
+    logger.info("SYNC ANUAL: Iniciando sincronização a partir da marca d'água de cada modalidade")
+
+    licitacoes_processadas_total = 0
+    fila_paginas = queue.Queue(maxsize=TAMANHO_FILA_PIPELINE)
+    fila_gravacao = queue.Queue(maxsize=TAMANHO_FILA_PIPELINE)
+    estatisticas = EstatisticasPipeline(['busca', 'enriquecimento', 'gravacao'], ['paginas', 'gravacao'])
+    metricas.adicionar_fonte('pipeline', estatisticas.resumo)
+    abortar = threading.Event()
+    fila_rapida = queue.Queue(maxsize=TAMANHO_FILA_VIA_RAPIDA) if VIA_RAPIDA_SYNC else None
+
+    threads = [
+        threading.Thread(target=_estagio_busca_paginas, name='pipeline_busca', daemon=True,
+                         args=(fila_paginas, estatisticas, abortar, planos, fila_rapida)),
+        threading.Thread(target=_estagio_enriquecimento, name='pipeline_enriquecimento', daemon=True,
+                         args=(fila_paginas, fila_gravacao, estatisticas, abortar)),
+    ]
+    thread_via_rapida = None
+    if fila_rapida is not None:
+        thread_via_rapida = threading.Thread(target=_estagio_via_rapida, name='pipeline_via_rapida', daemon=True, args=(fila_rapida, abortar))
+        thread_via_rapida.start()
+    for t in threads:
+        t.start()
+
+    # Estágio 3 (gravação) roda nesta thread, com a conexão principal
+    while True:
+        try:
+            item = fila_gravacao.get(timeout=1)
+        except queue.Empty:
+            # Sem página nova: só sai se o pipeline foi abortado ou se o enriquecimento morreu sem mandar o fim.
+            if abortar.is_set() or not threads[1].is_alive():
                 break
-            
-            logger.info(f"SINCRONIZAÇÃO MODALIDADE: Modalidade {modalidade_id_sync}, Página {pagina_atual}: Processando {len(licitacoes_data)} licitações.")
-            
-            # --- INÍCIO DA MELHORIA: COMMIT EM LOTE POR PÁGINA ---
+            continue
+        if item is _FIM_PIPELINE:
+            break
+
+        conn = garantir_conexao_ativa(conn)
+        if isinstance(item, _ModalidadeConcluida):
+            if conn:
+                concluir_modalidade(conn, planos[item.modalidade_id], item.modalidade_id)
+            continue
+        modalidade_id_sync, pagina_atual, licitacoes_data, enriquecimentos, visto_em = item
+        plano = planos[modalidade_id_sync]
+        data_inicio_api_str, data_fim_api_str = plano['data_inicio'], plano['data_fim']
+
+        if not conn:
+            logger.critical("Falha ao restabelecer conexão com o banco após múltiplas tentativas. Abortando script.")
+            abortar.set()
+            logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, "Sem conexão com o banco para gravar a página.")
+            break
+
+        inicio = time.monotonic()
+        if gravar_pagina_licitacoes(conn, modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, licitacoes_data, enriquecimentos):
+            # Se o commit foi bem-sucedido, atualizamos os contadores
+            licitacoes_processadas_total += len(licitacoes_data)
+            registrar_latencia_pagina(licitacoes_data, visto_em)
+        # Commitada ou registrada em failed_pages.jsonl, a página está tratada: a retomada começa depois dela
+        registrar_checkpoint_modalidade(conn, plano, modalidade_id_sync, pagina_atual)
+        estatisticas.registrar_trabalho('gravacao', time.monotonic() - inicio)
+
+    for t in threads:
+        t.join()
+    if thread_via_rapida is not None and thread_via_rapida.is_alive():
+        fila_rapida.put(_FIM_PIPELINE) # A busca já terminou: nada mais entra na fila
+        thread_via_rapida.join()
+    if conn:
+        conn.close()
+    liberar_modalidades(modalidades)
+    fechar_enriquecimento_async()
+    logger.info(f"\n--- Sincronização da Janela Anual Concluída ---")
+    logger.info(f"Total de licitações da API processadas com sucesso: {licitacoes_processadas_total}")
+    estatisticas.logar_resumo()
+    logar_latencia_via_rapida()
+    logar_estatisticas_conexoes_pncp()
+    logar_estatisticas_cache_subrecursos()
+
+
+# ======= MODO CONCORRENTE (python sync_api.py --workers N) =======
+# Cada worker do pool processa uma página (modalidade, pagina) por vez com SUA conexão (threading.local).
+# A página 1 de cada modalidade revela 'paginasRestantes'; a partir daí as demais páginas da modalidade
+# são distribuídas para o pool. O resultado no banco é o mesmo do modo sequencial: cada página continua
+# sendo uma transação, e o UPSERT só aplica dados com dataAtualizacao mais recente, independente da ordem.
+_estado_worker = threading.local()
+
+def _conexao_do_worker(conexoes_abertas, lock_conexoes):
+    """Conexão própria da thread do worker (reaberta se caiu). As conexões abertas são fechadas no fim pelo orquestrador."""
+    conn_anterior = getattr(_estado_worker, 'conn', None)
+    conn = garantir_conexao_ativa(conn_anterior)
+    if conn is not conn_anterior:
+        _estado_worker.conn = conn
+        if conn:
+            with lock_conexoes:
+                conexoes_abertas.append(conn)
+    return conn
+
+def _tarefa_pagina_concorrente(conexoes_abertas, lock_conexoes, modalidade_id_sync, pagina, data_inicio_api_str, data_fim_api_str):
+    """Executa processar_pagina_sync dentro de um worker, reaproveitando a conexão própria da thread."""
+    conn = _conexao_do_worker(conexoes_abertas, lock_conexoes)
+    if not conn:
+        motivo_falha = f"Worker sem conexão com o banco para a página {pagina} da modalidade {modalidade_id_sync}"
+        logger.error(motivo_falha)
+        logar_pagina_falha(modalidade_id_sync, pagina, data_inicio_api_str, data_fim_api_str, motivo_falha)
+        return 'falha_db', -1, 0
+    return processar_pagina_sync(conn, modalidade_id_sync, pagina, data_inicio_api_str, data_fim_api_str, via_rapida=True)
+
+def sync_licitacoes_concorrente(max_workers=MAX_WORKERS_SYNC):
+    """
+    Mesma sincronização de sync_licitacoes_ultima_janela_anual, mas com modalidades e faixas de páginas
+    processadas em paralelo por um pool limitado a 'max_workers' páginas simultâneas (teto global).
+    """
+    # Conexão do orquestrador: só para o estado da sincronização (janela, checkpoints e marca d'água)
+    conn_estado = get_db_connection()
+    if not conn_estado: return
+    modalidades = reservar_modalidades()
+    if not modalidades:
+        logger.warning("SYNC CONCORRENTE: Todas as modalidades estão com outras execuções. Nada a fazer.")
+        conn_estado.close()
+        return
+    planos = planejar_modalidades(conn_estado, modalidades)
+    logger.info(f"SYNC CONCORRENTE: Iniciando sincronização ({max_workers} workers) a partir da marca d'água de cada modalidade")
+    # Uma conexão keep-alive por worker; com menos conexões que workers o pool descartaria conexões a cada página.
+    configurar_cliente_pncp(max(POOL_CONEXOES_PNCP, max_workers))
+
+    conexoes_abertas = []
+    lock_conexoes = threading.Lock()
+    # Estado de cada modalidade: próxima página ainda não agendada, última página conhecida e disjuntor.
+    # 'checkpoint' só avança sobre páginas tratadas CONTÍGUAS (as páginas terminam fora de ordem).
+    estado = {
+        mod: {
+            'proxima_pagina': planos[mod]['pagina_inicial'], 'ultima_pagina': planos[mod]['pagina_inicial'],
+            'falhas_seguidas': 0, 'encerrada': False, 'paginas_ok': 0, 'completa': False, 'interrompida': False,
+            'tratadas': set(), 'checkpoint': planos[mod]['pagina_inicial'] - 1,
+        }
+        for mod in planos
+    }
+    pendentes = {} # future -> (modalidade, pagina)
+    licitacoes_processadas_total = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sync_worker') as executor:
+
+        def agendar_ate(modalidade, ultima_pagina):
+            est = estado[modalidade]
+            if not est['encerrada'] and not get_coordenador_leases().valida(recurso_modalidade(modalidade)):
+                logger.critical(f"LEASE: Modalidade {modalidade} perdeu o lease. Parando de agendar páginas dela (a próxima execução retoma do checkpoint).")
+                est['interrompida'] = True
+                encerrar_modalidade(modalidade, 0)
+                return
+            if LIMITE_PAGINAS_TESTE_SYNC is not None:
+                limite = planos[modalidade]['pagina_inicial'] - 1 + LIMITE_PAGINAS_TESTE_SYNC
+                if ultima_pagina > limite:
+                    est['interrompida'] = True # Limite de teste: a modalidade não será percorrida até o fim
+                    ultima_pagina = limite
+            while not est['encerrada'] and est['proxima_pagina'] <= ultima_pagina:
+                pagina = est['proxima_pagina']
+                futuro = executor.submit(
+                    _tarefa_pagina_concorrente, conexoes_abertas, lock_conexoes,
+                    modalidade, pagina, planos[modalidade]['data_inicio'], planos[modalidade]['data_fim']
+                )
+                pendentes[futuro] = (modalidade, pagina)
+                est['proxima_pagina'] += 1
+
+        def encerrar_modalidade(modalidade, a_partir_da_pagina):
+            # Cancela as páginas da modalidade que ainda nem começaram (as que já estão rodando terminam normalmente).
+            estado[modalidade]['encerrada'] = True
+            for futuro, (mod, pag) in list(pendentes.items()):
+                if mod == modalidade and pag > a_partir_da_pagina and futuro.cancel():
+                    del pendentes[futuro]
+
+        def marcar_tratada(modalidade, pagina):
+            # Commitada ou registrada em failed_pages.jsonl: avança o checkpoint até o primeiro buraco
+            est = estado[modalidade]
+            est['tratadas'].add(pagina)
+            checkpoint_anterior = est['checkpoint']
+            while est['checkpoint'] + 1 in est['tratadas']:
+                est['checkpoint'] += 1
+                est['tratadas'].discard(est['checkpoint'])
+            if est['checkpoint'] > checkpoint_anterior:
+                registrar_checkpoint_modalidade(conn_estado, planos[modalidade], modalidade, est['checkpoint'])
+
+        for modalidade_id_sync in planos:
+            agendar_ate(modalidade_id_sync, planos[modalidade_id_sync]['pagina_inicial'])
+
+        while pendentes:
+            concluidos, _ = wait(list(pendentes), return_when=FIRST_COMPLETED)
+            for futuro in concluidos:
+                modalidade_id_sync, pagina = pendentes.pop(futuro)
+                est = estado[modalidade_id_sync]
+                try:
+                    status_pagina, paginas_restantes, qtd_licitacoes = futuro.result()
+                except Exception as e:
+                    logger.exception(f"SYNC CONCORRENTE: Erro inesperado no worker (modalidade {modalidade_id_sync}, página {pagina})")
+                    logar_pagina_falha(modalidade_id_sync, pagina, planos[modalidade_id_sync]['data_inicio'], planos[modalidade_id_sync]['data_fim'], f"Erro inesperado no worker: {e}")
+                    status_pagina, paginas_restantes, qtd_licitacoes = 'falha_db', -1, 0
+
+                if status_pagina == 'falha_api':
+                    marcar_tratada(modalidade_id_sync, pagina) # Já registrada em failed_pages.jsonl
+                    est['falhas_seguidas'] += 1
+                    if est['falhas_seguidas'] >= MAX_CONSECUTIVE_API_FAILURES:
+                        logger.critical(f"CIRCUIT BREAKER: {est['falhas_seguidas']} falhas seguidas de API. Abortando a modalidade {modalidade_id_sync} por segurança.")
+                        est['interrompida'] = True
+                        encerrar_modalidade(modalidade_id_sync, pagina)
+                    elif pagina >= est['proxima_pagina'] - 1:
+                        # Igual ao modo sequencial: sem saber o total, avança para a próxima página.
+                        agendar_ate(modalidade_id_sync, pagina + 1)
+                    continue
+
+                est['falhas_seguidas'] = 0
+
+                if status_pagina == 'vazia':
+                    est['completa'] = True
+                    encerrar_modalidade(modalidade_id_sync, pagina)
+                    continue
+
+                if status_pagina == 'ok':
+                    licitacoes_processadas_total += qtd_licitacoes
+                    est['paginas_ok'] += 1
+                marcar_tratada(modalidade_id_sync, pagina)
+                if paginas_restantes == 0:
+                    est['completa'] = True # API indicou a última página
+
+                # 'paginasRestantes' pode crescer durante a execução; agenda tudo o que ainda não foi agendado.
+                if paginas_restantes and paginas_restantes > 0:
+                    est['ultima_pagina'] = max(est['ultima_pagina'], pagina + paginas_restantes)
+                    agendar_ate(modalidade_id_sync, est['ultima_pagina'])
+
+            for modalidade_id_sync, est in estado.items():
+                if not est.get('logada') and not any(mod == modalidade_id_sync for mod, _ in pendentes.values()):
+                    est['logada'] = True
+                    logger.info(f"SYNC CONCORRENTE: Modalidade {modalidade_id_sync} concluída ({est['paginas_ok']} páginas commitadas).")
+                    if est['completa'] and not est['interrompida']:
+                        concluir_modalidade(conn_estado, planos[modalidade_id_sync], modalidade_id_sync)
+
+    for conn in conexoes_abertas + [conn_estado]:
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+
+    liberar_modalidades(modalidades)
+    fechar_enriquecimento_async()
+    logger.info(f"\n--- Sincronização Concorrente Concluída ---")
+    logger.info(f"Total de licitações da API processadas com sucesso: {licitacoes_processadas_total}")
+    logar_latencia_via_rapida()
+    logar_estatisticas_conexoes_pncp()
+    logar_estatisticas_cache_subrecursos()
+
+
+# ======= BACKFILL HISTÓRICO (python sync_api.py backfill --from AAAAMMDD --to AAAAMMDD) =======
+# Para popular um banco novo ou reconstruir após perda de dados: o período é dividido em fatias (shards) de
+# um dia ou uma semana por modalidade, distribuídas para um pool de workers. Cada fatia fica registrada na
+# tabela sync_backfill_shards com a última página gravada, então o comando pode ser interrompido e repetido:
+# fatias concluídas são puladas e as demais continuam de onde pararam (o UPSERT torna a regravação inofensiva).
+# A vazão total continua limitada pelo limitador adaptativo (limitador_pncp), que é quem define o "orçamento" da API.
+MAX_WORKERS_BACKFILL = int(os.getenv('SYNC_BACKFILL_WORKERS', '8'))
+INTERVALO_LOG_PROGRESSO_BACKFILL = 30 # Segundos entre as linhas de progresso
+
+def gerar_shards_backfill(data_de, data_ate, tamanho='semana', modalidades=None):
+    """Lista de (modalidade, data_inicio, data_fim) cobrindo [data_de, data_ate] (datas inclusivas)."""
+    passo = timedelta(days=7 if tamanho == 'semana' else 1)
+    shards = []
+    for modalidade in modalidades or CODIGOS_MODALIDADE:
+        inicio = data_de
+        while inicio <= data_ate:
+            fim = min(inicio + passo - timedelta(days=1), data_ate)
+            shards.append((modalidade, inicio, fim))
+            inicio = fim + timedelta(days=1)
+    return shards
+
+def registrar_shards_backfill(conn, shards):
+    """Cria as fatias que ainda não existem (idempotente) e devolve as pendentes, com a página de retomada."""
+    cursor = conn.cursor(dictionary=True)
+    _executemany_em_lotes(
+        cursor,
+        "INSERT IGNORE INTO sync_backfill_shards (modalidade_id, data_inicio, data_fim) VALUES (%s, %s, %s)",
+        shards
+    )
+    conn.commit()
+    datas = [s[1] for s in shards]
+    # 'em_andamento' que sobrou de uma execução interrompida também é retomado
+    cursor.execute(
+        "SELECT id, modalidade_id, data_inicio, data_fim, ultima_pagina FROM sync_backfill_shards "
+        "WHERE status <> 'concluido' AND data_inicio BETWEEN %s AND %s ORDER BY data_inicio DESC, modalidade_id",
+        (min(datas), max(datas))
+    )
+    chaves = set(shards)
+    pendentes = [row for row in cursor.fetchall() if (row['modalidade_id'], row['data_inicio'], row['data_fim']) in chaves]
+    cursor.close()
+    return pendentes
+
+def _atualizar_shard_backfill(conn, shard_id, status, pagina=None, licitacoes=0, nova_tentativa=False):
+    """nova_tentativa=True só quando a fatia é assumida (os checkpoints por página não contam como tentativa)."""
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE sync_backfill_shards SET status = %s, ultima_pagina = COALESCE(%s, ultima_pagina), "
+        "licitacoes = licitacoes + %s, tentativas = tentativas + %s WHERE id = %s",
+        (status, pagina, licitacoes, 1 if nova_tentativa else 0, shard_id)
+    )
+    conn.commit()
+    cursor.close()
+
+def _tarefa_shard_backfill(conexoes_abertas, lock_conexoes, shard):
+    """
+    Reserva a fatia (lease 'backfill:fatia:ID') e a percorre. Fatia com lease de outra execução devolve ('ocupada', 0):
+    vários backfills (em máquinas diferentes) dividem as fatias pendentes entre si.
+    """
+    recurso = f"backfill:fatia:{shard['id']}"
+    coordenador = get_coordenador_leases()
+    if not coordenador.adquirir(recurso):
+        return 'ocupada', 0
+    try:
+        return _percorrer_shard_backfill(conexoes_abertas, lock_conexoes, shard, recurso)
+    finally:
+        coordenador.liberar(recurso)
+
+def _percorrer_shard_backfill(conexoes_abertas, lock_conexoes, shard, recurso):
+    """
+    Percorre todas as páginas de UMA fatia (mesmo fluxo do modo sequencial: commit por página e disjuntor).
+    Retorna (status, licitacoes_gravadas), com status 'concluido' ou 'falha' (a fatia será tentada de novo).
+    """
+    conn = _conexao_do_worker(conexoes_abertas, lock_conexoes)
+    if not conn:
+        logger.error(f"BACKFILL: Worker sem conexão com o banco para a fatia {shard['id']}.")
+        return 'falha', 0
+    modalidade_id_sync = shard['modalidade_id']
+    data_inicio_api_str, data_fim_api_str = format_datetime_for_api(shard['data_inicio']), format_datetime_for_api(shard['data_fim'])
+    _atualizar_shard_backfill(conn, shard['id'], 'em_andamento', nova_tentativa=True)
+
+    pagina_atual = shard['ultima_pagina'] + 1
+    licitacoes_gravadas = 0
+    erros_consecutivos_api = 0
+    while True:
+        if not get_coordenador_leases().valida(recurso):
+            logger.critical(f"LEASE: A fatia {shard['id']} perdeu o lease. Parando (outra execução continua do checkpoint).")
+            return 'falha', licitacoes_gravadas
+        conn = _conexao_do_worker(conexoes_abertas, lock_conexoes)
+        if not conn:
+            return 'falha', licitacoes_gravadas
+        status_pagina, paginas_restantes, qtd_licitacoes = processar_pagina_sync(conn, modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str)
+        if status_pagina == 'vazia':
+            break
+        if status_pagina == 'falha_api':
+            erros_consecutivos_api += 1
+            if erros_consecutivos_api >= MAX_CONSECUTIVE_API_FAILURES:
+                logger.critical(f"BACKFILL: {erros_consecutivos_api} falhas seguidas de API na fatia {shard['id']} (modalidade {modalidade_id_sync}, {data_inicio_api_str}-{data_fim_api_str}). A fatia fica para a próxima execução.")
+                _atualizar_shard_backfill(conn, shard['id'], 'falha')
+                return 'falha', licitacoes_gravadas
+            pagina_atual += 1 # Sem checkpoint: se o disjuntor abrir, a próxima execução tenta estas páginas de novo
+            continue
+
+        erros_consecutivos_api = 0
+        # Página tratada (commitada ou registrada em failed_pages.jsonl): checkpoint da fatia
+        licitacoes_gravadas += qtd_licitacoes
+        _atualizar_shard_backfill(conn, shard['id'], 'em_andamento', pagina_atual, qtd_licitacoes)
+        if paginas_restantes == 0:
+            break
+        pagina_atual += 1
+
+    _atualizar_shard_backfill(conn, shard['id'], 'concluido')
+    return 'concluido', licitacoes_gravadas
+
+def _formatar_duracao(segundos):
+    horas, resto = divmod(int(segundos), 3600)
+    return f"{horas}h{resto // 60:02d}m{resto % 60:02d}s"
+
+def backfill_licitacoes(data_de, data_ate, max_workers=MAX_WORKERS_BACKFILL, tamanho_shard='semana'):
+    """Sincroniza [data_de, data_ate] (datas de atualização, inclusivas) em fatias paralelas e retomáveis."""
+    conn_estado = get_db_connection()
+    if not conn_estado: return
+    shards = gerar_shards_backfill(data_de, data_ate, tamanho_shard)
+    try:
+        pendentes = registrar_shards_backfill(conn_estado, shards)
+    except mysql.connector.errors.ProgrammingError as e:
+        logger.critical(f"BACKFILL: Tabela sync_backfill_shards indisponível ({e}). Rode atualizar_db_sync.sql.")
+        conn_estado.close()
+        return
+    conn_estado.close()
+
+    total = len(pendentes)
+    logger.info(f"BACKFILL: {len(shards)} fatias ({tamanho_shard}) de {data_de:%Y%m%d} a {data_ate:%Y%m%d}; {len(shards) - total} já concluídas, {total} pendentes. {max_workers} workers.")
+    if not total:
+        return
+    configurar_cliente_pncp(max(POOL_CONEXOES_PNCP, max_workers))
+
+    conexoes_abertas = []
+    lock_conexoes = threading.Lock()
+    inicio = time.monotonic()
+    ultimo_log = inicio
+    concluidas = falhas = ocupadas = licitacoes_total = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='backfill_worker') as executor:
+        futuros = {executor.submit(_tarefa_shard_backfill, conexoes_abertas, lock_conexoes, shard): shard for shard in pendentes}
+        for futuro in as_completed(futuros):
+            shard = futuros[futuro]
             try:
-                # Processa todas as licitações da página DENTRO de uma única transação
-                for lic_api in licitacoes_data:
-                    save_licitacao_to_db(conn, lic_api)
-                
-                # O commit só acontece aqui, UMA VEZ para a página inteira
+                status, licitacoes = futuro.result()
+            except Exception:
+                logger.exception(f"BACKFILL: Erro inesperado na fatia {shard['id']} (modalidade {shard['modalidade_id']}).")
+                status, licitacoes = 'falha', 0
+            licitacoes_total += licitacoes
+            if status == 'concluido':
+                concluidas += 1
+            elif status == 'ocupada':
+                ocupadas += 1
+            else:
+                falhas += 1
+
+            agora = time.monotonic()
+            feitas = concluidas + falhas + ocupadas
+            if agora - ultimo_log >= INTERVALO_LOG_PROGRESSO_BACKFILL or feitas == total:
+                ultimo_log = agora
+                decorrido = agora - inicio
+                eta = decorrido / feitas * (total - feitas)
+                logger.info(
+                    f"BACKFILL: {feitas}/{total} fatias ({feitas / total:.0%}), {falhas} com falha, {ocupadas} com outra execução, "
+                    f"{licitacoes_total} licitações, {licitacoes_total / max(decorrido, 1e-9):.1f} lic/s. "
+                    f"Decorrido {_formatar_duracao(decorrido)}, ETA {_formatar_duracao(eta)}. Taxa da API: {limitador_pncp.resumo()['taxa_atual']:.1f} req/s."
+                )
+
+    for conn in conexoes_abertas:
+        try:
+            conn.close()
+        except mysql.connector.Error:
+            pass
+    fechar_enriquecimento_async()
+    logger.info(f"\n--- Backfill Concluído ---")
+    logger.info(f"BACKFILL: {concluidas} fatias concluídas, {falhas} com falha (rode o mesmo comando de novo para tentar só essas).")
+    logar_estatisticas_conexoes_pncp()
+    logar_estatisticas_cache_subrecursos()
+
+
+# ======= REPLAY DO ARQUIVO BRUTO (python sync_api.py replay --from AAAAMMDD --to AAAAMMDD) =======
+# Reingere as páginas de listagem arquivadas (ver ArquivoBrutoPNCP) pelo mesmo caminho de escrita do sync, com
+# commit por página e regravar=True. Itens/arquivos vêm do arquivo bruto: do mesmo dia da captura ou do dia seguinte
+# (página capturada perto da meia-noite). Só o que não estiver arquivado é buscado no PNCP (contado no resumo).
+def _carregar_subrecursos_do_dia(dia):
+    """{('itens'|'arquivos', chave): dados} de um dia do arquivo bruto (a captura mais recente vence)."""
+    subrecursos = {}
+    for registro in ler_arquivo_bruto_do_dia(dia):
+        if registro['tipo'] in ('itens', 'arquivos'):
+            subrecursos[(registro['tipo'], registro['parametros']['chave'])] = registro['dados']
+    return subrecursos
+
+def replay_arquivo_bruto(data_de, data_ate):
+    """Regrava no banco as páginas arquivadas entre data_de e data_ate (datas de captura, inclusivas)."""
+    conn = get_db_connection()
+    if not conn: return
+    inicio = time.monotonic()
+    paginas = licitacoes = falhas = subrecursos_ausentes = 0
+    subrecursos_por_dia = {}
+
+    dia = data_de
+    while dia <= data_ate:
+        for d in (dia, dia + timedelta(days=1)):
+            if d not in subrecursos_por_dia:
+                subrecursos_por_dia[d] = _carregar_subrecursos_do_dia(d)
+        subrecursos_por_dia.pop(dia - timedelta(days=1), None)
+        # O mesmo dia tem prioridade sobre o dia seguinte
+        subrecursos = {**subrecursos_por_dia[dia + timedelta(days=1)], **subrecursos_por_dia[dia]}
+
+        for registro in ler_arquivo_bruto_do_dia(dia):
+            if registro['tipo'] != 'listagem':
+                continue
+            licitacoes_data = registro['dados']
+            parametros = registro['parametros']
+            enriquecimentos = {}
+            for lic_api in licitacoes_data:
+                lic_db = mapear_licitacao_api_para_db(lic_api)
+                if not tem_chaves_subrecursos(lic_db):
+                    continue
+                chave = chave_subrecursos_arquivo_bruto(lic_db['orgaoEntidadeCnpj'], lic_db['anoCompra'], lic_db['sequencialCompra'])
+                enriquecimento = {}
+                for tipo in ('itens', 'arquivos'):
+                    if (tipo, chave) in subrecursos:
+                        enriquecimento[tipo] = subrecursos[(tipo, chave)]
+                if 'itens' not in enriquecimento:
+                    subrecursos_ausentes += 1
+                enriquecimentos[lic_db['numeroControlePNCP']] = enriquecimento
+
+            conn = garantir_conexao_ativa(conn)
+            if not conn:
+                logger.critical("REPLAY: Sem conexão com o banco. Abortando.")
+                return
+            try:
+                salvar_pagina_licitacoes_em_lote(conn, licitacoes_data, enriquecimentos, regravar=True)
                 conn.commit()
-                
-                # Se o commit foi bem-sucedido, atualizamos os contadores
-                logger.info(f"Página {pagina_atual} da modalidade {modalidade_id_sync} commitada com sucesso.")
-                licitacoes_processadas_total += len(licitacoes_data)
-                paginas_processadas_modalidade += 1
-
-            except mysql.connector.errors.OperationalError as op_err:
-                # Captura especificamente o erro de "Lost connection"
-                logger.error(f"Erro operacional de DB (ex: conexão perdida) no lote da página {pagina_atual}. Erro: {op_err}")
-                # Não tentamos rollback, pois a conexão está provavelmente morta.
-                # A lógica no início do loop 'while' cuidará da reconexão.
-                motivo_falha = f"Erro operacional de DB no lote da página {pagina_atual}: {op_err}"
-                logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, motivo_falha)
-
-            except Exception as e:
-                # Para outros erros de BD, tentamos o rollback
-                logger.error(f"Falha ao processar o lote da página {pagina_atual}. Rollback executado. Erro: {e}")
+                paginas += 1
+                licitacoes += len(licitacoes_data)
+            except mysql.connector.Error as e:
+                falhas += 1
+                logger.error(f"REPLAY: Falha ao regravar a página {parametros.get('pagina')} da modalidade {parametros.get('modalidade')} capturada em {registro['capturado_em']}: {e}")
                 try:
                     conn.rollback()
-                except mysql.connector.Error as rb_err:
-                    logger.error(f"Erro adicional durante o rollback: {rb_err}")
-                motivo_falha = f"Erro de banco de dados no lote da página {pagina_atual}: {e}"
-                logar_pagina_falha(modalidade_id_sync, pagina_atual, data_inicio_api_str, data_fim_api_str, motivo_falha)
-
-            
-            logger.info(f"SINCRONIZAÇÃO MODALIDADE: Página {pagina_atual} processada. {paginas_restantes} páginas restantes.")
-            
-            if paginas_restantes == 0:
-                logger.info(f"SINCRONIZAÇÃO MODALIDADE: API indicou ser a última página para a modalidade {modalidade_id_sync}.")
-                break
-            
-            pagina_atual += 1
-            time.sleep(0.5)
+                except mysql.connector.Error:
+                    pass
+        logger.info(f"REPLAY: Dia {dia:%Y%m%d} concluído. {paginas} páginas, {licitacoes} licitações até agora.")
+        dia += timedelta(days=1)
 
     conn.close()
-    logger.info(f"\n--- Sincronização da Janela Anual Concluída ---")
-    logger.info(f"Total de licitações da API processadas com sucesso: {licitacoes_processadas_total}")
+    duracao = max(time.monotonic() - inicio, 1e-9)
+    logger.info(f"\n--- Replay Concluído ---")
+    logger.info(
+        f"REPLAY: {paginas} páginas ({licitacoes} licitações) regravadas em {duracao:.1f}s "
+        f"({paginas / duracao:.2f} páginas/s, {licitacoes / duracao:.1f} licitações/s). {falhas} páginas com falha. "
+        f"{subrecursos_ausentes} licitações sem itens no arquivo bruto (buscados no PNCP)."
+    )
+    logar_estatisticas_conexoes_pncp()
+
+
+# ======= CONTAGENS AGREGADAS E GERAÇÃO DOS DADOS (consumidas pela /api/licitacoes do app.py) =======
+# No fim de cada execução que gravou licitações: recalcula licitacoes_agregados (total por situacaoReal, UF e
+# modalidade, usada como contagem estimada da busca) e incrementa a geração dos dados no Redis (geracao_cache.py),
+# o que invalida de uma vez os caches da API (buscas, exportações e contagens). Execução sem mudança não mexe na
+# geração: o cache da API continua valendo.
+SQL_RECALCULAR_AGREGADOS = """
+    INSERT INTO licitacoes_agregados (situacaoReal, unidadeOrgaoUfSigla, modalidadeId, total)
+    SELECT situacaoReal, unidadeOrgaoUfSigla, modalidadeId, COUNT(*)
+    FROM licitacoes
+    GROUP BY situacaoReal, unidadeOrgaoUfSigla, modalidadeId
+"""
+
+def licitacoes_gravadas_na_execucao():
+    """Licitações novas, atualizadas ou completadas nesta execução (contadores do metricas_sync)."""
+    por_resultado = metricas.resumo()['contadores'].get('licitacoes_total', {})
+    return sum(valor for rotulo, valor in por_resultado.items() if rotulo.split('=')[-1] in ('nova', 'atualizada', 'completada'))
+
+def publicar_alteracoes_dados(alteracoes=None):
+    """
+    Recalcula as contagens agregadas e incrementa a geração dos dados. Falhas só são logadas.
+    'alteracoes' = linhas alteradas pelo chamador (0 = nada a publicar); None = licitações gravadas nesta execução.
+    """
+    if alteracoes is None:
+        alteracoes = licitacoes_gravadas_na_execucao()
+    if not alteracoes:
+        logger.info("AGREGADOS: Nenhuma licitação alterada; a geração dos dados (e o cache da API) continua a mesma.")
+        return
+    conn = get_db_connection()
+    if conn:
+        cursor = conn.cursor()
+        try:
+            with metricas.medir('db_segundos', etapa='agregados'):
+                cursor.execute("DELETE FROM licitacoes_agregados") # DELETE (não TRUNCATE): a API nunca vê a tabela vazia
+                cursor.execute(SQL_RECALCULAR_AGREGADOS)
+                conn.commit()
+            logger.info(f"AGREGADOS: Contagens por status/UF/modalidade recalculadas ({cursor.rowcount} grupos).")
+        except mysql.connector.Error as e:
+            logger.warning(f"AGREGADOS: Não foi possível recalcular licitacoes_agregados ({e}). A API segue com o COUNT(*) ou a contagem anterior.")
+            try:
+                conn.rollback()
+            except mysql.connector.Error:
+                pass
+        finally:
+            cursor.close()
+            conn.close()
+    geracao = incrementar_geracao()
+    if geracao is None:
+        logger.warning("AGREGADOS: Redis indisponível; a geração dos dados não foi incrementada (o cache da API só vence pelo timeout).")
+    else:
+        logger.info(f"AGREGADOS: {alteracoes} licitações alteradas. Geração dos dados agora é {geracao}.")
 
 
 if __name__ == '__main__':
-    # --- MECANISMO DE LOCK PARA IMPEDIR EXECUÇÃO CONCORRENTE ---
-    try:
-        # Tenta criar e obter um lock exclusivo em um arquivo.
-        # O 'f' será fechado automaticamente quando o script terminar, liberando o lock.
-        f = open("sync_api.lock", "w")
-        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        logger.info("Lock adquirido. Nenhuma outra instância em execução.")
-    except IOError:
-        logger.warning("Outra instância do script já está em execução. Saindo.")
-        sys.exit(0) # Sai silenciosamente
-    # --- FIM DO MECANISMO DE LOCK ---
-
-    logger.info(f"Iniciando script de sincronização (janela de {DIAS_JANELA_SINCRONIZACAO} dias de atualizações)...")
-    sync_licitacoes_ultima_janela_anual()
-    logger.info("Script de sincronização finalizado.")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Sincroniza as licitações do PNCP com o banco local.")
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS_SYNC,
+                        help="Páginas processadas em paralelo (teto global). 1 = modo sequencial. Padrão: SYNC_MAX_WORKERS ou 1.")
+    subcomandos = parser.add_subparsers(dest='comando')
+    parser_backfill = subcomandos.add_parser('backfill', help="Sincroniza um período histórico em fatias paralelas e retomáveis.")
+    data_arg = lambda valor: datetime.strptime(valor, '%Y%m%d').date()
+    parser_backfill.add_argument('--from', dest='data_de', type=data_arg, required=True, help="Data inicial (AAAAMMDD) de atualização.")
+    parser_backfill.add_argument('--to', dest='data_ate', type=data_arg, default=datetime.now().date(), help="Data final (AAAAMMDD). Padrão: hoje.")
+    parser_backfill.add_argument('--workers', dest='workers_backfill', type=int, default=MAX_WORKERS_BACKFILL,
+                                 help="Fatias processadas em paralelo. Padrão: SYNC_BACKFILL_WORKERS ou 8.")
+    parser_backfill.add_argument('--shard', choices=['dia', 'semana'], default='semana', help="Tamanho de cada fatia. Padrão: semana.")
+    parser_replay = subcomandos.add_parser('replay', help="Regrava no banco as respostas guardadas no arquivo bruto (sem chamar o PNCP).")
+    parser_replay.add_argument('--from', dest='data_de', type=data_arg, required=True, help="Primeiro dia de captura (AAAAMMDD).")
+    parser_replay.add_argument('--to', dest='data_ate', type=data_arg, default=datetime.now().date(), help="Último dia de captura (AAAAMMDD). Padrão: hoje.")
+    args = parser.parse_args()
+    if args.comando in ('backfill', 'replay') and args.data_de > args.data_ate:
+        parser.error("--from deve ser anterior ou igual a --to.")
+
+    if args.comando == 'replay':
+        # Sem lock: o replay não chama o PNCP e grava pelo mesmo UPSERT do sync, então pode rodar junto com ele
+        logger.info(f"Iniciando replay do arquivo bruto de {args.data_de:%Y%m%d} a {args.data_ate:%Y%m%d}...")
+        replay_arquivo_bruto(args.data_de, args.data_ate)
+        publicar_alteracoes_dados()
+        exportar_metricas_execucao('replay')
+        logger.info("Script de replay finalizado.")
+        sys.exit(0)
+
+    # --- COORDENAÇÃO: sem lock global. O sync reserva cada modalidade e o backfill cada fatia (leases em sync_leases),
+    # então execuções em paralelo (ou em outras máquinas) dividem o trabalho em vez de saírem sem fazer nada.
+    # Cada processo tem o seu limitador: com várias execuções ao mesmo tempo, divida o PNCP_TAXA_MAXIMA entre elas.
+
+    if args.comando == 'backfill':
+        logger.info(f"Iniciando backfill de {args.data_de:%Y%m%d} a {args.data_ate:%Y%m%d}...")
+        backfill_licitacoes(args.data_de, args.data_ate, args.workers_backfill, args.shard)
+        publicar_alteracoes_dados()
+        exportar_metricas_execucao('backfill')
+        logger.info("Script de backfill finalizado.")
+        sys.exit(0)
+
+    logger.info(f"Iniciando script de sincronização (a partir da marca d'água de cada modalidade, sobreposição de {SOBREPOSICAO_MARCA_DAGUA_HORAS}h)...")
+    if args.workers > 1:
+        sync_licitacoes_concorrente(args.workers)
+    else:
+        sync_licitacoes_ultima_janela_anual()
+    publicar_alteracoes_dados()
+    exportar_metricas_execucao('concorrente' if args.workers > 1 else 'sequencial')
+    logger.info("Script de sincronização finalizado.")
@@ -0,0 +1,47 @@
+# arquivo worker_enriquecimento.py
+# Worker da fila de enriquecimento: busca e grava itens e arquivos das licitações que o sync_api.py enfileirou
+# (SYNC_ENRIQUECIMENTO_FILA=1). Escala na horizontal: rode mais processos (--processos) ou mais máquinas
+# apontando para o mesmo REDIS_URL e o mesmo banco.
+# Cada processo tem o seu limitador de requisições ao PNCP: divida o PNCP_TAXA_MAXIMA entre os processos.
+# Jobs que esgotaram as retentativas ficam na FailedJobRegistry da fila (rq info / rq requeue --all --queue enriquecimento_pncp).
+# Uso: python worker_enriquecimento.py --processos 4   (--burst: processa o que há na fila e sai)
+import argparse
+from redis import Redis
+from rq import Queue, SimpleWorker
+from rq.worker_pool import WorkerPool
+
+from sync_api import (
+    REDIS_URL_SYNC,
+    NOME_FILA_ENRIQUECIMENTO,
+    publicar_alteracoes_enriquecimento,
+    fechar_arquivo_bruto,
+    logar_estatisticas_conexoes_pncp,
+    logar_estatisticas_cache_subrecursos,
+    logger
+)
+
+
+def executar_worker(processos=1, burst=False):
+    """Um processo: SimpleWorker (os jobs rodam no próprio processo, reaproveitando conexões e cache). Mais: WorkerPool."""
+    conexao = Redis.from_url(REDIS_URL_SYNC)
+    logger.info(f"WORKER_ENRIQUECIMENTO: Consumindo '{NOME_FILA_ENRIQUECIMENTO}' em {REDIS_URL_SYNC} com {processos} processo(s).")
+    if processos > 1:
+        WorkerPool([NOME_FILA_ENRIQUECIMENTO], connection=conexao, num_workers=processos, worker_class=SimpleWorker).start(burst=burst)
+        return
+    worker = SimpleWorker([Queue(NOME_FILA_ENRIQUECIMENTO, connection=conexao)], connection=conexao)
+    try:
+        # with_scheduler: as retentativas com intervalo (Retry) dependem do scheduler do rq
+        worker.work(burst=burst, with_scheduler=True)
+    finally:
+        publicar_alteracoes_enriquecimento(forcar=True) # O que sobrou do último intervalo
+        fechar_arquivo_bruto()
+        logar_estatisticas_conexoes_pncp()
+        logar_estatisticas_cache_subrecursos()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Worker da fila de enriquecimento (itens e arquivos) do sync do PNCP.")
+    parser.add_argument('--processos', type=int, default=1, help="Processos worker nesta máquina.")
+    parser.add_argument('--burst', action='store_true', help="Esvazia a fila e sai (ex: cron).")
+    args = parser.parse_args()
+    executar_worker(args.processos, args.burst)